@@ -0,0 +1,327 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+import collections
+import config
+import data_layer
+import hashlib
+import json
+import logging
+import public_transport_hourly
+import threading
+import traffic_announcements_sketches
+import traffic_density_hourly
+import traffic_density_spatial
+import utils
+import wifi_new_user_daily
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger('IMM Data Visualization - Aggregate Service')
+
+# JSON endpoints over the aggregates behind the charts; e.g.
+# curl 'http://127.0.0.1:8502/traffic/heatmap?year=2020&month=January'
+# The aggregates of a data set are computed once, at its first request, by the shared data layer, and the responses
+# are kept in an LRU cache keyed by the normalized query, so the repeated requests are answered without touching
+# the data. A request with missing, unknown or invalid parameters is answered with 400, any other failure with 500.
+
+
+class InvalidQuery(Exception):
+    """
+    A parameter of the request is missing, unknown or not valid.
+    """
+
+
+def splitting_list(value, default=None):
+    """
+    :param value: string; comma separated
+    :param default: list
+    :rtype: list
+    """
+    return default if value is None else [v for v in value.split(',') if v]
+
+
+def transport_hourly_averages(data, params):
+    """
+    :param data: data of the data set, from its published snapshot
+    :param params: dict; year, month & lines (config.pth_lines if it is missing)
+    :rtype: tuple; dataframe & orient
+    """
+    lines = params.get('lines', config.pth_lines)
+    unknown = sorted(set(lines) - set(data['line'].unique()))
+    if unknown:
+        raise InvalidQuery('unknown line(s) {0}'.format(', '.join(unknown)))
+    df = public_transport_hourly.data_generator(data=data, year=params['year'], month=params['month'], is_line=True)
+    df = public_transport_hourly.creating_avg_data_all_date_breakdown(df=df, lines=lines, time_type='hours',
+                                                                      h=config.hours)
+    return df, 'records'
+
+
+def traffic_heatmap(data, params):
+    """
+    :param data: data of the data set, from its published snapshot
+    :param params: dict; lists of years & months, and hours
+    :rtype: tuple
+    """
+    years = params['year']
+    df = traffic_density_hourly.slicing_heatmap_tensor(data['tensor'], years if len(years) > 1 else years[0],
+                                                       params['month'], hours=params.get('hours'))
+    return df, 'split'
+
+
+def traffic_nearby(data, params):
+    """
+    :param data: data of the data set, from its published snapshot
+    :param params: dict; latitude, longitude, year & month, and radius_km or k (5 nearest locations if both are
+                   missing)
+    :rtype: tuple; the locations measured in the month, sorted by distance, with their average number of vehicles
+    """
+    key = (params['year'], params['month'])
+    if key not in data['spatial_index']:
+        raise InvalidQuery('there is no traffic density data for {0} {1}'.format(params['month'], params['year']))
+    if 'radius_km' in params:
+        df = traffic_density_spatial.querying_radius(data['spatial_index'][key], params['latitude'],
+                                                     params['longitude'], params['radius_km'])
+    else:
+        df = traffic_density_spatial.querying_knn(data['spatial_index'][key], params['latitude'], params['longitude'],
+                                                  k=params.get('k', 5))
+    return df.drop(columns='row'), 'records'
+
+
+def dam_buckets(data, params):
+    """
+    :param data: data of the data set, from its published snapshot
+    :param params: dict; granularity (monthly), col (occupancy_rate) & aggs (mean)
+    :rtype: tuple
+    """
+    df = utils.getting_time_buckets(data['buckets'], params.get('granularity', 'monthly'),
+                                    params.get('aggs', ['mean']))[params.get('col', 'occupancy_rate')]
+    return df.reset_index(), 'records'
+
+
+def wifi_buckets(data, params):
+    """
+    :param data: data of the data set, from its published snapshot
+    :param params: dict; granularity (monthly)
+    :rtype: tuple
+    """
+    df = utils.getting_time_buckets(data['buckets'], params.get('granularity', 'monthly'),
+                                    ['sum'])['number_of_subscription']
+    return df.reset_index(), 'records'
+
+
+def wifi_subscriptions(data, params):
+    """
+    :param data: data of the data set, from its published snapshot
+    :param params: dict; dims (subscription_county), values (number_of_subscription), counties
+    :rtype: tuple
+    """
+    cube = data['cube']
+    if 'counties' in params:
+        cube = cube[cube['subscription_county'].isin(params['counties'])]
+    df = wifi_new_user_daily.rolling_up_cube(cube, params.get('dims', ['subscription_county']),
+                                             values=params.get('values', ['number_of_subscription']))
+    return df, 'records'
+
+
+def announcement_monthly_counts(data, params):
+    """
+    :param data: data of the data set, from its published snapshot
+    :param params: dict; types (all types if it is missing)
+    :rtype: tuple
+    """
+    df = data['monthly_counts']
+    # a type without any announcement has no column
+    df = df.reindex(columns=params['types'], fill_value=0) if 'types' in params else df
+    return df.reset_index(), 'records'
+
+
+def announcement_duration_quantiles(data, params):
+    """
+    :param data: data of the data set, from its published snapshot
+    :param params: dict; by (announcement_type_desc or month), months (YYYY-MM), qs
+    :rtype: tuple
+    """
+    qs = params.get('qs', config.tai_sketch_quantiles)
+    if any(q < 0 or q > 1 for q in qs):
+        raise InvalidQuery('qs have to be between 0 and 1')
+    df = traffic_announcements_sketches.creating_quantile_table(
+        data['sketches'], by=params.get('by', 'announcement_type_desc'), months=params.get('months'), qs=qs)
+    return df, 'records'
+
+
+# endpoint -> (data set, function)
+endpoints = {'/transport/hourly-averages': ('pth', transport_hourly_averages),
+             '/traffic/heatmap': ('tdh', traffic_heatmap),
+             '/traffic/nearby': ('tdh', traffic_nearby),
+             '/dam/buckets': ('dor', dam_buckets),
+             '/wifi/buckets': ('wnu', wifi_buckets),
+             '/wifi/subscriptions': ('wnu', wifi_subscriptions),
+             '/announcements/monthly-counts': ('tai', announcement_monthly_counts),
+             '/announcements/duration-quantiles': ('tai', announcement_duration_quantiles)}
+# endpoint -> parameter -> (required, type, comma separated list, allowed values or None)
+parameters = {
+    '/transport/hourly-averages': {'year': (True, int, False, None), 'month': (True, str, False, list(config.months)),
+                                   'lines': (False, str, True, None)},
+    '/traffic/heatmap': {'year': (True, int, True, None), 'month': (True, str, True, list(config.months)),
+                         'hours': (False, int, True, config.hours)},
+    '/traffic/nearby': {'latitude': (True, float, False, None), 'longitude': (True, float, False, None),
+                        'year': (True, int, False, None), 'month': (True, str, False, list(config.months)),
+                        'radius_km': (False, float, False, None), 'k': (False, int, False, None)},
+    '/dam/buckets': {'granularity': (False, str, False, list(config.time_granularity)),
+                     'col': (False, str, False, config.dor_cols),
+                     'aggs': (False, str, True, ['mean', 'sum', 'count', 'min', 'max'])},
+    '/wifi/buckets': {'granularity': (False, str, False, list(config.time_granularity))},
+    '/wifi/subscriptions': {'dims': (False, str, True, ['subscription_date', 'subscription_county',
+                                                         'subscription_type', 'hex_id']),
+                            'values': (False, str, True, ['record_count', 'number_of_subscription']),
+                            'counties': (False, str, True, None)},
+    '/announcements/monthly-counts': {'types': (False, str, True, config.atd_list)},
+    '/announcements/duration-quantiles': {'by': (False, str, False, ['announcement_type_desc', 'month']),
+                                          'months': (False, str, True, None), 'qs': (False, float, True, None)}
+}
+# the responses of the LRU cache; (endpoint, query, snapshot version) -> (body, ETag)
+responses = collections.OrderedDict()
+responses_lock = threading.Lock()
+
+
+def validating(path, query):
+    """
+    :param path: string; endpoint
+    :param query: list; (key, value) pairs of the query string
+    :rtype: dict; parsed parameters, the list parameters are split on the commas
+    """
+    spec = parameters[path]
+    query = dict(query)
+    unknown = sorted(set(query) - set(spec))
+    if unknown:
+        raise InvalidQuery('unknown parameter(s) {0}'.format(', '.join(unknown)))
+
+    params = {}
+    for name, (required, type_, is_list, choices) in spec.items():
+        if name not in query:
+            if required is True:
+                raise InvalidQuery('{0} is required'.format(name))
+            continue
+        values = splitting_list(query[name]) if is_list is True else [query[name]]
+        try:
+            values = [type_(v) for v in values]
+        except ValueError:
+            raise InvalidQuery('{0} has to be {1}'.format(name, type_.__name__))
+        invalid = [v for v in values if choices is not None and v not in choices]
+        if not values or invalid:
+            raise InvalidQuery('{0} has to be in {1}'.format(name, choices) if choices is not None
+                               else '{0} is empty'.format(name))
+        params[name] = values if is_list is True else values[0]
+    return params
+
+
+def answering(path, params, snapshot):
+    """
+    The responses are cached per snapshot version, so a refreshed data set is answered from its new snapshot
+    while the responses of the previous one age out of the cache.
+    :param path: string
+    :param params: dict; output of validating
+    :param snapshot: dict; published snapshot of the data set of the endpoint, from data_layer.getting_snapshot
+    :rtype: tuple; JSON body as bytes & its ETag
+    """
+    key = (path, tuple(sorted((k, tuple(v) if isinstance(v, list) else v) for k, v in params.items())),
+           snapshot['version'])
+    with responses_lock:
+        if key in responses:
+            responses.move_to_end(key)
+            return responses[key]
+
+    df, orient = endpoints[path][1](snapshot['data'], params)
+    body = df.to_json(orient=orient, date_format='iso', force_ascii=False).encode('utf-8')
+    with responses_lock:
+        responses[key] = body, '"{0}"'.format(hashlib.sha1(body).hexdigest())
+        while len(responses) > config.service_cache_size:
+            responses.popitem(last=False)
+    return responses[key]
+
+
+class AggregateHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive connections
+    disable_nagle_algorithm = True  # headers & body are separate writes, Nagle would delay the body
+
+    def do_GET(self):
+        """
+        :return: None
+        """
+        url = urlsplit(self.path)
+        if url.path in ['/', '/endpoints']:
+            return self.sending(200, json.dumps(sorted(endpoints)).encode('utf-8'))
+        if url.path not in endpoints:
+            return self.sending(404, json.dumps({'error': 'unknown endpoint {0}'.format(url.path)}).encode('utf-8'))
+
+        try:
+            params = validating(url.path, parse_qsl(url.query))
+            body, etag = answering(url.path, params, data_layer.getting_snapshot(endpoints[url.path][0]))
+        except InvalidQuery as e:
+            return self.sending(400, json.dumps({'error': str(e)}).encode('utf-8'))
+        except Exception as e:
+            logger.exception('{0} could not be answered.'.format(self.path))
+            return self.sending(500, json.dumps({'error': '{0}: {1}'.format(type(e).__name__, e)}).encode('utf-8'))
+
+        if etag in [t.strip() for t in self.headers.get('If-None-Match', '').split(',')]:
+            return self.sending(304, b'', etag)
+        return self.sending(200, body, etag)
+
+    def sending(self, status, body, etag=None):
+        """
+        :param status: int
+        :param body: bytes
+        :param etag: string
+        :return: None
+        """
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def warming_responses(dat_name):
+    """
+    Computes the responses of config.service_warm_queries that use the data set, for its published snapshot.
+    :param dat_name: string
+    :return: None
+    """
+    snapshot = data_layer.getting_snapshot(dat_name)
+    for path, query in config.service_warm_queries:
+        if endpoints[path][0] == dat_name:
+            answering(path, validating(path, query.items()), snapshot)
+
+
+def serving(host=config.service_host, port=config.service_port, warm=True):
+    """
+    :param host: string
+    :param port: int
+    :param warm: bool; if True, the warmer builds the data sets of config.warmer_datasets in the background and
+                 rebuilds them on its schedule, otherwise a data set is built at its first request
+    :return: None
+    """
+    if warm is True:
+        data_layer.starting_warmer(after=warming_responses)
+
+    server = ThreadingHTTPServer((host, port), AggregateHandler)
+    server.daemon_threads = True
+    logger.info('Serving the aggregates on http://{0}:{1}'.format(host, port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    serving()
@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Benchmark of the aggregation backends (pandas, sqlite and duckdb if it is installed) on synthetic data sets;
+# the results of every backend are checked against the pandas path.
+# It can be run from the project root with: python benchmarks/bench_aggregation_backend.py
+
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config  # noqa: E402
+import public_transport_hourly  # noqa: E402
+import sql_backend  # noqa: E402
+import traffic_announcements_instant  # noqa: E402
+import traffic_density_hourly  # noqa: E402
+import utils  # noqa: E402
+
+
+def creating_samples(seed=0):
+    """
+    :param seed: int
+    :rtype: dict; prepared data sets with the shapes of the real ones
+    """
+    rng = np.random.default_rng(seed)
+
+    n = 2000000
+    hours = pd.date_range('2020-01-01', '2021-03-01', freq='H', inclusive='left')
+    tdh = pd.DataFrame({'date_time': hours[rng.integers(0, len(hours), n)],
+                        'number_of_vehicles': rng.integers(0, 500, n)})
+
+    pth = pd.DataFrame({'date_time': hours[rng.integers(0, len(hours), n)],
+                        'line': rng.choice(['L{0}'.format(i) for i in range(500)], n),
+                        'number_of_passenger': rng.integers(0, 1000, n),
+                        'number_of_passage': rng.integers(0, 1000, n)})
+    pth['month'] = pth['date_time'].dt.month_name()
+    pth['year'] = pth['date_time'].dt.year
+
+    start = pd.Timestamp('2018-01-01') + pd.to_timedelta(rng.integers(0, 3 * 365 * 86400, 500000), unit='s')
+    tai = pd.DataFrame({'announcement_starting_datetime': start,
+                        'announcement_ending_datetime': start + pd.to_timedelta(rng.integers(60, 86400, len(start)),
+                                                                                unit='s'),
+                        'announcement_type_desc': rng.choice(config.atd_list, len(start))})
+
+    dates = pd.date_range('2005-01-01', '2021-05-01')
+    dor = pd.DataFrame({'date': dates, 'occupancy_rate': rng.random(len(dates)),
+                        'reserved_water': rng.random(len(dates)) * 1000})
+    return {'tdh': tdh, 'pth': pth, 'tai': tai, 'dor': dor}
+
+
+def running(samples, backend):
+    """
+    :param samples: dict
+    :param backend: string
+    :rtype: dict; result and seconds per aggregation, the first run loads the tables
+    """
+    jobs = {
+        'traffic heatmap tensor': lambda: traffic_density_hourly.creating_heatmap_tensor(
+            samples['tdh'], backend=backend)['sum'],
+        'monthly passenger sums by line': lambda: public_transport_hourly.data_generator(
+            samples['pth'], 2020, 'January', is_line=True, backend=backend),
+        'announcement counts by type & month': lambda: traffic_announcements_instant.creating_monthly_type_counts(
+            samples['tai'], backend=backend),
+        'occupancy monthly means': lambda: utils.getting_time_buckets(utils.creating_time_buckets(
+            samples['dor'], 'date', config.dor_cols, backend=backend, table='dam_occupancy_rates'), 'monthly'),
+    }
+    results = {}
+    for name, job in jobs.items():
+        job()
+        t = time.perf_counter()
+        result = job()
+        results[name] = (result, time.perf_counter() - t)
+    return results
+
+
+def comparing(a, b):
+    """
+    :param a: numpy array or dataframe
+    :param b: numpy array or dataframe
+    :rtype: bool
+    """
+    if isinstance(a, pd.DataFrame):
+        return a.shape == b.shape and all(np.allclose(a[c].values.astype(np.float64), b[c].values.astype(np.float64),
+                                                      equal_nan=True) if a[c].dtype.kind in 'iuf'
+                                          else np.array_equal(a[c].values, b[c].values) for c in a.columns)
+    return np.allclose(a, b, equal_nan=True)
+
+
+def main():
+    """
+    :return: None
+    """
+    config.sql_database_dir = tempfile.mkdtemp()
+    samples = creating_samples()
+    backends = ['pandas', 'sqlite'] + ([] if sql_backend.duckdb is None else ['duckdb'])
+    results = {b: running(samples, b) for b in backends}
+
+    print('{0:<40}'.format('aggregation') + ''.join('{0:>12}'.format(b + ' ms') for b in backends) + '  same')
+    for name, (expected, _) in results['pandas'].items():
+        same = all(comparing(expected, results[b][name][0]) for b in backends[1:])
+        print('{0:<40}'.format(name) + ''.join('{0:>12.1f}'.format(1000 * results[b][name][1]) for b in backends)
+              + '  {0}'.format(same))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Benchmark of the timestamp parsing of traffic_announcements_instant on a million-row announcements sample.
+# It can be run from the project root with: python benchmarks/bench_datetime_parsing.py
+
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils  # noqa: E402
+
+n_rows = 1000000
+
+
+def creating_sample(n=n_rows, seed=0):
+    """
+    :param n: int
+    :param seed: int
+    :rtype: dataframe; announcement timestamps as strings with milliseconds, like the raw data
+    """
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp('2018-01-01').value // 10 ** 9 + rng.integers(0, 3 * 365 * 86400, n)
+    end = start + rng.integers(60, 86400, n)
+    to_str = (lambda s: pd.to_datetime(s, unit='s').strftime('%Y-%m-%d %H:%M:%S') + '.000')
+    return pd.DataFrame({'announcement_starting_datetime': to_str(start),
+                         'announcement_ending_datetime': to_str(end)})
+
+
+def parsing_per_row(df, col_name):
+    """
+    The previous implementation of traffic_announcements_instant.creating_datetime_col
+    :param df: dataframe
+    :param col_name: string
+    :return: None
+    """
+    df[col_name] = df[col_name].apply(lambda row: row[:19])
+    df[col_name] = pd.to_datetime(df[col_name])
+
+
+def main():
+    """
+    :return: None
+    """
+    sample = creating_sample()
+    cols = ['announcement_starting_datetime', 'announcement_ending_datetime']
+
+    df_old = sample.copy()
+    t = time.perf_counter()
+    for c in cols:
+        parsing_per_row(df_old, c)
+    t_old = time.perf_counter() - t
+
+    df_new = sample.copy()
+    t = time.perf_counter()
+    utils.parsing_datetime(df_new, cols, length=19)
+    t_new = time.perf_counter() - t
+
+    df_fmt = sample.copy()
+    t = time.perf_counter()
+    utils.parsing_datetime(df_fmt, cols, length=19, fmt='%Y-%m-%d %H:%M:%S')
+    t_fmt = time.perf_counter() - t
+
+    pd.testing.assert_frame_equal(df_old, df_new)
+    pd.testing.assert_frame_equal(df_old, df_fmt)
+    print('rows: {0:,}'.format(len(sample)))
+    print('per-row slicing + to_datetime : {0:.3f} s'.format(t_old))
+    print('utils.parsing_datetime        : {0:.3f} s ({1:.1f}x)'.format(t_new, t_old / t_new))
+    print('utils.parsing_datetime (fmt)  : {0:.3f} s ({1:.1f}x)'.format(t_fmt, t_old / t_fmt))
+
+
+if __name__ == "__main__":
+    main()
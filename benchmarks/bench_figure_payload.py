@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Payload bytes and serialization time per figure, before (plain JSON) and after (figure_encoding) the encoding.
+# It can be run from the project root with: python benchmarks/bench_figure_payload.py
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import dam_occupancy_rates_daily  # noqa: E402
+import figure_encoding  # noqa: E402
+import traffic_density_hourly  # noqa: E402
+import wifi_new_user_daily  # noqa: E402
+
+
+def creating_figures(seed=0):
+    """
+    :param seed: int
+    :rtype: dict; figures of the dashboards built from synthetic data with the shapes of the real ones
+    """
+    rng = np.random.default_rng(seed)
+
+    # dam occupancy since 2005, daily
+    dates = pd.date_range('2005-01-01', '2021-05-01')
+    dor = pd.DataFrame({'date': dates, 'occupancy_rate': rng.random(len(dates)),
+                        'reserved_water': rng.random(len(dates)) * 1000})
+
+    # wifi subscriptions, one row per subscription
+    n = 200000
+    wnu = pd.DataFrame({'subscription_date': pd.Timestamp('2019-01-01') + pd.to_timedelta(rng.integers(0, 700, n),
+                                                                                          unit='D'),
+                        'subscription_county': rng.choice(['KADIKÖY', 'FATİH', 'KARTAL'], n),
+                        'subscription_type': rng.choice(['domestic', 'foreign'], n),
+                        'number_of_subscription': rng.integers(1, 5, n)})
+
+    # traffic density, one month of city-wide hourly totals & 2500 locations
+    hours = pd.date_range('2020-01-01', '2020-02-01', freq='H', inclusive='left')
+    tdh = pd.DataFrame({'date_time': hours, 'number_of_vehicles': rng.integers(100000, 500000, len(hours))})
+    loc = pd.DataFrame({'year': 2020, 'month': 'January', 'latitude': 41 + rng.random(2500) * 0.3,
+                        'longitude': 28.6 + rng.random(2500) * 0.6, 'mean': rng.random(2500) * 300})
+
+    return {
+        'dam daily line': dam_occupancy_rates_daily.creating_line_graph_based_date(
+            df=dor.copy(), date_type='daily', col='reserved_water'),
+        'dam colorful line': dam_occupancy_rates_daily.creating_colorful_line_graph_based_date(
+            df=dor.copy(), col='occupancy_rate'),
+        'wifi daily line': wifi_new_user_daily.creating_line_graph_based_date(df=wnu.copy(), date_type='daily'),
+        'traffic heatmap': traffic_density_hourly.creating_heatmap_graph(
+            df=traffic_density_hourly.creating_heatmap_data(tdh), year=2020, month='January'),
+        'traffic density map': traffic_density_hourly.creating_density_mapbox(
+            dat=loc, year=2020, month='January', is_aggregated=True),
+    }
+
+
+def main():
+    """
+    :return: None
+    """
+    print('{0:<36}{1:>14}{2:>14}{3:>8}{4:>12}{5:>12}'.format('figure', 'plain bytes', 'compact bytes', 'ratio',
+                                                           'plain ms', 'compact ms'))
+    for name, fig in creating_figures().items():
+        m = figure_encoding.measuring_payload(fig)
+        print('{0:<36}{1:>14,}{2:>14,}{3:>8.2f}{4:>12.1f}{5:>12.1f}'.format(
+            name, m['plain_bytes'], m['compact_bytes'], m['plain_bytes'] / m['compact_bytes'],
+            1000 * m['plain_sec'], 1000 * m['compact_sec']))
+
+
+if __name__ == "__main__":
+    main()
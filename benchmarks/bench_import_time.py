@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Import time of the project modules, measured with python -X importtime in a fresh interpreter per module; the
+# heaviest packages each module pulls in are listed, and the exit status is 1 if a module is over its budget.
+# It can be run from the project root with: python benchmarks/bench_import_time.py [module ...]
+
+import os
+import re
+import subprocess
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# milliseconds; the modules that are imported by the process pool workers, the service & the batch jobs, none of
+# which should import streamlit, datapane or the plotly express & figure factory modules at import time
+budgets_ms = {'utils': 600, 'sql_backend': 600, 'figure_encoding': 250, 'traffic_announcements_intervals': 600,
+              'traffic_announcements_sketches': 600, 'traffic_announcements_instant': 600,
+              'traffic_density_hourly': 600, 'public_transport_hourly': 600, 'dam_occupancy_rates_daily': 600,
+              'wifi_new_user_daily': 600, 'data_layer': 700, 'orchestrator': 900, 'aggregate_service': 800}
+n_runs = 5
+pattern = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def measuring(module):
+    """
+    :param module: string
+    :rtype: tuple; cumulative milliseconds of the module & of its direct imports, summed by top-level package
+    """
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module], cwd=root,
+                         capture_output=True, text=True, check=True).stderr
+    lines = [(len(m.group(3)), m.group(4), int(m.group(2)) / 1000) for m in map(pattern.match, out.splitlines())
+             if m is not None]
+    # a module is printed after its imports, one level deeper than the module itself
+    children = []
+    for depth, name, ms in lines:
+        if name == module:
+            packages = {}
+            for d, n, c in children:
+                if d == depth + 2:
+                    packages[n.split('.')[0]] = packages.get(n.split('.')[0], 0.0) + c
+            return ms, packages
+        children = [] if depth <= 1 else children + [(depth, name, ms)]
+    return 0.0, {}
+
+
+def main(modules=None):
+    """
+    :param modules: list; the modules of budgets_ms if it is None
+    :return: int; 1 if a module is over its budget
+    """
+    modules = modules or list(budgets_ms)
+    over = []
+    print('{0:<34}{1:>10}{2:>10}  {3}'.format('module', 'ms', 'budget', 'heaviest imports (ms)'))
+    for module in modules:
+        runs = [measuring(module) for _ in range(n_runs)]
+        total, packages = min(runs, key=lambda r: r[0])  # the least noisy run
+        heaviest = sorted(packages.items(), key=lambda kv: -kv[1])[:4]
+        budget = budgets_ms.get(module)
+        if budget is not None and total > budget:
+            over.append(module)
+        print('{0:<34}{1:>10.0f}{2:>10}  {3}'.format(module, total, '-' if budget is None else budget,
+                                                     ', '.join('{0} {1:.0f}'.format(k, v) for k, v in heaviest)))
+    if over:
+        print('over budget: {0}'.format(', '.join(over)))
+    return 1 if over else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Seconds until the first chart of the traffic density and public transport pages can be drawn, from the exact data
+# set and from its preview (config.preview_fraction), on synthetic monthly partitions read from snapshot files.
+# It can be run from the project root with: python benchmarks/bench_time_to_first_chart.py
+
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config  # noqa: E402
+import data_layer  # noqa: E402
+import public_transport_hourly  # noqa: E402
+import traffic_density_hourly  # noqa: E402
+import utils  # noqa: E402
+
+
+def creating_partitions(directory, seed=0):
+    """
+    Writes the raw monthly partitions of both data sets as fresh snapshot files & points the catalog at them.
+    :param directory: string
+    :param seed: int
+    :return: None
+    """
+    rng = np.random.default_rng(seed)
+    files = {'tdh': [], 'pth': []}
+    for m in ['2020-01', '2020-02', '2021-01', '2021-02']:
+        hours = pd.date_range(m + '-01', periods=24 * 28, freq='H').astype(str)
+
+        # traffic density, 2000 locations per hour
+        n = len(hours) * 2000
+        files['tdh'].append(('traffic_density_{0}.csv'.format(m), pd.DataFrame({
+            'DATE_TIME': np.repeat(hours, 2000), 'LATITUDE': np.tile(41 + rng.random(2000) * 0.3, len(hours)),
+            'LONGITUDE': np.tile(28.6 + rng.random(2000) * 0.6, len(hours)), 'GEOHASH': 'sxk9',
+            'MINIMUM_SPEED': 5, 'MAXIMUM_SPEED': 120, 'AVERAGE_SPEED': rng.integers(10, 90, n),
+            'NUMBER_OF_VEHICLES': rng.integers(1, 300, n)})))
+
+        # public transport, 50 lines with 20 rows (stations, transfer & product kinds) per hour
+        n = len(hours) * 1000
+        files['pth'].append(('hourly_transport_{0}.csv'.format(m), pd.DataFrame({
+            'DATE_TIME': np.repeat(hours, 1000), 'TRANSPORT_TYPE_ID': 1, 'ROAD_TYPE': 'OTOYOL',
+            'TRANSPORT_TYPE_DESC': np.tile(np.repeat(['KARAYOLU'] * 40 + ['DENİZ'] * 9 + ['RAY'], 20), len(hours)),
+            'LINE': np.tile(np.repeat(['L{0}'.format(i) for i in range(49)] + ['MARMARAY'], 20), len(hours)),
+            'TRANSFER_TYPE': rng.choice(['AKTARMA', 'NORMAL'], n), 'NUMBER_OF_PASSAGE': rng.integers(1, 500, n),
+            'NUMBER_OF_PASSENGER': rng.integers(1, 400, n)})))
+
+    for dat_name, parts in files.items():
+        snapshot = os.path.join(directory, dat_name)
+        os.makedirs(snapshot)
+        config.datasets[dat_name]['snapshot'] = snapshot
+        config.datasets[dat_name]['url'] = []
+        for name, part in parts:
+            url = 'https://data.ibb.gov.tr/download/' + name
+            part.to_csv(os.path.join(snapshot, name), index=False)
+            utils.saving_fetch_time(os.path.join(snapshot, name), url)
+            config.datasets[dat_name]['url'].append(url)
+
+
+def drawing_first_chart(dat_name, data):
+    """
+    :param dat_name: string
+    :param data: data of the snapshot or of the preview of the data set
+    :return: Plotly Graph; the first chart of the page
+    """
+    if dat_name == 'tdh':
+        return traffic_density_hourly.creating_heatmap_graph(df=None, year=config.tdh_years[0],
+                                                             month=config.tdh_months[0], tensor=data['tensor'])
+    df = data['df'] if isinstance(data, dict) else data
+    return public_transport_hourly.creating_line_graph_based_day(
+        public_transport_hourly.creating_day_avg_data(public_transport_hourly.data_generator(
+            data=df, year=config.pth_years[0], month=config.pth_months[0])),
+        public_transport_hourly.creating_day_avg_data(public_transport_hourly.data_generator(
+            data=df, year=config.pth_years[-1], month=config.pth_months[0])),
+        col='avg_' + config.pth_cols[0], m=config.months[config.pth_months[0]],
+        years=(config.pth_years[0], config.pth_years[-1]))
+
+
+def main():
+    """
+    :return: None
+    """
+    directory = tempfile.mkdtemp()
+    config.tdh_heatmap_tensor_path = os.path.join(directory, 'tdh_heatmap_tensor.npz')
+    creating_partitions(directory)
+    config.preview_fraction = 0.05 if config.preview_fraction is None else config.preview_fraction
+
+    print('{0:<8}{1:>12}{2:>12}{3:>8}'.format('data', 'exact s', 'preview s', 'ratio'))
+    for dat_name in ['tdh', 'pth']:
+        seconds = []
+        for build in [data_layer.loaders[dat_name], data_layer.previewers[dat_name]]:
+            if os.path.exists(config.tdh_heatmap_tensor_path):
+                os.remove(config.tdh_heatmap_tensor_path)
+            utils.forgetting_dataset(dat_name)
+            start = time.perf_counter()
+            drawing_first_chart(dat_name, build())
+            seconds.append(time.perf_counter() - start)
+        print('{0:<8}{1:>12.2f}{2:>12.2f}{3:>8.1f}'.format(dat_name, seconds[0], seconds[1], seconds[0] / seconds[1]))
+
+
+if __name__ == "__main__":
+    main()
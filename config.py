@@ -26,9 +26,93 @@ traffic_density_data_url_list = [
 wifi_new_user_data_url = 'https://data.ibb.gov.tr/en/dataset/015e8185-d59c-47c1-a4cf-8d7fc709ef44/resource/12f5bc23-224a-43cb-b60d-3f36f83ffd33/download/ibb_wifi_subscriber.csv'
 traffic_announcements_url = 'https://data.ibb.gov.tr/en/dataset/8d47d214-eca8-494d-9457-d134dde561ff/resource/1c043914-8a76-4793-bae9-c60a68c7d389/download/traffic_announcement.csv'
 
+# dataset catalog; source URL (a list for the monthly partitioned data sets), local snapshot (downloaded copy, not
+# tracked by git; a directory of the partition files for the partitioned data sets), bundled copy of the repository
+# that is read when the portal and the snapshot are not available, column names in the order of the raw file (_id is
+# dropped, None keeps the lowercased raw names) and the timestamp columns
+datasets = {
+    'dor': {'url': dam_occ_rates_data_url, 'snapshot': 'data/snapshots/dam_occupancy_rates.csv', 'bundled': None,
+            'columns': ['date', 'occupancy_rate', 'reserved_water'], 'date_cols': ['date'], 'date_length': None,
+            'partitioned': False},
+    'wnu': {'url': wifi_new_user_data_url, 'snapshot': 'data/snapshots/ibb_wifi_new_user_data.csv',
+            'bundled': 'data/ibb_wifi_new_user_data.csv',
+            'columns': ['subscription_date', 'subscription_county', 'subscription_type', 'lon', 'lat',
+                        'number_of_subscription'], 'date_cols': ['subscription_date'], 'date_length': None,
+            'partitioned': False},
+    'tai': {'url': traffic_announcements_url, 'snapshot': 'data/snapshots/traffic_announcements.csv', 'bundled': None,
+            'columns': None, 'date_cols': ['announcement_starting_datetime', 'announcement_ending_datetime'],
+            'date_length': 19, 'partitioned': False},
+    'pth': {'url': public_transport_data_url_list, 'snapshot': 'data/snapshots/pth', 'bundled': None, 'columns': None,
+            'date_cols': ['date_time'], 'date_length': None, 'partitioned': True},
+    'tdh': {'url': traffic_density_data_url_list, 'snapshot': 'data/snapshots/tdh', 'bundled': None, 'columns': None,
+            'date_cols': ['date_time'], 'date_length': None, 'partitioned': True},
+}
+# a snapshot fetched earlier than this is downloaded again (the fetch time is kept in <snapshot>.json),
+# None: the snapshot is always used if it exists
+snapshot_max_age_hours = 24
+
 # some variables that are easily changeable
+# point budget of a line trace, longer series are downsampled with LTTB (None disables it)
+max_points = 2000
+# figure payloads; numeric arrays are sent as typed arrays, float64 values are downcast to float32 only when the
+# relative round trip error stays within the tolerance (float32 epsilon is ~6e-8, so 0.0 keeps the downcast lossless)
+figure_float32_tolerance = 0.0
+figure_min_array_size = 16  # shorter arrays are left as JSON lists
+# rendering of scatter & line traces; svg, webgl or auto (webgl when a figure crosses one of the thresholds)
+render_mode = 'auto'
+webgl_point_threshold = 10000  # total number of points in the figure
+webgl_trace_threshold = 20
+# refresh of the daily updated data sets; full: the whole history is downloaded in every run,
+# incremental: only the records after the watermark are fetched and appended to the local store
+refresh_mode = 'full'
+refresh_dir = 'data/refresh'
+refresh_datasets = ['dor', 'wnu', 'tai']
+ckan_datastore_sql_url = 'https://data.ibb.gov.tr/api/3/action/datastore_search_sql'
+ckan_page_size = 32000
+# aggregation backend of each module; pandas, duckdb (optional dependency) or sqlite
+aggregation_backend = {'dor': 'pandas', 'wnu': 'pandas', 'tai': 'pandas', 'tdh': 'pandas', 'pth': 'pandas'}
+sql_database_dir = 'data/sql'
+sql_threads = None  # DuckDB uses all cores if it is None
+# local JSON service of the aggregates
+service_host = '127.0.0.1'
+service_port = 8502
+service_cache_size = 1024  # responses kept in the LRU cache
+# responses computed after every refresh of their data set, (endpoint, query) pairs
+service_warm_queries = [('/traffic/heatmap', {'year': '2020', 'month': 'January'}),
+                        ('/traffic/heatmap', {'year': '2021', 'month': 'January'}),
+                        ('/dam/buckets', {}), ('/wifi/buckets', {}), ('/wifi/subscriptions', {}),
+                        ('/announcements/monthly-counts', {}), ('/announcements/duration-quantiles', {})]
+# background warm-up of the shared data layer; the data sets are rebuilt at startup and then every interval,
+# the dashboard's default page first, pth is loaded at its first use
+warmer_datasets = ['wnu', 'dor', 'tai', 'tdh']
+warmer_interval_hours = 24
+# concurrent pipelines of orchestrator.py
+orchestrator_max_concurrency = 3  # pipelines running at the same time, also the number of worker processes
+orchestrator_download_timeout = 300  # seconds per file
+# seconds per pipeline, counted from the moment it gets a free slot
+orchestrator_timeouts = {'dor': 600, 'wnu': 600, 'tai': 900, 'tdh': 3600, 'pth': 3600}
+orchestrator_output_dir = 'data/figures'
+# memory budget in MB, None: no budget. With a budget, the partitioned data sets are loaded one partition at a time,
+# their unused columns are not parsed, the numbers are downcast, the repetitive strings are categorized, the memory
+# of every stage is logged and traffic density switches to the out_of_core mode if its estimate is over the budget;
+# the numbers of the other data sets are downcast when they are loaded
+memory_budget_mb = None
+memory_category_ratio = 0.5  # strings with fewer distinct values than this share of the rows become categorical
+memory_sample_rows = 100000  # rows of the first partition that the estimate of the whole data set is based on
+# fast preview of the traffic density & public transport pages, None: off. Until the exact data set is published,
+# the pages are drawn from a stratified sample of this share of the rows, with confidence intervals, and the exact
+# data set is built in the background
+preview_fraction = None
+preview_strata = {'tdh': ['date_time'], 'pth': ['date_time', 'line']}  # one stratum per hour (and line)
+preview_min_rows = 2  # rows sampled per stratum at least, all of them in the smaller strata
+preview_chunk_size = 200000  # rows read at a time, each chunk is sampled as soon as it is read
+preview_confidence = 0.95
+preview_poll_seconds = 5  # a preview page checks this often whether the exact data set is published
+# time buckets of the daily series; granularity -> pandas period alias
+time_granularity = {'daily': 'D', 'weekly': 'W', 'monthly': 'M', 'quarterly': 'Q', 'yearly': 'Y'}
 # wifi new user & dam occupancy rates
 wnu_county_list_ = ['BAKIRKÖY', 'EYÜP SULTAN', 'FATİH', 'KADIKÖY', 'KARTAL', 'MALTEPE']
+wnu_h3_resolution = 8  # H3 cells of the subscription cube & the hexagon map
 date_type = ['daily', 'monthly']
 dor_cols = ['occupancy_rate', 'reserved_water']
 dor_months = ['October', 'December', 'July']
@@ -37,6 +121,8 @@ pth_cols = ['number_of_passenger', 'number_of_passage']
 pth_months = ['January', 'February']
 pth_years = [2020, 2021]
 pth_types = ['Highway', 'Rail', 'Sea']
+pth_keep_cols = ['date_time', 'transport_type_desc', 'transfer_type', 'line', 'number_of_passenger',
+                 'number_of_passage']  # used by the dashboards
 pth_lines = ['AKSARAY-HAVALİMANI', 'KABATAŞ-BAĞCILAR', 'MARMARAY', 'TAKSİM-4.LEVENT']
 pth_lines_single = ['METROBÜS']  # please write the single line
 pth_days = ['Monday', 'Tuesday']
@@ -46,10 +132,20 @@ months = {'January': 1, 'February': 2, 'March': 3, 'April': 4, 'May': 5, 'June':
           'July': 7, 'August': 8, 'September': 9, 'October': 10, 'November': 11, 'December': 12}
 # traffic density hourly
 days = ['Sunday', 'Saturday', 'Friday', 'Thursday', 'Wednesday', 'Tuesday', 'Monday']
+weekdays = days[::-1]  # pandas dayofweek order, Monday=0
 tdh_years = [2020, 2021]
 tdh_months = ['January', 'February']
 tdh_evening_rush_hours = [18, 19, 20]
 tdh_morning_rush_hours = [6, 7, 8, 9]
+# precomputed [year, month, weekday, hour] heatmap tensor
+tdh_heatmap_tensor_path = 'data/tdh_heatmap_tensor.npz'
+# in_memory: all months are loaded into one dataframe, out_of_core: the months are processed one partition at a time
+tdh_execution_mode = 'in_memory'
+tdh_chunk_size = 1000000  # rows per partition in the out_of_core mode
+tdh_keep_cols = ['date_time', 'latitude', 'longitude', 'number_of_vehicles']  # used by the dashboards
+# memory mapped location x hour arrays of number of vehicles & average speed
+tdh_store_dir = 'data/tdh_store'
+tdh_grid_cell_size = 0.01  # degree, cell size of the spatial index over the measurement locations
 # traffic announcements
 announcement_type_desc = {'Kaza Bildirimi': 'Accident Notification',
                           'Araç Arızası': 'Vehicle Breakdown',
@@ -68,3 +164,7 @@ atd_list = ['Accident Notification', 'Intense Traffic', 'Vehicle Breakdown', 'Ma
             'Landscaping', 'Road Closing to Traffic', 'Vehicle Fire']
 atd_list_ = ['Accident Notification', 'Intense Traffic', 'Vehicle Breakdown']
 tai_years = [2019]
+# duration quantile sketches of the announcements
+tai_sketch_relative_accuracy = 0.01
+tai_sketch_quantiles = [0.5, 0.9, 0.99]
+tai_sketch_path = 'data/tai_duration_sketches.json'
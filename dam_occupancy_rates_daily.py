@@ -2,14 +2,15 @@
 # -*- coding: utf-8 -*-
 
 import config
-import datapane as dp
+import figure_encoding
+import lazy_imports
 import logging
-import pandas as pd
-import plotly.express as px
+import numpy as np
 import plotly.graph_objs as go
-import streamlit as st
 import utils
 
+px = lazy_imports.importing_lazily('plotly.express')
+
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger('IMM Data Visualization - Dam Occupancy Rates')
 
@@ -18,54 +19,62 @@ def data_preparation():
     """
     :rtype: dataframe
     """
-    # getting data
-    data = utils.getting_raw_data(dat_name='dor')
-    data.columns = ['date', 'occupancy_rate', 'reserved_water']
+    # getting data, one parsed copy is shared in the process
+    return preparing_data(utils.loading_dataset('dor'))
 
-    # Changing data type for date column, str -> timestamp
-    data['date'] = pd.to_datetime(data['date'])
 
-    return data
+def preparing_data(data):
+    """
+    :param data: dataframe; raw records or the output of utils.loading_dataset
+    :rtype: dataframe
+    """
+    # column names & str -> timestamp for date column, as declared in the dataset catalog
+    return utils.applying_schema(data, 'dor')
 
 
-def creating_line_graph_based_date(df, date_type, col):
+def getting_time_buckets(df):
+    """
+    :param df: dataframe; output of data_preparation
+    :rtype: dict; in the incremental refresh mode, only the appended records are added to the saved buckets
+    """
+    if config.refresh_mode == 'incremental':
+        return utils.refreshing_time_buckets('dor', preparing_data, 'date', config.dor_cols)
+    return utils.creating_time_buckets(df, 'date', config.dor_cols, backend=config.aggregation_backend['dor'],
+                                       table='dam_occupancy_rates')
+
+
+def creating_line_graph_based_date(df, date_type, col, x_range=None, buckets=None):
     """
     :param df: dataframe
-    :param date_type:
-    :param col:
+    :param date_type: string; daily, weekly, monthly, quarterly or yearly
+    :param col: string
+    :param x_range: tuple; (start date, end date), the zoomed range is shown in full resolution within the budget
+    :param buckets: dict; output of utils.creating_time_buckets, shared by the graphs of all granularities
     :return: Plotly Line Graph
     """
-    if date_type == 'daily':
-        if col == 'occupancy_rate':
-            title_ = 'Daily General Dam Occupancy Rate'
-            yxs = 'Occupancy Rate'
-            nm = 'Dam Occupancy Rate'
-        else:
-            title_ = 'Daily General Dam Reserved Water'
-            yxs = 'Reserved Water'
-            nm = 'Dam Reserved Water'
-        mode_ = 'lines'
-
+    if col == 'occupancy_rate':
+        title_ = '{0} General Dam Occupancy Rate'.format(date_type.title())
+        yxs = 'Occupancy Rate' if date_type == 'daily' else 'Average Occupancy Rate'
+        nm = 'Dam Occupancy Rate'
+        agg = 'mean'
     else:
-        if col == 'occupancy_rate':
-            title_ = 'Monthly General Dam Occupancy Rate'
-            yxs = 'Average Occupancy Rate'
-            nm = 'Dam Occupancy Rate'
-        else:
-            title_ = 'Monthly General Dam Reserved Water'
-            yxs = 'Total Reserved Water'
-            nm = 'Dam Reserved Water'
-        df['date'] = df['date'].dt.strftime('%Y-%m')
-        mode_ = 'lines+markers'
+        title_ = '{0} General Dam Reserved Water'.format(date_type.title())
+        yxs = 'Reserved Water' if date_type == 'daily' else 'Total Reserved Water'
+        nm = 'Dam Reserved Water'
+        agg = 'sum'
+    mode_ = 'lines' if date_type == 'daily' else 'lines+markers'
 
+    buckets = utils.creating_time_buckets(df, 'date', [col]) if buckets is None else buckets
+    df_grouped = utils.getting_time_buckets(buckets, granularity=date_type, aggs=[agg])[(col, agg)]
     if col == 'occupancy_rate':
-        df_grouped = df[['date', col]].groupby('date').mean().reset_index()
-        df_grouped[col] = round(df_grouped[col], 2)
-    else:
-        df_grouped = df[['date', col]].groupby('date').sum().reset_index()
+        df_grouped = round(df_grouped, 2)
+
+    # long series are downsampled to the point budget
+    x_, y_ = utils.downsampling_series(df_grouped.index, df_grouped.values, x_range=x_range)
 
-    fig = go.Figure(data=go.Scatter(x=df_grouped['date'], y=df_grouped[col], showlegend=True, name=nm, mode=mode_,
-                                    marker={'color': ["red"] * len(df_grouped)}))
+    scatter = figure_encoding.choosing_scatter_type(len(x_))
+    fig = go.Figure(data=scatter(x=x_, y=y_, showlegend=True, name=nm, mode=mode_,
+                                 marker={'color': ["red"] * len(x_)}))
     fig.update_layout(
         title=title_,
         xaxis_title='Date',
@@ -81,28 +90,22 @@ def creating_line_graph_based_date(df, date_type, col):
     return fig
 
 
-def classify(e):
+def creating_colorful_line_data(df_, label):
     """
-    :param e: float
-    :rtype: string
+    Points of one class as a single trace; the runs of the class are separated by NaN gaps and
+    the single point runs are shown as markers.
+    :param df_: dataframe; time, value, label, group and run_size columns
+    :param label: string; high, medium or low
+    :rtype: tuple of numpy arrays; x, y and marker sizes
     """
-    if e > 0.75:
-        return 'high'
-    if e > 0.25:
-        return 'medium'
-    if e >= 0:
-        return 'low'
+    data = df_[df_['label'] == label]
+    x = data['time'].values
+    y = data['value'].values.astype(np.float64)
+    size = np.where(data['run_size'].values == 1, 6, 0)
 
-
-def modes(df):
-    """
-    :param df: dataframe
-    :rtype: string
-    """
-    if len(df) > 1:
-        return 'lines'
-    else:
-        return 'markers'
+    # positions where a new run of the class starts
+    breaks = np.flatnonzero(np.diff(data['group'].values) != 0) + 1
+    return np.insert(x, breaks, x[breaks]), np.insert(y, breaks, np.nan), np.insert(size, breaks, 0)
 
 
 def creating_colorful_line_graph_based_date(df, col):
@@ -116,14 +119,11 @@ def creating_colorful_line_graph_based_date(df, col):
     df_fig = df_.copy().set_index('time')
 
     # creating figure data
-    df_['label_'] = [(elem - df_['value'].min()) / (df_['value'].max() - df_['value'].min()) for elem in df_['value']]
-    df_['label'] = [classify(elem) for elem in df_['label_']]
-    df_ = df_.drop('label_', 1)
+    value = df_['value'].values.astype(np.float64)
+    label_ = (value - np.nanmin(value)) / (np.nanmax(value) - np.nanmin(value))
+    df_['label'] = np.select([label_ > 0.75, label_ > 0.25, label_ >= 0], ['high', 'medium', 'low'], default='')
     df_['group'] = df_['label'].ne(df_['label'].shift()).cumsum()
-    df_ = df_.groupby('group')
-    dfs = []
-    for name, data in df_:
-        dfs.append(data)
+    df_['run_size'] = df_['group'].map(df_['group'].value_counts())
 
     if col == 'occupancy_rate':
         title_ = 'Daily General Dam Occupancy Rate'
@@ -134,21 +134,16 @@ def creating_colorful_line_graph_based_date(df, col):
         yxs = 'Reserved Water'
         nm = 'Dam Reserved Water'
 
-    # vis
-    fig = go.Figure((go.Scatter(x=df_fig.index, y=df_fig['value'], name=nm, line=dict(color='rgba(200,200,200,0.7)'))))
+    # vis; the grey line and the class traces together have about twice the points of the series
+    scatter = figure_encoding.choosing_scatter_type(2 * len(df_), n_traces=4)
+    fig = go.Figure((scatter(x=df_fig.index, y=df_fig['value'], name=nm, line=dict(color='rgba(200,200,200,0.7)'))))
     cols = {'high': 'green', 'medium': 'blue', 'low': 'red'}
 
-    showed = []
-    for frame in dfs:
-        if frame['label'].iloc[0] not in showed:
-            fig.add_trace(go.Scatter(x=frame['time'], y=frame['value'], mode=modes(frame),
-                                     marker_color=cols[frame['label'].iloc[0]], legendgroup=frame['label'].iloc[0],
-                                     name=frame['label'].iloc[0]))
-            showed.append(frame['label'].iloc[0])
-        else:
-            fig.add_trace(go.Scatter(x=frame['time'], y=frame['value'], mode=modes(frame),
-                                     marker_color=cols[frame['label'].iloc[0]], legendgroup=frame['label'].iloc[0],
-                                     name=frame['label'].iloc[0], showlegend=False))
+    # one trace per class, in the order of their first appearance
+    for label in [lbl for lbl in df_['label'].unique() if lbl in cols]:
+        x, y, size = creating_colorful_line_data(df_, label)
+        fig.add_trace(scatter(x=x, y=y, mode='lines+markers', marker=dict(size=size), marker_color=cols[label],
+                              legendgroup=label, name=label))
 
     fig.update_layout(
         template='plotly_dark',
@@ -225,12 +220,13 @@ def main():
     :return: Plotly Figure
     """
     df = data_preparation()
+    buckets = getting_time_buckets(df)
 
     # The localhost page is opened on the Internet browser.
     # Each plot is presented in a separate browser tab.
     for dt in config.date_type:
         for col in config.dor_cols:
-            creating_line_graph_based_date(df=df.copy(), date_type=dt, col=col)
+            creating_line_graph_based_date(df=df, date_type=dt, col=col, buckets=buckets)
 
     for c in config.dor_cols:
         creating_colorful_line_graph_based_date(df=df.copy(), col=c)
@@ -240,31 +236,43 @@ def main():
     creating_bar_graph_for_occupancy(df=df.copy())
 
 
-def putting_into_streamlit():
+def putting_into_streamlit(df=None, buckets=None):
     """
+    :param df: dataframe; output of data_preparation, loaded here if it is None
+    :param buckets: dict; output of getting_time_buckets
     :return: None
     """
-    df = data_preparation()
+    import streamlit as st
+
+    df = data_preparation() if df is None else df
+    buckets = getting_time_buckets(df) if buckets is None else buckets
     st.markdown("## **:ocean: Istanbul Dam Occupancy Rates Visualization**")
 
+    # the selected range is drawn in full resolution as long as it fits into the point budget
+    first, last = buckets['partials'].index.min().date(), buckets['partials'].index.max().date()
+    x_range = st.slider('Date range', min_value=first, max_value=last, value=(first, last), format='YYYY-MM-DD')
+    x_range = None if x_range == (first, last) else x_range
     for dt in config.date_type:
         for col in config.dor_cols:
-            st.write(creating_line_graph_based_date(df=df.copy(), date_type=dt, col=col))
+            fig = creating_line_graph_based_date(df=df, date_type=dt, col=col, x_range=x_range, buckets=buckets)
+            figure_encoding.writing_to_streamlit(fig)
 
     # if it will be run this code block, please use the dark theme in streamlit
     # for c in config.dor_cols:
-    #     st.write(creating_colorful_line_graph_based_date(df=df.copy(), col=c))
+    #     figure_encoding.writing_to_streamlit(creating_colorful_line_graph_based_date(df=df.copy(), col=c))
 
     for m in config.dor_months:
-        st.write(creating_bar_graph_for_occupancy(df=df.copy(), month=m))
+        figure_encoding.writing_to_streamlit(creating_bar_graph_for_occupancy(df=df.copy(), month=m))
 
-    st.write(creating_bar_graph_for_occupancy(df=df.copy()))
+    figure_encoding.writing_to_streamlit(creating_bar_graph_for_occupancy(df=df.copy()))
 
 
 def putting_into_datapane():
     """
     :return: None
     """
+    import datapane as dp
+
     # getting token
     dp.login(config.dp_token)
 
@@ -276,7 +284,7 @@ def putting_into_datapane():
     dp.Report(dp.Plot(p1)).publish(name='Daily General Dam Occupancy Rate', open=True)
 
     # line graph
-    p2 = creating_line_graph_based_date(df=df.copy(), date_type='monthly', col='reserved_water')
+    p2 = creating_line_graph_based_date(df=df, date_type='monthly', col='reserved_water')
     dp.Report(dp.Plot(p2)).publish(name='Monthly General Dam Reserved Water', open=True)
 
     # bar graphs - single month & year based
@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import config
+import dam_occupancy_rates_daily
+import data_layer
+import hourly_fact_table
+import logging
+import public_transport_hourly
+import streamlit as st
+import traffic_announcements_instant
+import traffic_density_hourly
+import wifi_new_user_daily
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger('IMM Data Visualization - Dashboard')
+
+# All dashboards as the pages of one Streamlit app; e.g.
+# streamlit run dashboard.py
+# The script is re-run at every interaction of every session, while the imported modules are not, so the data of
+# a page is prepared once by the shared data layer and reused by the later runs & the other sessions.
+
+
+@st.fragment(run_every=config.preview_poll_seconds)
+def waiting_exact(dat_name):
+    """
+    Re-runs the page once the exact data set replaces its preview.
+    :param dat_name: string
+    :return: None
+    """
+    if dat_name in data_layer.state:
+        st.rerun()
+
+
+def noting_preview(dat_name):
+    """
+    :param dat_name: string
+    :return: None
+    """
+    st.info('Preview: the charts are estimated from a {0:.0%} stratified sample of the rows, the hover texts, the '
+            'error bars and the tables give the {1:.0%} confidence intervals; only the charts that have them are '
+            'drawn. The exact charts replace them when they are ready.'
+            .format(config.preview_fraction, config.preview_confidence))
+    waiting_exact(dat_name)
+
+
+def showing_wifi():
+    """
+    :return: None
+    """
+    with st.spinner('Loading the wifi new user data...'):
+        data = data_layer.getting_state('wnu')
+    wifi_new_user_daily.putting_into_streamlit(cube=data['cube'], buckets=data['buckets'])
+
+
+def showing_dam():
+    """
+    :return: None
+    """
+    with st.spinner('Loading the dam occupancy rates...'):
+        data = data_layer.getting_state('dor')
+    dam_occupancy_rates_daily.putting_into_streamlit(df=data['df'], buckets=data['buckets'])
+
+
+def showing_announcements():
+    """
+    :return: None
+    """
+    with st.spinner('Loading the traffic announcements...'):
+        data = data_layer.getting_state('tai')
+    traffic_announcements_instant.putting_into_streamlit(df=data['df'], durations=data['durations'],
+                                                         sketches=data['sketches'])
+
+
+def showing_traffic():
+    """
+    :return: None
+    """
+    with st.spinner('Loading the traffic density data...'):
+        data, is_preview = data_layer.getting_preview_or_state('tdh')
+    if is_preview is True:
+        noting_preview('tdh')
+    traffic_density_hourly.putting_into_streamlit(tensor=data['tensor'], density=data['density'])
+
+
+def showing_transport():
+    """
+    :return: None
+    """
+    with st.spinner('Loading the public transport data...'):
+        data, is_preview = data_layer.getting_preview_or_state('pth')
+    if is_preview is True:
+        noting_preview('pth')
+        public_transport_hourly.putting_into_streamlit(df=data['df'], margins=data['margins'])
+    else:
+        public_transport_hourly.putting_into_streamlit(df=data)
+
+
+def showing_incidents():
+    """
+    :return: None
+    """
+    with st.spinner('Joining the announcements, traffic density & public transport data by hour...'):
+        fact = data_layer.getting_state('fact')
+    hourly_fact_table.putting_into_streamlit(fact=fact)
+
+
+def main():
+    """
+    :return: None
+    """
+    st.set_page_config(page_title='IMM Data Visualization', layout='wide')
+    # the data sets are built & refreshed in the background, a page waits only if its first build is not over
+    data_layer.starting_warmer()
+    page = st.navigation([
+        st.Page(showing_wifi, title='WiFi New Users', icon=':material/wifi:', url_path='wifi', default=True),
+        st.Page(showing_dam, title='Dam Occupancy Rates', icon=':material/water_drop:', url_path='dam'),
+        st.Page(showing_announcements, title='Traffic Announcements', icon=':material/campaign:',
+                url_path='announcements'),
+        st.Page(showing_traffic, title='Traffic Density', icon=':material/traffic:', url_path='traffic'),
+        st.Page(showing_transport, title='Public Transport', icon=':material/directions_bus:', url_path='transport'),
+        st.Page(showing_incidents, title='Incidents by Hour', icon=':material/link:', url_path='incidents'),
+    ])
+    page.run()
+
+
+if __name__ == "__main__":
+    main()
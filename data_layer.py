@@ -0,0 +1,275 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import config
+import dam_occupancy_rates_daily
+import hourly_fact_table
+import logging
+import pandas as pd
+import public_transport_hourly
+import threading
+import time
+import traffic_announcements_instant
+import traffic_announcements_sketches
+import traffic_density_hourly
+import traffic_density_spatial
+import utils
+import wifi_new_user_daily
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger('IMM Data Visualization - Data Layer')
+
+# Prepared data & aggregates of every data set, shared by the dashboard pages, the sessions and the JSON service
+# of the same process. A data set is loaded at its first use, or beforehand by the warmer; the objects are shared,
+# so they must not be mutated by the callers (pass a copy to the functions that add columns).
+# Each data set is published as a versioned snapshot; a refresh builds the next version aside and replaces the
+# published one with a single assignment, so the readers get either the old or the new snapshot, never a mix,
+# and they do not wait for the refresh.
+# With config.preview_fraction, the large data sets are first served as previews, built from a stratified sample,
+# while their exact snapshots are built in the background; a preview is dropped once the exact snapshot is out.
+
+
+def loading_transport():
+    """
+    :rtype: dataframe
+    """
+    return public_transport_hourly.data_preparation()
+
+
+def loading_traffic():
+    """
+    :rtype: dict; heatmap tensor, density map data & the spatial indexes of its locations by year & month
+    """
+    tensor, density, heatmap_data = traffic_density_hourly.preparing_aggregates(with_heatmap_data=True)
+    # the locations measured in every month, with their averages, for the nearby location queries
+    spatial = {k: traffic_density_spatial.creating_spatial_index(d[['latitude', 'longitude', 'count', 'mean']])
+               for k, d in density.groupby(['year', 'month'], observed=True)}
+    return {'tensor': tensor, 'density': density, 'heatmap_data': heatmap_data, 'spatial_index': spatial}
+
+
+def loading_fact(tai, tdh, pth):
+    """
+    :param tai: dict; data of the announcements snapshot
+    :param tdh: dict; data of the traffic density snapshot
+    :param pth: dataframe; data of the public transport snapshot
+    :rtype: dataframe; hourly fact table
+    """
+    return hourly_fact_table.creating_hourly_fact_table(tai['df'], tdh['heatmap_data'], pth,
+                                                        lines=config.pth_lines_single)
+
+
+def loading_dam():
+    """
+    :rtype: dict; prepared data & time buckets
+    """
+    df = dam_occupancy_rates_daily.data_preparation()
+    return {'df': df, 'buckets': dam_occupancy_rates_daily.getting_time_buckets(df)}
+
+
+def loading_wifi():
+    """
+    :rtype: dict; subscription cube & time buckets
+    """
+    cube = wifi_new_user_daily.creating_subscription_cube(wifi_new_user_daily.data_preparation())
+    return {'cube': cube, 'buckets': wifi_new_user_daily.getting_time_buckets(cube)}
+
+
+def loading_announcements():
+    """
+    :rtype: dict; prepared data, durations, monthly counts by type & duration sketches
+    """
+    df = traffic_announcements_instant.data_preparation()
+    data_ = traffic_announcements_instant.creating_scatter_graph_data(df.copy())
+    data_['diff_min'] = round(data_['diff_sec'] / 60, 2)
+    data_['diff_hhh'] = round(data_['diff_min'] / 60, 2)
+    return {'df': df, 'durations': data_,
+            'monthly_counts': traffic_announcements_instant.creating_monthly_type_counts(df),
+            'sketches': traffic_announcements_sketches.getting_duration_sketches(data_)}
+
+
+def loading_transport_preview():
+    """
+    :rtype: dict; weighted sample & estimated monthly sums with their confidence intervals
+    """
+    df, margins = public_transport_hourly.preparing_preview()
+    return {'df': df, 'margins': margins}
+
+
+def loading_traffic_preview():
+    """
+    :rtype: dict; estimated heatmap tensor & density map data
+    """
+    tensor, density = traffic_density_hourly.preparing_preview()
+    return {'tensor': tensor, 'density': density}
+
+
+loaders = {'pth': loading_transport, 'tdh': loading_traffic, 'dor': loading_dam, 'wnu': loading_wifi,
+           'tai': loading_announcements, 'fact': loading_fact}
+# data sets built from the snapshots of other data sets, their loaders get the data of those snapshots; they are
+# built again at their next use once one of those is published again
+dependencies = {'fact': ['tai', 'tdh', 'pth']}
+state = {}
+state_locks = {k: threading.Lock() for k in loaders}
+warmer = {'thread': None, 'stop': threading.Event()}
+warmer_lock = threading.Lock()
+previewers = {'pth': loading_transport_preview, 'tdh': loading_traffic_preview}
+previews = {}
+preview_locks = {k: threading.Lock() for k in previewers}
+builders = {}
+builders_lock = threading.Lock()
+
+
+def publishing_state(dat_name):
+    """
+    Builds the next snapshot of the data set and swaps it in; the caller holds the lock of the data set.
+    :param dat_name: string
+    :rtype: dict; version, creation time & data of the snapshot
+    """
+    previous = state.get(dat_name)
+    utils.forgetting_dataset(dat_name)  # re-read the source instead of the parsed copy of the last build
+    inputs = {d: getting_snapshot(d) for d in dependencies.get(dat_name, [])}
+    snapshot = {'version': 1 if previous is None else previous['version'] + 1, 'created': pd.Timestamp.now(),
+                'inputs': {d: v['version'] for d, v in inputs.items()},
+                'data': loaders[dat_name](**{d: v['data'] for d, v in inputs.items()})}
+    state[dat_name] = snapshot
+    logger.info('Version {0} of {1} is published.'.format(snapshot['version'], dat_name))
+    return snapshot
+
+
+def getting_snapshot(dat_name):
+    """
+    :param dat_name: string
+    :rtype: dict; the published snapshot, built by one thread while the others wait for it if there is none yet
+    """
+    if checking_stale(dat_name):
+        with state_locks[dat_name]:
+            if checking_stale(dat_name):
+                publishing_state(dat_name)
+    return state[dat_name]
+
+
+def checking_stale(dat_name):
+    """
+    :param dat_name: string
+    :rtype: bool; True if the data set is not published or one of the snapshots it is built from was replaced
+    """
+    snapshot = state.get(dat_name)
+    return snapshot is None or any(state[d]['version'] != v for d, v in snapshot['inputs'].items())
+
+
+def getting_state(dat_name):
+    """
+    :param dat_name: string
+    :return: data & aggregates of the data set
+    """
+    return getting_snapshot(dat_name)['data']
+
+
+def building_exact(dat_name):
+    """
+    :param dat_name: string
+    :return: None
+    """
+    try:
+        getting_snapshot(dat_name)
+    except Exception:
+        # the preview stays in use, the next page run starts the build again
+        logger.exception('Exact build of {0} failed.'.format(dat_name))
+    else:
+        previews.pop(dat_name, None)
+
+
+def starting_exact_build(dat_name):
+    """
+    Starts the build of the exact snapshot in a daemon thread, unless it is running; the build waits for the
+    warmer if the warmer is building the same data set.
+    :param dat_name: string
+    :rtype: threading.Thread
+    """
+    with builders_lock:
+        if dat_name not in builders or not builders[dat_name].is_alive():
+            builders[dat_name] = threading.Thread(target=building_exact, args=(dat_name,),
+                                                  name='data-layer-exact-' + dat_name, daemon=True)
+            builders[dat_name].start()
+        return builders[dat_name]
+
+
+def getting_preview_or_state(dat_name):
+    """
+    :param dat_name: string
+    :rtype: tuple; data of the exact snapshot & False if it is published (or there is no preview for the data set),
+            otherwise data of the preview & True
+    """
+    if dat_name in state or config.preview_fraction is None or dat_name not in previewers:
+        return getting_state(dat_name), False
+
+    starting_exact_build(dat_name)
+    with preview_locks[dat_name]:
+        if dat_name not in previews and dat_name not in state:
+            start = time.perf_counter()
+            preview = previewers[dat_name]()
+            # the exact snapshot can be published while the preview is built, then the preview is not kept
+            if dat_name not in state:
+                previews[dat_name] = preview
+                logger.info('Preview of {0} is published in {1:.1f} seconds.'.format(dat_name,
+                                                                                   time.perf_counter() - start))
+    preview = previews.get(dat_name)
+    return (getting_state(dat_name), False) if preview is None else (preview, True)
+
+
+def refreshing_state(dat_name):
+    """
+    :param dat_name: string
+    :rtype: dict; the new snapshot, the readers keep getting the previous one until it is ready
+    """
+    with state_locks[dat_name]:
+        return publishing_state(dat_name)
+
+
+def warming(dat_names, interval_hours, after=None):
+    """
+    Refreshes the data sets one after the other, at once and then every interval_hours, until the stop event.
+    :param dat_names: list
+    :param interval_hours: float
+    :param after: function; called with the data set name after each swap, e.g. to warm the dependent caches
+    :return: None
+    """
+    while True:
+        for dat_name in dat_names:
+            if warmer['stop'].is_set():
+                return
+            try:
+                refreshing_state(dat_name)
+                if after is not None:
+                    after(dat_name)
+            except Exception:
+                # the published snapshot stays in use, the next round tries again
+                logger.exception('Refresh of {0} failed.'.format(dat_name))
+        if warmer['stop'].wait(3600 * interval_hours):
+            return
+
+
+def starting_warmer(dat_names=None, interval_hours=None, after=None):
+    """
+    Starts the warmer in a daemon thread, once per process.
+    :param dat_names: list; config.warmer_datasets if it is None
+    :param interval_hours: float; config.warmer_interval_hours if it is None
+    :param after: function
+    :rtype: threading.Thread
+    """
+    with warmer_lock:
+        if warmer['thread'] is None or not warmer['thread'].is_alive():
+            warmer['stop'].clear()
+            warmer['thread'] = threading.Thread(
+                target=warming, name='data-layer-warmer', daemon=True,
+                args=(config.warmer_datasets if dat_names is None else dat_names,
+                      config.warmer_interval_hours if interval_hours is None else interval_hours, after))
+            warmer['thread'].start()
+        return warmer['thread']
+
+
+def stopping_warmer():
+    """
+    :return: None
+    """
+    warmer['stop'].set()
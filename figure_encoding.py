@@ -0,0 +1,176 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import base64
+import config
+import logging
+import numpy as np
+import plotly.graph_objs as go
+import plotly.io as pio
+import plotly.offline as po
+import time
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger('IMM Data Visualization - Figure Encoding')
+
+# Numeric arrays of the figures are encoded as plotly.js typed arrays, {'dtype': ..., 'bdata': base64, 'shape': ...},
+# instead of JSON lists of float64 numbers. It needs plotly.js 2.28 or later on the rendering side (plotly 5.19 or
+# later, whose bundled plotly.js is also the one include_plotlyjs='cdn' loads); with an older plotly the figures are
+# rendered as they are.
+array_keys = ['x', 'y', 'z', 'lat', 'lon', 'text', 'customdata', 'size', 'color', 'values']
+int_types = [(np.int8, 'i1'), (np.uint8, 'u1'), (np.int16, 'i2'), (np.uint16, 'u2'), (np.int32, 'i4'),
+             (np.uint32, 'u4')]
+
+
+def downcasting_array(arr):
+    """
+    :param arr: numpy array; numeric
+    :rtype: tuple; downcast array and its plotly.js dtype code
+    """
+    finite = arr[np.isfinite(arr)] if arr.dtype.kind == 'f' else arr
+    if arr.dtype.kind in 'iub' or (len(finite) == len(arr) and np.array_equal(finite, np.round(finite))):
+        lo, hi = (finite.min(), finite.max()) if len(finite) else (0, 0)
+        for t, code in int_types:
+            if np.iinfo(t).min <= lo and hi <= np.iinfo(t).max:
+                return arr.astype(t), code
+
+    # float32 is used when every finite value survives the round trip within the tolerance (no overflow/underflow)
+    with np.errstate(over='ignore'):
+        finite32 = finite.astype(np.float32).astype(np.float64)
+    if np.all(np.abs(finite32 - finite) <= config.figure_float32_tolerance * np.abs(finite)):
+        return arr.astype(np.float32), 'f4'
+    return arr.astype(np.float64), 'f8'
+
+
+def encoding_array(value):
+    """
+    :param value: list, tuple or numpy array
+    :rtype: dict or the value itself if it is not a numeric array
+    """
+    if isinstance(value, dict) or isinstance(value, str):
+        return value
+    try:
+        arr = np.asarray(value)
+    except ValueError:  # ragged lists
+        return value
+    if arr.dtype.kind not in 'iufb' or arr.ndim == 0 or arr.ndim > 2 or arr.size < config.figure_min_array_size:
+        return value
+
+    arr, code = downcasting_array(arr)
+    encoded = {'dtype': code, 'bdata': base64.b64encode(np.ascontiguousarray(arr).tobytes()).decode('ascii')}
+    if arr.ndim == 2:
+        encoded['shape'] = '{0},{1}'.format(*arr.shape)
+    return encoded
+
+
+def encoding_object(obj):
+    """
+    :param obj: dict; a trace or one of its nested attributes, e.g. marker
+    :rtype: dict
+    """
+    encoded = {}
+    for k, v in obj.items():
+        if isinstance(v, dict):
+            encoded[k] = encoding_object(v)
+        elif k in array_keys:
+            encoded[k] = encoding_array(v)
+        else:
+            encoded[k] = v
+    return encoded
+
+
+def encoding_figure(fig, strip_template=True):
+    """
+    :param fig: Plotly Figure
+    :param strip_template: bool; the default template is removed, it is repeated in every figure
+    :rtype: dict; data & layout with typed arrays
+    """
+    fig_dict = fig.to_plotly_json()
+    layout = dict(fig_dict.get('layout', {}))
+    if strip_template is True and 'template' in layout:
+        default = pio.templates[pio.templates.default].to_plotly_json()
+        if layout['template'] == default:
+            del layout['template']
+    return {'data': [encoding_object(t) for t in fig_dict.get('data', [])], 'layout': layout}
+
+
+def checking_typed_arrays():
+    """
+    :rtype: bool; True if the plotly.js version of the installed plotly decodes the typed arrays
+    """
+    version = tuple(int(v) for v in po.get_plotlyjs_version().split('.')[:2])
+    return version >= (2, 28)
+
+
+def encoding_figure_json(fig, strip_template=True):
+    """
+    :param fig: Plotly Figure
+    :param strip_template: bool
+    :rtype: string
+    """
+    return pio.to_json(encoding_figure(fig, strip_template=strip_template), validate=False, remove_uids=True)
+
+
+def exporting_figure_html(fig, path, strip_template=True):
+    """
+    :param fig: Plotly Figure
+    :param path: string
+    :return: None
+    """
+    if checking_typed_arrays() is False:
+        fig.write_html(path, include_plotlyjs='cdn', full_html=True)
+        return
+    with open(path, 'w') as f:
+        f.write(pio.to_html(encoding_figure(fig, strip_template=strip_template), validate=False,
+                            include_plotlyjs='cdn', full_html=True))
+
+
+def writing_to_streamlit(fig, strip_template=True):
+    """
+    Streamlit re-validates the figures given to st.plotly_chart, so the compact payload is embedded as a component.
+    The component is an iframe of a fixed height; the Streamlit theme and the container width are not applied to the
+    figure. With a plotly.js that cannot decode the typed arrays, st.plotly_chart is used.
+    :param fig: Plotly Figure
+    :return: None
+    """
+    import streamlit as st
+    import streamlit.components.v1 as components
+
+    if checking_typed_arrays() is False:
+        st.plotly_chart(fig)
+        return
+
+    html = pio.to_html(encoding_figure(fig, strip_template=strip_template), validate=False,
+                       include_plotlyjs='cdn', full_html=False)
+    components.html(html, height=(fig.layout.height or 650) + 20)
+
+
+def choosing_scatter_type(n_points, n_traces=1, mode=None):
+    """
+    Dense figures are drawn with WebGL, SVG gets slow with tens of thousands of points or many traces.
+    :param n_points: int; total number of points of the figure
+    :param n_traces: int
+    :param mode: string; svg, webgl or auto, config.render_mode if it is None
+    :return: go.Scatter or go.Scattergl
+    """
+    mode = config.render_mode if mode is None else mode
+    if mode == 'webgl' or (mode == 'auto' and (n_points > config.webgl_point_threshold or
+                                              n_traces > config.webgl_trace_threshold)):
+        return go.Scattergl
+    return go.Scatter
+
+
+def measuring_payload(fig):
+    """
+    :param fig: Plotly Figure
+    :rtype: dict; payload bytes and serialization seconds of the plain and the compact JSON
+    """
+    t = time.perf_counter()
+    plain = fig.to_json()
+    t_plain = time.perf_counter() - t
+    t = time.perf_counter()
+    compact = encoding_figure_json(fig)
+    t_compact = time.perf_counter() - t
+    return {'plain_bytes': len(plain.encode('utf-8')), 'compact_bytes': len(compact.encode('utf-8')),
+            'plain_sec': t_plain, 'compact_sec': t_compact}
+
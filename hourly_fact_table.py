@@ -0,0 +1,183 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import config
+import figure_encoding
+import logging
+import numpy as np
+import pandas as pd
+import plotly.graph_objs as go
+import public_transport_hourly
+import traffic_announcements_instant
+import traffic_announcements_intervals
+import traffic_density_hourly
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger('IMM Data Visualization - Hourly Fact Table')
+
+# The datasets are joined on an integer hour key (hours since epoch), so every join is a hash join on int64
+# and the cost stays linear in the input size.
+nanoseconds_in_hour = 3600 * 10 ** 9
+
+
+def creating_hour_key(values):
+    """
+    :param values: series or numpy array of timestamps
+    :rtype: numpy array; int64 hours since epoch
+    """
+    return np.asarray(values, dtype='datetime64[ns]').astype('datetime64[h]').astype(np.int64)
+
+
+def creating_hourly_vehicle_counts(heatmap_data):
+    """
+    :param heatmap_data: dataframe; output of traffic_density_hourly.creating_heatmap_data
+    :rtype: dataframe; city-wide number of vehicles by hour key
+    """
+    data = heatmap_data[['date_time', 'number_of_vehicles']]
+    return data.groupby(creating_hour_key(data['date_time']))['number_of_vehicles'].sum() \
+        .rename_axis('hour_key').reset_index()
+
+
+def creating_hourly_passenger_counts(dat, lines=None):
+    """
+    :param dat: dataframe; output of public_transport_hourly.data_preparation
+    :param lines: list; all lines if it is None
+    :rtype: dataframe; number of passengers & passages by hour key
+    """
+    data = dat if lines is None else dat[dat['line'].isin(lines)]
+    return data[['number_of_passenger', 'number_of_passage']] \
+        .groupby(creating_hour_key(data['date_time'])).sum() \
+        .rename_axis('hour_key').reset_index()
+
+
+def creating_hourly_announcement_counts(index, hour_keys, types):
+    """
+    Number of announcements active at some point in each hour, with binary searches over the sorted endpoints.
+    An announcement overlaps [h, h + 1) if it starts before h + 1 and ends after h.
+    :param index: dict; output of traffic_announcements_intervals.creating_interval_index
+    :param hour_keys: numpy array
+    :param types: list
+    :rtype: dataframe
+    """
+    h_start = hour_keys.astype(np.int64) * nanoseconds_in_hour
+    h_end = h_start + nanoseconds_in_hour
+    df = pd.DataFrame({'hour_key': hour_keys})
+    for t in types:
+        e = traffic_announcements_intervals.selecting_endpoints(index, t)
+        col = t.lower().replace(' ', '_')
+        df[col + '_count'] = np.searchsorted(e['starts'], h_end, side='left') - \
+            np.searchsorted(e['ends'], h_start, side='right')
+        df[col + '_active'] = df[col + '_count'] > 0
+    return df
+
+
+def creating_hourly_fact_table(announcements, heatmap_data, transport, lines=None, types=config.atd_list_):
+    """
+    :param announcements: dataframe; output of traffic_announcements_instant.data_preparation
+    :param heatmap_data: dataframe; output of traffic_density_hourly.creating_heatmap_data
+    :param transport: dataframe; output of public_transport_hourly.data_preparation
+    :param lines: list
+    :param types: list
+    :rtype: dataframe; one row per hour with vehicle, passenger and announcement columns
+    """
+    vehicles = creating_hourly_vehicle_counts(heatmap_data)
+    passengers = creating_hourly_passenger_counts(transport, lines=lines)
+    fact = vehicles.merge(passengers, on='hour_key', how='outer')
+
+    index = traffic_announcements_intervals.creating_interval_index(announcements)
+    fact = fact.merge(creating_hourly_announcement_counts(index, fact['hour_key'].values, types),
+                      on='hour_key', how='left')
+    fact['any_active'] = fact[[t.lower().replace(' ', '_') + '_active' for t in types]].any(axis=1)
+
+    fact.insert(0, 'date_time', pd.to_datetime(fact['hour_key'].values * nanoseconds_in_hour))
+    return fact.sort_values('hour_key').reset_index(drop=True)
+
+
+def comparing_during_incidents(fact, col='number_of_passenger', type_='Accident Notification'):
+    """
+    Compares the average of the column when the announcement type is active and not, for each hour of the day,
+    so that the daily pattern does not dominate the comparison.
+    :param fact: dataframe
+    :param col: string
+    :param type_: string
+    :rtype: dataframe
+    """
+    flag = type_.lower().replace(' ', '_') + '_active'
+    data = fact.dropna(subset=[col])
+    df = data.groupby([data['date_time'].dt.hour.rename('hour'), data[flag]])[col].mean().unstack(flag) \
+        .reindex(columns=[True, False]).rename(columns={True: 'avg_active', False: 'avg_inactive'}) \
+        .rename_axis(columns=None)
+    df['change_perc'] = round(100 * (df['avg_active'] / df['avg_inactive'] - 1), 2)
+    return df.reset_index()
+
+
+def creating_incident_comparison_graph(fact, col='number_of_passenger', type_='Accident Notification'):
+    """
+    :param fact: dataframe
+    :param col: string
+    :param type_: string
+    :return: Plotly Bar Graph
+    """
+    df = comparing_during_incidents(fact, col=col, type_=type_)
+    yxs = 'Avg Passenger Count' if col == 'number_of_passenger' else 'Avg ' + col.replace('_', ' ').title()
+
+    fig = go.Figure()
+    fig.add_trace(go.Bar(x=df['hour'], y=round(df['avg_active'], 2), name='{0} Active'.format(type_)))
+    fig.add_trace(go.Bar(x=df['hour'], y=round(df['avg_inactive'], 2), name='No {0}'.format(type_)))
+    fig.update_layout(
+        title='{0} by Hour During {1}s'.format(yxs, type_),
+        xaxis=dict(
+            dtick=1
+        ),
+        xaxis_title='Hour',
+        yaxis_title=yxs,
+        barmode='group',
+        font=dict(
+            family='Verdana',
+            size=10,
+            color='black'
+        ),
+        width=900,
+        height=650
+    )
+    return fig
+
+
+def data_preparation(lines=None):
+    """
+    :param lines: list
+    :rtype: dataframe
+    """
+    announcements = traffic_announcements_instant.data_preparation()
+    heatmap_data = traffic_density_hourly.creating_heatmap_data(dat=traffic_density_hourly.data_preparation())
+    transport = public_transport_hourly.data_preparation()
+    return creating_hourly_fact_table(announcements, heatmap_data, transport, lines=lines)
+
+
+def main():
+    """
+    :return: Plotly Figure
+    """
+    fact = data_preparation(lines=config.pth_lines_single)
+    for t in config.atd_list_:
+        creating_incident_comparison_graph(fact, col='number_of_passenger', type_=t)
+        creating_incident_comparison_graph(fact, col='number_of_vehicles', type_=t)
+
+
+def putting_into_streamlit(fact=None):
+    """
+    :param fact: dataframe; output of creating_hourly_fact_table, prepared here if it is None
+    :return: None
+    """
+    import streamlit as st
+
+    fact = data_preparation(lines=config.pth_lines_single) if fact is None else fact
+    st.markdown("## **:link: Announcements, Traffic Density & Ridership by Hour**")
+    for t in config.atd_list_:
+        for col in ['number_of_passenger', 'number_of_vehicles']:
+            figure_encoding.writing_to_streamlit(creating_incident_comparison_graph(fact, col=col, type_=t))
+
+
+if __name__ == "__main__":
+    # main()
+    putting_into_streamlit()
@@ -9,8 +9,7 @@ import branca.colormap as cm
 import datapane as dp
 import folium
 import json
-import os
-import pandas as pd
+import wifi_new_user_daily
 
 # Hide warnings
 import warnings
@@ -18,21 +17,13 @@ warnings.filterwarnings('ignore')
 
 dp.login('YOUR_TOKEN')
 
-dat = pd.read_csv(os.path.dirname(os.path.abspath(__file__)) + '/data/ibb_wifi_new_user_data.csv')
-
-# I do not like uppercase :)
-dat.columns = ['_id', 'subscription_date', 'subscription_county', 'subscription_type', 'lon', 'lat',
-               'number_of_subscription']
-# Converting from Turkish to English for Subscription Type column
-# dat['subscription_type'].unique()
-dat['subscription_type'] = dat['subscription_type'].map(
-    {'Yerli': 'domestic', 'Yabancı': 'foreign', 'Bilinmiyor': 'unknown'})
-# Changing data type for date column, str -> timestamp
-dat['subscription_date'] = pd.to_datetime(dat['subscription_date'])
+# the same loader as wifi_new_user_daily, the downloaded snapshot is used while it is fresh
+dat = wifi_new_user_daily.data_preparation()
 
 dat_coord = dat[['lon', 'lat', 'number_of_subscription']].groupby(['lon', 'lat']).sum().reset_index()
-dat_coord['hex_id'] = dat_coord.apply(lambda row: h3.geo_to_h3(row["lat"], row["lon"], 8), axis=1)
-df_aggreg = dat_coord[['hex_id', 'number_of_subscription']].groupby('hex_id').sum().reset_index()
+# the hexagon map is a roll-up of the subscription cube
+cube = wifi_new_user_daily.creating_subscription_cube(dat)
+df_aggreg = wifi_new_user_daily.rolling_up_cube(cube, ['hex_id'])
 df_aggreg.rename(columns={'number_of_subscription': 'value'}, inplace=True)
 
 df_aggreg["geometry"] = df_aggreg.hex_id.apply(
@@ -0,0 +1,34 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import importlib
+import importlib.util
+import types
+
+# Heavy or optional dependencies are bound at the top of the modules as proxies, which import the real module at
+# the first attribute access, e.g. px = lazy_imports.importing_lazily('plotly.express'); so the workers, the
+# service and the batch jobs that only aggregate do not pay for the plotting & publishing libraries.
+
+
+class LazyModule(types.ModuleType):
+    def __getattr__(self, attr):
+        """
+        :param attr: string
+        :return: attribute of the real module, which is imported by the first call; the import system
+                 serializes the concurrent first imports
+        """
+        return getattr(importlib.import_module(self.__name__), attr)
+
+
+def importing_lazily(name, optional=False):
+    """
+    :param name: string; module name
+    :param optional: bool; if True, None is returned when the package of the module is not installed
+    :rtype: module
+    """
+    # only the top-level package is looked up, finding the spec of a submodule would import its parent packages
+    if importlib.util.find_spec(name.partition('.')[0]) is None:
+        if optional is True:
+            return None
+        raise ImportError('No module named {0!r}'.format(name))
+    return LazyModule(name)
@@ -0,0 +1,318 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import config
+import dam_occupancy_rates_daily
+import figure_encoding
+import io
+import lazy_imports
+import logging
+import multiprocessing
+import os
+import pandas as pd
+import public_transport_hourly
+import time
+import traffic_announcements_instant
+import traffic_announcements_intervals
+import traffic_announcements_sketches
+import traffic_density_hourly
+import utils
+import wifi_new_user_daily
+
+requests = lazy_imports.importing_lazily('requests')  # the workers import this module too, only the loop downloads
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger('IMM Data Visualization - Orchestrator')
+
+# Runs the fetch -> prepare -> aggregate -> render pipelines of all data sets concurrently, e.g.
+# python orchestrator.py
+# The downloads are awaited on the event loop (in threads), the CPU-bound stages run in worker processes,
+# which get the downloaded bytes and return only the timings and the paths of the rendered figures.
+
+
+def preparing_dam(raw):
+    """
+    :param raw: dataframe
+    :rtype: dataframe
+    """
+    return dam_occupancy_rates_daily.preparing_data(raw)
+
+
+def aggregating_dam(df):
+    """
+    :param df: dataframe
+    :rtype: dict
+    """
+    return {'df': df, 'buckets': dam_occupancy_rates_daily.getting_time_buckets(df)}
+
+
+def rendering_dam(agg):
+    """
+    :param agg: dict
+    :rtype: dict; figures by name
+    """
+    figs = {'dor_{0}_{1}'.format(dt, col): dam_occupancy_rates_daily.creating_line_graph_based_date(
+        df=agg['df'], date_type=dt, col=col, buckets=agg['buckets']) for dt in config.date_type
+        for col in config.dor_cols}
+    figs['dor_occupancy_by_month'] = dam_occupancy_rates_daily.creating_bar_graph_for_occupancy(df=agg['df'].copy())
+    return figs
+
+
+def aggregating_wifi(df):
+    """
+    :param df: dataframe
+    :rtype: dict
+    """
+    cube = wifi_new_user_daily.creating_subscription_cube(df)
+    return {'cube': cube, 'buckets': wifi_new_user_daily.getting_time_buckets(cube)}
+
+
+def rendering_wifi(agg):
+    """
+    :param agg: dict
+    :rtype: dict
+    """
+    figs = {'wnu_{0}'.format(dt): wifi_new_user_daily.creating_line_graph_based_date(
+        df=agg['cube'], date_type=dt, buckets=agg['buckets']) for dt in config.date_type}
+    for c in ['subscription_county', 'subscription_type']:
+        figs['wnu_by_{0}'.format(c)] = wifi_new_user_daily.creating_bar_graph(cube=agg['cube'], col=c)
+    figs['wnu_by_county_type'] = wifi_new_user_daily.creating_stack_bar_graph(cube=agg['cube'])
+    return figs
+
+
+def aggregating_announcements(df):
+    """
+    :param df: dataframe
+    :rtype: dict
+    """
+    data_ = traffic_announcements_instant.creating_scatter_graph_data(df.copy())
+    return {'df': df, 'sketches': traffic_announcements_sketches.getting_duration_sketches(data_)}
+
+
+def rendering_announcements(agg):
+    """
+    :param agg: dict
+    :rtype: dict
+    """
+    return {'tai_monthly_counts': traffic_announcements_instant.creating_line_graph(agg['df']),
+            'tai_duration_quantiles': traffic_announcements_sketches.creating_quantile_graph(agg['sketches']),
+            'tai_concurrency': traffic_announcements_intervals.creating_concurrency_graph(
+                agg['df'], freq='D', types=config.atd_list_)}
+
+
+def aggregating_traffic(df):
+    """
+    :param df: dataframe
+    :rtype: dict
+    """
+    return {'tensor': traffic_density_hourly.creating_heatmap_tensor(df),
+            'density': traffic_density_hourly.creating_density_map_data(df)}
+
+
+def rendering_traffic(agg):
+    """
+    :param agg: dict
+    :rtype: dict
+    """
+    figs = {}
+    for y in config.tdh_years:
+        for m in config.tdh_months:
+            figs['tdh_heatmap_{0}_{1}'.format(y, m)] = traffic_density_hourly.creating_heatmap_graph(
+                df=None, year=y, month=m, tensor=agg['tensor'])
+            figs['tdh_density_{0}_{1}'.format(y, m)] = traffic_density_hourly.creating_density_mapbox(
+                dat=agg['density'], year=y, month=m, is_aggregated=True)
+    return figs
+
+
+def aggregating_transport(df):
+    """
+    :param df: dataframe
+    :rtype: dict; daily sums by month & year
+    """
+    return {(m, y): public_transport_hourly.creating_daily_data(
+        public_transport_hourly.data_generator(data=df, year=y, month=m)) for m in config.pth_months
+        for y in config.pth_years}
+
+
+def rendering_transport(agg):
+    """
+    :param agg: dict
+    :rtype: dict
+    """
+    # the first & the last year of config.pth_years are compared
+    y1, y2 = config.pth_years[0], config.pth_years[-1]
+    return {'pth_daily_{0}_{1}'.format(m, col): public_transport_hourly.creating_line_graph_based_day(
+        agg[(m, y1)], agg[(m, y2)], col=col, m=config.months[m], years=(y1, y2)) for m in config.pth_months
+        for col in config.pth_cols}
+
+
+pipelines = {
+    'dor': (preparing_dam, aggregating_dam, rendering_dam),
+    'wnu': (wifi_new_user_daily.preparing_data, aggregating_wifi, rendering_wifi),
+    'tai': (traffic_announcements_instant.preparing_data, aggregating_announcements, rendering_announcements),
+    'tdh': (traffic_density_hourly.preparing_partition, aggregating_traffic, rendering_traffic),
+    'pth': (public_transport_hourly.preparing_data, aggregating_transport, rendering_transport),
+}
+
+
+def downloading(url):
+    """
+    :param url: string
+    :rtype: bytes
+    """
+    r = requests.get(url, timeout=config.orchestrator_download_timeout)
+    r.raise_for_status()
+    return r.content
+
+
+def running_stages(dat_name, contents, output_dir=None):
+    """
+    The CPU-bound stages of a pipeline, run in a worker process.
+    :param dat_name: string
+    :param contents: list of bytes; one csv file per URL
+    :param output_dir: string; config.orchestrator_output_dir if it is None
+    :rtype: dict; seconds per stage & paths of the rendered figures
+    """
+    output_dir = config.orchestrator_output_dir if output_dir is None else output_dir
+    preparing, aggregating, rendering = pipelines[dat_name]
+    timings = {}
+
+    t = time.perf_counter()
+    raw = pd.concat([pd.read_csv(io.BytesIO(c)) for c in contents], ignore_index=True)
+    df = preparing(raw)
+    timings['prepare'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    agg = aggregating(df)
+    timings['aggregate'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for name, fig in rendering(agg).items():
+        paths.append(os.path.join(output_dir, name + '.html'))
+        figure_encoding.exporting_figure_html(fig, paths[-1])
+    timings['render'] = time.perf_counter() - t
+    return {'timings': timings, 'paths': paths}
+
+
+def settling(future, result=None, error=None):
+    """
+    :param future: asyncio.Future
+    :param result: result of the worker
+    :param error: exception of the worker
+    :return: None
+    """
+    if future.done():  # cancelled by the timeout
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+async def running_in_worker(pool, func, *args):
+    """
+    Runs the function in the worker pool; its result is handed to the event loop by the callbacks of the pool, so
+    no thread is left waiting for a worker that is terminated.
+    :param pool: multiprocessing.Pool
+    :param func: function
+    :param args: arguments of the function
+    :rtype: result of the function
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    pool.apply_async(func, args,
+                     callback=lambda r: loop.call_soon_threadsafe(settling, future, r),
+                     error_callback=lambda e: loop.call_soon_threadsafe(settling, future, None, e))
+    return await future
+
+
+async def running_pipeline(dat_name, pool):
+    """
+    :param dat_name: string
+    :param pool: multiprocessing.Pool
+    :rtype: dict
+    """
+    loop = asyncio.get_running_loop()
+    t = time.perf_counter()
+    urls = utils.getting_data_url(dat_name)
+    urls = urls if isinstance(urls, list) else [urls]
+    contents = await asyncio.gather(*[loop.run_in_executor(None, downloading, u) for u in urls])
+    fetch = time.perf_counter() - t
+
+    result = await running_in_worker(pool, running_stages, dat_name, contents)
+    result['timings'] = dict(fetch=fetch, **result['timings'])
+    return result
+
+
+async def running_with_timeout(dat_name, semaphore):
+    """
+    A pipeline that times out is reported as such, the others go on; the timeout starts when the pipeline gets
+    a free slot. Each pipeline has a worker process of its own, so the worker of a timed out pipeline is
+    terminated without touching the others.
+    :param dat_name: string
+    :param semaphore: asyncio.Semaphore; limits the pipelines that run at the same time
+    :rtype: dict
+    """
+    async with semaphore:
+        t = time.perf_counter()
+        pool = multiprocessing.Pool(processes=1)
+        status = 'cancelled'
+        try:
+            result = await asyncio.wait_for(running_pipeline(dat_name, pool),
+                                            timeout=config.orchestrator_timeouts.get(dat_name))
+            status = 'ok'
+        except asyncio.TimeoutError:
+            result, status = {'timings': {}, 'paths': []}, 'timeout'
+        except Exception as e:
+            logger.exception('{0} pipeline failed'.format(dat_name))
+            result, status = {'timings': {}, 'paths': []}, 'failed: {0}'.format(type(e).__name__)
+        finally:
+            await stopping_pool(pool, is_busy=status != 'ok')
+
+    logger.info('{0} pipeline: {1} in {2:.1f} s'.format(dat_name, status, time.perf_counter() - t))
+    return dict(result, dataset=dat_name, status=status, total=time.perf_counter() - t)
+
+
+async def stopping_pool(pool, is_busy):
+    """
+    Closes the pool; the worker of a pipeline that did not finish, e.g. it timed out, is terminated instead of
+    being waited for, in a thread so that the event loop goes on.
+    :param pool: multiprocessing.Pool
+    :param is_busy: bool
+    :return: None
+    """
+    if is_busy is True:
+        await asyncio.get_running_loop().run_in_executor(None, pool.terminate)
+    else:
+        pool.close()
+
+
+async def running_all(dat_names=None):
+    """
+    :param dat_names: list; all pipelines if it is None
+    :rtype: dataframe; seconds per pipeline & stage
+    """
+    dat_names = list(pipelines) if dat_names is None else dat_names
+    semaphore = asyncio.Semaphore(config.orchestrator_max_concurrency)
+    t = time.perf_counter()
+    results = await asyncio.gather(*[running_with_timeout(n, semaphore) for n in dat_names])
+
+    summary = pd.DataFrame([dict(dataset=r['dataset'], status=r['status'], figures=len(r['paths']),
+                                 **r['timings'], total=r['total']) for r in results]).set_index('dataset')
+    logger.info('All pipelines finished in {0:.1f} s, the slowest took {1:.1f} s\n{2}'.format(
+        time.perf_counter() - t, summary['total'].max(), summary.round(2).to_string()))
+    return summary
+
+
+def main():
+    """
+    :return: dataframe
+    """
+    return asyncio.run(running_all())
+
+
+if __name__ == "__main__":
+    main()
@@ -2,15 +2,17 @@
 # -*- coding: utf-8 -*-
 
 import config
-import datapane as dp
+import figure_encoding
+import lazy_imports
 import logging
 import numpy as np
 import pandas as pd
-import plotly.express as px
 import plotly.graph_objs as go
-import streamlit as st
+import sql_backend
 import utils
 
+px = lazy_imports.importing_lazily('plotly.express')
+
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger('IMM Data Visualization - Hourly Public Transport')
 
@@ -19,8 +21,24 @@ def data_preparation():
     """
     :rtype: dataframe
     """
-    # getting data
-    dat = utils.getting_raw_data(dat_name='pth', url_list=True)
+    if config.memory_budget_mb is not None:
+        # there is no out-of-core path for the transport graphs, the partitions are shrunk one at a time instead
+        if utils.estimating_footprint('pth', preparing_data, config.pth_keep_cols)[1] is True:
+            logger.warning('The public transport data is estimated to be over the memory budget.')
+        dat = utils.concatenating_frames(list(utils.iterating_shrunk_partitions('pth', preparing_data,
+                                                                               config.pth_keep_cols)))
+        utils.reporting_memory(dat, 'pth', 'prepared')
+        return dat
+
+    # getting data, from the partition snapshots through the shared loader
+    return preparing_data(utils.loading_dataset('pth'))
+
+
+def preparing_data(dat):
+    """
+    :param dat: dataframe; raw data
+    :rtype: dataframe
+    """
     dat.reset_index(drop=True, inplace=True)
     dat.columns = [c.lower() for c in dat.columns]
 
@@ -28,8 +46,9 @@ def data_preparation():
     dat['transport_type_desc'] = dat['transport_type_desc'].map({'KARAYOLU': 'Highway', 'RAY': 'Rail', 'DENİZ': 'Sea'})
     dat['transfer_type'] = dat['transfer_type'].map({'AKTARMA': 'Transmission', 'NORMAL': 'Normal'})
 
-    # Changing data type for date column, str -> timestamp
-    dat['date_time'] = pd.to_datetime(dat['date_time'])
+    # Changing data type for date column, str -> timestamp (the loaded data set is already parsed)
+    if not pd.api.types.is_datetime64_any_dtype(dat['date_time']):
+        utils.parsing_datetime(dat, 'date_time')
 
     # T5 EMİNÖNÜ-ALİBEYKÖY; This line has opened to use this year, so it will be excluded from data.
     # KABATAŞ-MAHMUTBEY; And this line has very limited usage in 2020, so it will be excluded from data.
@@ -39,20 +58,43 @@ def data_preparation():
     return data
 
 
-def data_generator(data, year, month, is_line=False):
+def preparing_preview(fraction=None):
+    """
+    Preview counterpart of data_preparation, from a stratified sample of the rows of every hour & line; the
+    passenger & passage counts are weighted, so the sums & the averages of the sums estimate the exact ones.
+    :param fraction: float; config.preview_fraction if it is None
+    :rtype: tuple; weighted sample & estimated monthly sums by transport type with their confidence intervals
+    """
+    fraction = config.preview_fraction if fraction is None else fraction
+    sample = pd.concat(list(utils.iterating_sampled_partitions('pth', preparing_data, config.pth_keep_cols,
+                                                               fraction)), ignore_index=True)
+    keys = ['year', 'month', 'transport_type_desc']
+    margins = pd.concat({c: utils.estimating_stratified_sums(sample, strata=config.preview_strata['pth'], by=keys,
+                                                             col=c).set_index(keys)[['estimate', 'margin']]
+                         for c in config.pth_cols}, axis=1)
+    return utils.weighting_sample(sample, config.pth_cols), margins
+
+
+def data_generator(data, year, month, is_line=False, backend=None):
     """
     :param data: dataframe
     :param year: int
     :param month: string
     :param is_line: bool
+    :param backend: string; pandas, duckdb or sqlite, config.aggregation_backend['pth'] if it is None
     :rtype: dataframe
     """
+    backend = config.aggregation_backend['pth'] if backend is None else backend
+    if backend != 'pandas':
+        return sql_backend.creating_passenger_sums(data, year, month, is_line, backend)
+
     grouping_cols = ['date_time']
     cols = ['date_time', 'number_of_passenger', 'number_of_passage']
     if is_line is True:
         grouping_cols.append('line')
         cols.append('line')
-    return data[(data['year'] == year) & (data['month'] == month)][cols].groupby(grouping_cols).sum().reset_index()
+    return data[(data['year'] == year) & (data['month'] == month)][cols].groupby(grouping_cols, observed=True).sum() \
+        .sort_index().reset_index()
 
 
 def creating_daily_data(df):
@@ -80,12 +122,13 @@ def creating_day_avg_data(df):
     return df_grouped.groupby(['day_value']).sum().reindex(days).reset_index()
 
 
-def creating_line_graph_based_day(df_2020, df_2021, col, m=1):
+def creating_line_graph_based_day(df_2020, df_2021, col, m=1, years=(2020, 2021)):
     """
-    :param df_2020: dataframe
-    :param df_2021: dataframe
+    :param df_2020: dataframe; the first year of the comparison
+    :param df_2021: dataframe; the second year of the comparison
     :param col: string
     :param m: int, month number; 1 or 2
+    :param years: tuple; the years of the two dataframes, for the trace names
     :return: Plotly Line Graph
     """
     if col == 'number_of_passenger':
@@ -108,11 +151,12 @@ def creating_line_graph_based_day(df_2020, df_2021, col, m=1):
     reverse_months = [{value: key for key, value in config.months.items()}][0]
     nm_month = reverse_months[m]
 
+    scatter = figure_encoding.choosing_scatter_type(len(df_2020) + len(df_2021), n_traces=2)
     fig = go.Figure()
-    fig.add_trace(go.Scatter(x=df_2020['day_value'], y=df_2020[col], line=dict(color='royalblue'),
-                             showlegend=True, name=nm + ' - {0} 2020'.format(nm_month), mode='lines'))
-    fig.add_trace(go.Scatter(x=df_2021['day_value'], y=df_2021[col], line=dict(color='firebrick'),
-                             showlegend=True, name=nm + ' - {0} 2021'.format(nm_month), mode='lines'))
+    fig.add_trace(scatter(x=df_2020['day_value'], y=df_2020[col], line=dict(color='royalblue'),
+                          showlegend=True, name=nm + ' - {0} {1}'.format(nm_month, years[0]), mode='lines'))
+    fig.add_trace(scatter(x=df_2021['day_value'], y=df_2021[col], line=dict(color='firebrick'),
+                          showlegend=True, name=nm + ' - {0} {1}'.format(nm_month, years[1]), mode='lines'))
 
     fig.update_layout(
         title=title_,
@@ -140,24 +184,26 @@ def creating_bar_graph_data(bar_part, base_data, y, m, t='Highway'):
     """
     if bar_part == 'tt_general':
         bar_ = base_data[['year', 'month', 'transport_type_desc', 'number_of_passenger', 'number_of_passage']]
-        bar_dat = bar_.groupby(['year', 'month', 'transport_type_desc']).sum().reset_index()
+        bar_dat = bar_.groupby(['year', 'month', 'transport_type_desc'], observed=True).sum().sort_index().reset_index()
         bar_data = bar_dat[(bar_dat['year'] == y) & (bar_dat['month'] == m)].reset_index(drop=True)
         bar_data['number_of_passenger_perc'] = round(
             bar_data['number_of_passenger'] / bar_data['number_of_passenger'].sum(), 2)
         bar_data['number_of_passage_perc'] = round(bar_data['number_of_passage']/bar_data['number_of_passage'].sum(), 2)
     else:  # tt_in_details
         bar_ = base_data[['year', 'month', 'transport_type_desc', 'line', 'number_of_passenger', 'number_of_passage']]
-        bar_dat = bar_.groupby(['year', 'month', 'transport_type_desc', 'line']).sum().reset_index()
+        bar_dat = bar_.groupby(['year', 'month', 'transport_type_desc', 'line'], observed=True).sum().sort_index() \
+            .reset_index()
         bar_data = bar_dat[
             (bar_dat['year'] == y) & (bar_dat['month'] == m) & (bar_dat['transport_type_desc'] == t)].reset_index(
             drop=True)
     return bar_data
 
 
-def creating_bar_graph_based_transport_type(dat, col):
+def creating_bar_graph_based_transport_type(dat, col, margins=None):
     """
     :param dat: dataframe
     :param col: string
+    :param margins: dataframe; estimated sums & confidence intervals of a preview, drawn as error bars if it is given
     :return: Plotly Bar Graph
     """
     for m in config.pth_months:
@@ -179,8 +225,13 @@ def creating_bar_graph_based_transport_type(dat, col):
             title_ = 'Passage Count by Transport Type'
             yaxis_title_ = 'Passage Count'
 
+        error_ = None
+        if margins is not None:
+            error_ = margins[(col, 'margin')].reindex(
+                pd.MultiIndex.from_frame(data[['year', 'month', 'transport_type_desc']])).values
+            title_ += ' [± {0:.0%} CI]'.format(config.preview_confidence)
         fig = px.bar(x=data['transport_type_desc'], color=data['date'], y=data[y_], text=data[text_], title=title_,
-                     barmode='group')
+                     barmode='group', error_y=error_)
         fig.update_layout(xaxis_title='Type', yaxis_title=yaxis_title_, width=900, height=650)
         return fig
 
@@ -236,14 +287,15 @@ def creating_avg_data_all_date_breakdown(df, lines, time_type, d=None, h=None):
     if time_type == 'days':
         df__ = df_[df_['day_value'].isin(d)][['day_value', 'hour', 'line',
                                               'number_of_passenger', 'number_of_passage']].reset_index(drop=True)
-        df_grouped = df__.groupby(['day_value', 'hour', 'line']).mean().reset_index().round(2) \
+        df_grouped = df__.groupby(['day_value', 'hour', 'line'], observed=True).mean().sort_index().reset_index() \
+            .round(2) \
             .rename(columns={'number_of_passenger': 'avg_number_of_passenger',
                              'number_of_passage': 'avg_number_of_passage'})
         return df_grouped
     else:
         df__ = df_[df_['hour'].isin(h)][['hour', 'line',
                                          'number_of_passenger', 'number_of_passage']].reset_index(drop=True)
-        df_grouped = df__.groupby(['hour', 'line']).mean().reset_index().round(2) \
+        df_grouped = df__.groupby(['hour', 'line'], observed=True).mean().sort_index().reset_index().round(2) \
             .rename(columns={'number_of_passenger': 'avg_number_of_passenger',
                              'number_of_passage': 'avg_number_of_passage'})
         return df_grouped
@@ -278,13 +330,15 @@ def creating_line_graph_based_date(time_type, df_2020, df_2021, col, m=1):
     order_list_20 = df_2020['date'].unique().tolist()
     order_list_21 = df_2021['date'].unique().tolist()
     df_2020_pv = pd.pivot_table(df_2020, values=col, index=['date'],
-                                columns='line', aggfunc=np.sum).reindex(order_list_20)
+                                columns='line', aggfunc=np.sum, observed=True).sort_index(axis=1).reindex(order_list_20)
     df_2021_pv = pd.pivot_table(df_2021, values=col, index=['date'],
-                                columns='line', aggfunc=np.sum).reindex(order_list_21)
+                                columns='line', aggfunc=np.sum, observed=True).sort_index(axis=1).reindex(order_list_21)
 
+    # one trace per line; WebGL keeps the figures interactive when all lines are drawn
+    scatter_20 = figure_encoding.choosing_scatter_type(df_2020_pv.size, n_traces=len(df_2020_pv.columns))
     fig_20 = go.Figure()
     for c in df_2020_pv.columns:
-        fig_20.add_trace(go.Scatter(x=df_2020_pv.index, y=df_2020_pv[c].values,
+        fig_20.add_trace(scatter_20(x=df_2020_pv.index, y=df_2020_pv[c].values,
                                     name=c + ' // {0} 2020'.format(nm_month),
                                     mode='lines',
                                     line=dict(shape='linear'),
@@ -293,9 +347,10 @@ def creating_line_graph_based_date(time_type, df_2020, df_2021, col, m=1):
                                     )
                          )
 
+    scatter_21 = figure_encoding.choosing_scatter_type(df_2021_pv.size, n_traces=len(df_2021_pv.columns))
     fig_21 = go.Figure()
     for c in df_2021_pv.columns:
-        fig_21.add_trace(go.Scatter(x=df_2021_pv.index, y=df_2021_pv[c].values,
+        fig_21.add_trace(scatter_21(x=df_2021_pv.index, y=df_2021_pv[c].values,
                                     name=c + ' // {0} 2021'.format(nm_month),
                                     mode='lines',
                                     line=dict(shape='linear'),
@@ -420,8 +475,8 @@ def main():
 
     # graph part IV
     for m in config.pth_months:
-        df_20 = data_generator(data=df.copy(), year=2020, month=m, is_line=True)
-        df_21 = data_generator(data=df.copy(), year=2021, month=m, is_line=True)
+        df_20 = data_generator(data=df, year=2020, month=m, is_line=True)
+        df_21 = data_generator(data=df, year=2021, month=m, is_line=True)
         m_ = [config.months[key] for key in config.months if key == m][0]
         for c in config.pth_cols:
             col_ = 'avg_' + c
@@ -453,28 +508,42 @@ def main():
                                                 col=col_, sline=config.pth_lines_single, m=m_)
 
 
-def putting_into_streamlit():
+def putting_into_streamlit(df=None, margins=None):
     """
+    :param df: dataframe; output of data_preparation, loaded here if it is None
+    :param margins: dataframe; estimated sums & confidence intervals of a preview, output of preparing_preview
     :return: None
     """
-    df = data_preparation()
+    import streamlit as st
+
+    df = data_preparation() if df is None else df
     st.markdown("## **:bus: Hourly Public Transport Data Visualization :oncoming_bus:**")
+    if margins is not None:
+        with st.expander('Estimated monthly sums by transport type, ± half width of the {0:.0%} confidence '
+                         'interval'.format(config.preview_confidence)):
+            st.dataframe(margins.round(0))
+        # the other charts of a preview would have no confidence intervals, they wait for the exact data set
+        for col in config.pth_cols:
+            figure_encoding.writing_to_streamlit(creating_bar_graph_based_transport_type(dat=df.copy(), col=col,
+                                                                                         margins=margins))
+        return
     for m in config.pth_months:
         df_20 = data_generator(data=df, year=2020, month=m)
         df_21 = data_generator(data=df, year=2021, month=m)
         for col in config.pth_cols:
             m_ = [config.months[key] for key in config.months if key == m][0]
-            st.write(creating_line_graph_based_day(creating_day_avg_data(df_20.copy()),
-                                                   creating_day_avg_data(df_21.copy()),
-                                                   col='avg_' + col, m=m_))
+            figure_encoding.writing_to_streamlit(creating_line_graph_based_day(creating_day_avg_data(df_20.copy()),
+                                                                               creating_day_avg_data(df_21.copy()),
+                                                                               col='avg_' + col, m=m_))
     for col in config.pth_cols:
-        st.write(creating_bar_graph_based_transport_type(dat=df.copy(), col=col))
+        figure_encoding.writing_to_streamlit(creating_bar_graph_based_transport_type(dat=df.copy(), col=col))
     for col in config.pth_cols:
         for t in config.pth_types:
-            st.write(creating_bar_graph_based_transport_type_in_details(dat=df.copy(), value_type=col, type_desc=t))
+            figure_encoding.writing_to_streamlit(creating_bar_graph_based_transport_type_in_details(
+                dat=df.copy(), value_type=col, type_desc=t))
     for m in config.pth_months:
-        df_20 = data_generator(data=df.copy(), year=2020, month=m, is_line=True)
-        df_21 = data_generator(data=df.copy(), year=2021, month=m, is_line=True)
+        df_20 = data_generator(data=df, year=2020, month=m, is_line=True)
+        df_21 = data_generator(data=df, year=2021, month=m, is_line=True)
         m_ = [config.months[key] for key in config.months if key == m][0]
         for c in config.pth_cols:
             col_ = 'avg_' + c
@@ -487,12 +556,12 @@ def putting_into_streamlit():
                                                       df_2020=h_20.copy().rename(columns={'hour': 'date'}),
                                                       df_2021=h_21.copy().rename(columns={'hour': 'date'}),
                                                       col=col_, m=m_)
-            st.write(fig_list[0])
-            st.write(fig_list[1])
+            figure_encoding.writing_to_streamlit(fig_list[0])
+            figure_encoding.writing_to_streamlit(fig_list[1])
     # It was repeated for graph order in Streamlit
     for m in config.pth_months:
-        df_20 = data_generator(data=df.copy(), year=2020, month=m, is_line=True)
-        df_21 = data_generator(data=df.copy(), year=2021, month=m, is_line=True)
+        df_20 = data_generator(data=df, year=2020, month=m, is_line=True)
+        df_21 = data_generator(data=df, year=2021, month=m, is_line=True)
         m_ = [config.months[key] for key in config.months if key == m][0]
         for c in config.pth_cols:
             col_ = 'avg_' + c
@@ -501,14 +570,17 @@ def putting_into_streamlit():
                                                          time_type='hours', h=config.hours)
             ah_21 = creating_avg_data_all_date_breakdown(df=df_21.copy(), lines=config.pth_lines_single,
                                                          time_type='hours', h=config.hours)
-            st.write(creating_line_graph_for_single_line(time_type='hours', df_2020=ah_20.copy(), df_2021=ah_21.copy(),
-                                                         col=col_, sline=config.pth_lines_single, m=m_))
+            figure_encoding.writing_to_streamlit(creating_line_graph_for_single_line(
+                time_type='hours', df_2020=ah_20.copy(), df_2021=ah_21.copy(), col=col_, sline=config.pth_lines_single,
+                m=m_))
 
 
 def putting_into_datapane():
     """
     :return: None
     """
+    import datapane as dp
+
     # getting token
     dp.login(config.dp_token)
 
@@ -547,10 +619,10 @@ def putting_into_datapane():
 
     # line graph 3
     h_20 = creating_avg_data_all_date_breakdown(
-        df=data_generator(data=df.copy(), year=2020, month='February', is_line=True).copy(), lines=config.pth_lines,
+        df=data_generator(data=df, year=2020, month='February', is_line=True).copy(), lines=config.pth_lines,
         time_type='hours', h=config.pth_hours)
     h_21 = creating_avg_data_all_date_breakdown(
-        df=data_generator(data=df.copy(), year=2021, month='February', is_line=True).copy(), lines=config.pth_lines,
+        df=data_generator(data=df, year=2021, month='February', is_line=True).copy(), lines=config.pth_lines,
         time_type='hours', h=config.pth_hours)
     fig_list = creating_line_graph_based_date(time_type='hours', df_2020=h_20.copy().rename(columns={'hour': 'date'}),
                                               df_2021=h_21.copy().rename(columns={'hour': 'date'}),
@@ -561,10 +633,10 @@ def putting_into_datapane():
 
     # line graph 4
     ah_20 = creating_avg_data_all_date_breakdown(
-        df=data_generator(data=df.copy(), year=2020, month='January', is_line=True).copy(),
+        df=data_generator(data=df, year=2020, month='January', is_line=True).copy(),
         lines=config.pth_lines_single, time_type='hours', h=config.hours)
     ah_21 = creating_avg_data_all_date_breakdown(
-        df=data_generator(data=df.copy(), year=2021, month='January', is_line=True).copy(),
+        df=data_generator(data=df, year=2021, month='January', is_line=True).copy(),
         lines=config.pth_lines_single, time_type='hours', h=config.hours)
     p4 = creating_line_graph_for_single_line(time_type='hours', df_2020=ah_20.copy(), df_2021=ah_21.copy(),
                                              col='avg_number_of_passenger', sline=config.pth_lines_single, m=1)
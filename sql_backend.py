@@ -0,0 +1,213 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import config
+import itertools
+import lazy_imports
+import logging
+import numpy as np
+import os
+import pandas as pd
+import sqlite3
+import threading
+import weakref
+
+# optional dependency, the sqlite backend needs only the standard library; None if it is not installed
+duckdb = lazy_imports.importing_lazily('duckdb', optional=True)
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger('IMM Data Visualization - SQL Backend')
+
+# The prepared data sets are loaded into an embedded database file (DuckDB, or SQLite as the fallback) and the
+# heavy aggregations run as SQL queries there; DuckDB runs them multi-threaded on its columnar tables and pushes
+# the filters down into the scans. The results are returned in the same shape as the pandas functions.
+date_parts = {
+    'duckdb': {'year': 'year({0})', 'month': 'month({0})', 'weekday': 'isodow({0}) - 1', 'hour': 'hour({0})',
+               'day': 'CAST(CAST({0} AS DATE) AS TIMESTAMP)', 'year_month': "strftime({0}, '%Y-%m')"},
+    'sqlite': {'year': "CAST(strftime('%Y', {0}) AS INTEGER)", 'month': "CAST(strftime('%m', {0}) AS INTEGER)",
+               'weekday': "(CAST(strftime('%w', {0}) AS INTEGER) + 6) % 7",
+               'hour': "CAST(strftime('%H', {0}) AS INTEGER)", 'day': 'date({0})',
+               'year_month': "strftime('%Y-%m', {0})"}
+}
+# one connection per backend; a connection is not safe to share between threads and the tables of the database file
+# are shared, so the lock of the backend is held from the loading of a table until its query has returned
+connections = {}
+backend_locks = {'duckdb': threading.RLock(), 'sqlite': threading.RLock()}
+# loaded frame (weak reference), columns & content fingerprint per (backend, table); the shared frames are not
+# mutated, so the same frame is not hashed again, and another frame is loaded only if its fingerprint differs
+loaded_tables = {}
+registrations = itertools.count()
+
+
+def connecting(backend):
+    """
+    :param backend: string; duckdb or sqlite
+    :return: database connection, one per backend in the process; the caller holds the lock of the backend
+    """
+    if backend not in connections:
+        if backend == 'duckdb' and duckdb is None:
+            raise ImportError('duckdb is not installed; install it or use the sqlite backend')
+
+        os.makedirs(config.sql_database_dir, exist_ok=True)
+        path = os.path.join(config.sql_database_dir, 'imm_dataviz.' + backend)
+        if backend == 'duckdb':
+            con = duckdb.connect(path)
+            if config.sql_threads is not None:
+                con.execute('SET threads TO {0}'.format(int(config.sql_threads)))
+        else:
+            con = sqlite3.connect(path, check_same_thread=False)
+        connections[backend] = con
+    return connections[backend]
+
+
+def fingerprinting_frame(dat):
+    """
+    :param dat: dataframe
+    :rtype: tuple; number of rows, column names and the sum of the row hashes, changes if any value changes
+    """
+    return len(dat), tuple(dat.columns), int(pd.util.hash_pandas_object(dat, index=False).sum())
+
+
+def loading_table(backend, name, dat, cols):
+    """
+    Loads the columns of the dataframe into a table of the database file; the table is not loaded again while
+    the data are the same. The frame that was loaded last is recognized by its identity, without hashing it, so
+    it must not be mutated in place (the frames of the data layer are not). The caller holds the lock of the backend
+    until its queries have returned.
+    :param backend: string
+    :param name: string; table name
+    :param dat: dataframe
+    :param cols: list
+    :return: database connection
+    """
+    con = connecting(backend)
+    loaded = loaded_tables.get((backend, name))
+    if loaded is not None and loaded[0]() is dat and loaded[1] == tuple(cols):
+        return con
+
+    data = dat[cols]
+    fingerprint = fingerprinting_frame(data)
+    if loaded is not None and loaded[2] == fingerprint:
+        loaded_tables[(backend, name)] = (weakref.ref(dat), tuple(cols), fingerprint)
+        return con
+
+    if backend == 'duckdb':
+        view = 'incoming_{0}'.format(next(registrations))
+        con.register(view, data)
+        try:
+            con.execute('CREATE OR REPLACE TABLE {0} AS SELECT * FROM {1}'.format(name, view))
+        finally:
+            con.unregister(view)
+    else:
+        # timestamps are stored as ISO 8601 text, which the sqlite date functions understand
+        data.to_sql(name, con, if_exists='replace', index=False)
+        con.commit()
+    loaded_tables[(backend, name)] = (weakref.ref(dat), tuple(cols), fingerprint)
+    logger.info('{0} rows are loaded into {1}.{2}.'.format(len(data), backend, name))
+    return con
+
+
+def querying(backend, con, sql, params=None):
+    """
+    :param backend: string
+    :param con: database connection
+    :param sql: string
+    :param params: list
+    :rtype: dataframe
+    """
+    if backend == 'duckdb':
+        return con.execute(sql, params or []).df()
+    return pd.read_sql_query(sql, con, params=params)
+
+
+def creating_daily_partials(dat, name, date_col, cols, backend):
+    """
+    SQL counterpart of the daily partials of utils.creating_time_buckets.
+    :param dat: dataframe
+    :param name: string; table name
+    :param date_col: string
+    :param cols: list
+    :param backend: string
+    :rtype: dataframe; indexed by day, columns are (column, aggregation) pairs
+    """
+    day = date_parts[backend]['day'].format(date_col)
+    aggs = ', '.join('COALESCE(SUM({0}), 0) AS "{0}_sum", COUNT({0}) AS "{0}_count", MIN({0}) AS "{0}_min", '
+                     'MAX({0}) AS "{0}_max"'.format(c) for c in cols)
+    with backend_locks[backend]:
+        con = loading_table(backend, name, dat, [date_col] + list(cols))
+        df = querying(backend, con, 'SELECT {0} AS day_, {1} FROM {2} WHERE {3} IS NOT NULL GROUP BY 1 ORDER BY 1'
+                      .format(day, aggs, name, date_col))
+
+    data = pd.DataFrame({(c, a): df['{0}_{1}'.format(c, a)].values for c in cols
+                         for a in ['sum', 'count', 'min', 'max']},
+                        index=pd.DatetimeIndex(pd.to_datetime(df['day_'].values), name=date_col))
+    for c in cols:
+        if pd.api.types.is_integer_dtype(dat[c]):
+            data[[(c, 'sum'), (c, 'min'), (c, 'max')]] = data[[(c, 'sum'), (c, 'min'), (c, 'max')]] \
+                .astype(dat[c].dtype)
+    data[[(c, 'count') for c in cols]] = data[[(c, 'count') for c in cols]].astype(np.int64)
+    return data
+
+
+def creating_heatmap_cells(dat, backend):
+    """
+    City-wide number of vehicles per date_time, summed & counted per year, month, weekday (Monday=0) and hour.
+    :param dat: dataframe; raw traffic density data or the output of traffic_density_hourly.creating_heatmap_data
+    :param backend: string
+    :rtype: dataframe
+    """
+    p = {k: v.format('date_time') for k, v in date_parts[backend].items()}
+    with backend_locks[backend]:
+        con = loading_table(backend, 'traffic_density', dat, ['date_time', 'number_of_vehicles'])
+        return querying(backend, con, '''
+            WITH hourly AS (
+                SELECT date_time, COALESCE(SUM(number_of_vehicles), 0) AS vehicles
+                FROM traffic_density WHERE date_time IS NOT NULL GROUP BY date_time)
+            SELECT {year} AS year, {month} AS month, {weekday} AS weekday, {hour} AS hour,
+                   SUM(vehicles) AS sum, COUNT(*) AS count
+            FROM hourly GROUP BY 1, 2, 3, 4'''.format(**p))
+
+
+def creating_monthly_type_counts(df, backend):
+    """
+    SQL counterpart of traffic_announcements_instant.creating_monthly_type_counts.
+    :param df: dataframe; output of traffic_announcements_instant.data_preparation
+    :param backend: string
+    :rtype: dataframe; months as the index, announcement types as the columns
+    """
+    ym = date_parts[backend]['year_month'].format('announcement_starting_datetime')
+    with backend_locks[backend]:
+        con = loading_table(backend, 'traffic_announcements', df, ['announcement_starting_datetime',
+                                                                   'announcement_type_desc'])
+        data = querying(backend, con, '''
+            SELECT {0} AS date, announcement_type_desc, COUNT(*) AS count FROM traffic_announcements
+            WHERE announcement_starting_datetime IS NOT NULL AND announcement_type_desc IS NOT NULL
+            GROUP BY 1, 2'''.format(ym))
+    return data.pivot(index='date', columns='announcement_type_desc', values='count').fillna(0).astype(np.int64) \
+        .sort_index().sort_index(axis=1)
+
+
+def creating_passenger_sums(data, year, month, is_line, backend):
+    """
+    SQL counterpart of public_transport_hourly.data_generator; the year & month filter is pushed into the scan.
+    :param data: dataframe; output of public_transport_hourly.data_preparation
+    :param year: int
+    :param month: string
+    :param is_line: bool
+    :param backend: string
+    :rtype: dataframe
+    """
+    keys = 'date_time, line' if is_line is True else 'date_time'
+    with backend_locks[backend]:
+        con = loading_table(backend, 'public_transport', data, ['date_time', 'line', 'year', 'month',
+                                                                'number_of_passenger', 'number_of_passage'])
+        df = querying(backend, con, '''
+            SELECT {0}, SUM(number_of_passenger) AS number_of_passenger, SUM(number_of_passage) AS number_of_passage
+            FROM public_transport WHERE year = ? AND month = ? AND date_time IS NOT NULL{1}
+            GROUP BY {0} ORDER BY {0}'''.format(keys, ' AND line IS NOT NULL' if is_line is True else ''),
+                      [int(year), month])
+
+    df['date_time'] = pd.to_datetime(df['date_time'])
+    for c in ['number_of_passenger', 'number_of_passage']:
+        df[c] = df[c].astype(data[c].dtype) if pd.api.types.is_integer_dtype(data[c]) else df[c]
+    return df
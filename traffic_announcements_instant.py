@@ -2,60 +2,74 @@
 # -*- coding: utf-8 -*-
 
 import config
-import datapane as dp
+import figure_encoding
+import lazy_imports
 import logging
 import numpy as np
 import pandas as pd
-import plotly.express as px
 import plotly.graph_objs as go
-import streamlit as st
+import sql_backend
+import traffic_announcements_intervals
+import traffic_announcements_sketches
 import utils
 
+px = lazy_imports.importing_lazily('plotly.express')
+
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger('IMM Data Visualization - Traffic Announcements')
 
 
-def creating_datetime_col(df, col_name):
+def data_preparation():
     """
-    :param df: dataframee
-    :param col_name: string
-    :return: None
+    :return: dataframe
     """
-    df[col_name] = df[col_name].apply(lambda row: row[:19])
-    df[col_name] = pd.to_datetime(df[col_name])
+    # getting data, one parsed copy is shared in the process
+    return preparing_data(utils.loading_dataset('tai'))
 
 
-def data_preparation():
+def preparing_data(data):
     """
-    :return: dataframe
+    :param data: dataframe; raw records or the output of utils.loading_dataset
+    :rtype: dataframe
     """
-    # getting data
-    data = utils.getting_raw_data(dat_name='tai')
-    data.columns = [c.lower() for c in data.columns]
-    creating_datetime_col(data, 'announcement_starting_datetime')
-    creating_datetime_col(data, 'announcement_ending_datetime')
+    # lowercase column names & str -> timestamp for the datetime columns, as declared in the dataset catalog
+    data = utils.applying_schema(data, 'tai')
     data['announcement_type_desc'] = data['announcement_type_desc'].map(config.announcement_type_desc)
     return data[data['announcement_type_desc'].isin(config.atd_list)][
         ['announcement_starting_datetime', 'announcement_ending_datetime', 'announcement_type_desc']].reset_index(
         drop=True)
 
 
+def creating_monthly_type_counts(df, backend=None):
+    """
+    :param df: dataframe
+    :param backend: string; pandas, duckdb or sqlite, config.aggregation_backend['tai'] if it is None
+    :rtype: dataframe; number of announcements, months (YYYY-MM) as the index, types as the columns
+    """
+    backend = config.aggregation_backend['tai'] if backend is None else backend
+    if backend != 'pandas':
+        return sql_backend.creating_monthly_type_counts(df, backend)
+
+    df_ = df[['announcement_starting_datetime', 'announcement_type_desc']] \
+        .assign(date=df['announcement_starting_datetime'].dt.strftime('%Y-%m'), count=1)
+    df_ = df_[['date', 'announcement_type_desc', 'count']].groupby(
+        ['date', 'announcement_type_desc']).sum().reset_index()
+    return pd.pivot_table(df_, values='count', index=['date'], columns='announcement_type_desc',
+                          aggfunc=np.sum, fill_value=0)
+
+
 def creating_line_graph(df):
     """
     :param df: dataframe
     :return: Plotly Line Graph
     """
-    df['date'] = df['announcement_starting_datetime'].dt.strftime('%Y-%m')
-    df['count'] = 1
-    df_ = df[['date', 'announcement_type_desc', 'count']].groupby(
-        ['date', 'announcement_type_desc']).sum().reset_index()
-    data_pivot = pd.pivot_table(df_, values='count', index=['date'], columns='announcement_type_desc',
-                                aggfunc=np.sum, fill_value=0)
+    data_pivot = creating_monthly_type_counts(df)
 
+    scatter = figure_encoding.choosing_scatter_type(data_pivot.size, n_traces=len(data_pivot.columns))
     fig = go.Figure()
     for c in data_pivot.columns:
-        fig.add_trace(go.Scatter(x=data_pivot.index, y=data_pivot[c].values, name=c, mode='lines',
-                                 line=dict(shape='linear'), connectgaps=True, showlegend=True))
+        fig.add_trace(scatter(x=data_pivot.index, y=data_pivot[c].values, name=c, mode='lines',
+                              line=dict(shape='linear'), connectgaps=True, showlegend=True))
 
     fig.update_layout(
         title='Total Announcement Count by Month',
@@ -147,36 +161,40 @@ def creating_bar_graph(df, type_, year=2020, month=None):
     return fig
 
 
-def creating_scatter_graph_data(data):
+def creating_scatter_graph_data(data, quarantine=False):
     """
     :param data: dataframe
-    :rtype: dataframe
+    :param quarantine: bool; if True, the invalid records are returned in a side table as well
+    :rtype: dataframe or tuple of dataframes
     """
-    # It will be relocated the position of time columns for the records that have a negative date difference.
+    # The start and end columns are swapped in place for the records that have a negative date difference.
     # (announcement_ending_datetime - announcement_starting_datetime) < 0
     # There were 122 incorrect records
-    data['diff_sec'] = (data.announcement_ending_datetime - data.announcement_starting_datetime).astype(
-        'timedelta64[s]')
+    start = data['announcement_starting_datetime'].values
+    end = data['announcement_ending_datetime'].values
+    is_swapped = end < start
+    data['announcement_starting_datetime'] = np.minimum(start, end)
+    data['announcement_ending_datetime'] = np.maximum(start, end)
+
+    # duration is computed once, as int64 seconds
+    is_missing = np.isnat(data['announcement_starting_datetime'].values) | \
+        np.isnat(data['announcement_ending_datetime'].values)
+    diff_sec = (data['announcement_ending_datetime'].values - data['announcement_starting_datetime'].values) \
+        .astype('timedelta64[s]').astype(np.int64)
+    data['diff_sec'] = np.where(is_missing, 0, diff_sec)
+    is_valid = ~is_missing & (data['diff_sec'].values > 0)
 
     # base columns
-    col_list = ['announcement_starting_datetime', 'announcement_ending_datetime', 'announcement_type_desc']
+    col_list = ['announcement_starting_datetime', 'announcement_ending_datetime', 'announcement_type_desc', 'diff_sec']
+    data_ = data.loc[is_valid, col_list].reset_index(drop=True)
+    logger.info('{0} records were swapped, {1} records have a missing datetime, {2} records have zero duration'
+                .format(is_swapped.sum(), is_missing.sum(), (~is_valid & ~is_missing).sum()))
+    if quarantine is False:
+        return data_
 
-    # getting normal records
-    data_ = pd.DataFrame(columns=col_list)
-    data_ = data_.append(data[data['diff_sec'] > 0][col_list].reset_index(drop=True))
-
-    # transforming abnormal records
-    change_data = data[data['diff_sec'] < 0][
-        ['announcement_ending_datetime', 'announcement_starting_datetime', 'announcement_type_desc']].reset_index(
-        drop=True)
-    change_data.columns = col_list
-    data_ = data_.append(change_data)
-
-    # adding diff seconds again
-    data_['diff_sec'] = (data_.announcement_ending_datetime - data_.announcement_starting_datetime).astype(
-        'timedelta64[s]')
-    data_.reset_index(drop=True, inplace=True)
-    return data_
+    invalid = data.loc[~is_valid, col_list].reset_index(drop=True)
+    invalid['reason'] = np.where(is_missing[~is_valid], 'missing_datetime', 'zero_duration')
+    return data_, invalid
 
 
 def grouping_types(df, t):
@@ -260,35 +278,55 @@ def main():
     # fig = px.box(data_, x='announcement_type_desc', y='diff_min')
     # fig.show()
     creating_scatter_graph(df=data_, type_='diff_min')
+    traffic_announcements_sketches.creating_quantile_graph(
+        traffic_announcements_sketches.getting_duration_sketches(data_), unit='diff_min')
+
+    # graph part IV
+    traffic_announcements_intervals.creating_concurrency_graph(df, freq='D', types=config.atd_list_)
 
 
-def putting_into_streamlit():
+def putting_into_streamlit(df=None, durations=None, sketches=None):
     """
+    :param df: dataframe; output of data_preparation, loaded here if it is None
+    :param durations: dataframe; output of creating_scatter_graph_data with the diff_min & diff_hhh columns
+    :param sketches: dict; duration sketches
     :return: None
     """
-    df = data_preparation()
+    import streamlit as st
+
+    df = data_preparation() if df is None else df
 
     st.markdown("## **:loudspeaker: Transportation Management Center Traffic Announcement Data Visualization**")
-    st.write(creating_line_graph(df))
+    figure_encoding.writing_to_streamlit(creating_line_graph(df))
 
-    df_ = creating_bar_graph_data(df)
+    df_ = creating_bar_graph_data(df.copy())
     # Please use the config.atd_list for all announcement type descriptions
     for t in config.atd_list_:
         # It can be given desired months in the month variable
-        st.write(creating_bar_graph(df=df_.copy(), type_=t, month=['March', 'July', 'October']))
+        figure_encoding.writing_to_streamlit(creating_bar_graph(df=df_.copy(), type_=t,
+                                                                month=['March', 'July', 'October']))
         for y in config.tai_years:
-            st.write(creating_bar_graph(df=df_.copy(), type_=t, year=y))
+            figure_encoding.writing_to_streamlit(creating_bar_graph(df=df_.copy(), type_=t, year=y))
 
-    data_ = creating_scatter_graph_data(df)
-    data_['diff_min'] = round(data_['diff_sec'] / 60, 2)
-    data_['diff_hhh'] = round(data_['diff_min'] / 60, 2)
-    st.write(creating_scatter_graph(df=data_, type_='diff_min'))
+    if durations is None:
+        durations = creating_scatter_graph_data(df.copy())
+        durations['diff_min'] = round(durations['diff_sec'] / 60, 2)
+        durations['diff_hhh'] = round(durations['diff_min'] / 60, 2)
+    figure_encoding.writing_to_streamlit(creating_scatter_graph(df=durations, type_='diff_min'))
+    if sketches is None:
+        sketches = traffic_announcements_sketches.getting_duration_sketches(durations)
+    figure_encoding.writing_to_streamlit(traffic_announcements_sketches.creating_quantile_graph(sketches,
+                                                                                                unit='diff_min'))
+    figure_encoding.writing_to_streamlit(traffic_announcements_intervals.creating_concurrency_graph(
+        df, freq='D', types=config.atd_list_))
 
 
 def putting_into_datapane():
     """
     :return: None
     """
+    import datapane as dp
+
     # getting token
     dp.login(config.dp_token)
 
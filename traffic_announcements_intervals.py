@@ -0,0 +1,155 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import figure_encoding
+import logging
+import numpy as np
+import pandas as pd
+import plotly.graph_objs as go
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger('IMM Data Visualization - Traffic Announcement Intervals')
+
+# An announcement is active in the half-open interval [starting datetime, ending datetime).
+start_col = 'announcement_starting_datetime'
+end_col = 'announcement_ending_datetime'
+
+
+def creating_endpoint_arrays(starts, ends):
+    """
+    :param starts: numpy array; datetime64[ns]
+    :param ends: numpy array; datetime64[ns]
+    :rtype: dict; sorted start and end arrays as int64 nanoseconds
+    """
+    starts = starts.astype('datetime64[ns]').astype(np.int64)
+    ends = ends.astype('datetime64[ns]').astype(np.int64)
+    # records with a negative duration have their endpoints the other way around
+    return {'starts': np.sort(np.minimum(starts, ends)), 'ends': np.sort(np.maximum(starts, ends))}
+
+
+def creating_interval_index(df):
+    """
+    :param df: dataframe; output of traffic_announcements_instant.data_preparation
+    :rtype: dict; endpoint arrays for all announcements and for each announcement type
+    """
+    data = df[[start_col, end_col, 'announcement_type_desc']].dropna()
+    index = {'all': creating_endpoint_arrays(data[start_col].values, data[end_col].values), 'types': {}}
+    for t, d in data.groupby('announcement_type_desc'):
+        index['types'][t] = creating_endpoint_arrays(d[start_col].values, d[end_col].values)
+    return index
+
+
+def selecting_endpoints(index, type_=None):
+    """
+    :param index: dict
+    :param type_: string; all announcements if it is None
+    :rtype: dict
+    """
+    return index['all'] if type_ is None else index['types'][type_]
+
+
+def counting_active_at(index, t, type_=None):
+    """
+    Number of announcements active at t, in O(log n) with two binary searches.
+    :param index: dict
+    :param t: timestamp, string or an array of them
+    :param type_: string
+    :rtype: int or numpy array
+    """
+    e = selecting_endpoints(index, type_)
+    is_scalar = np.ndim(t) == 0
+    t_ = pd.DatetimeIndex(pd.to_datetime([t] if is_scalar else t)).values.astype(np.int64)
+    count = np.searchsorted(e['starts'], t_, side='right') - np.searchsorted(e['ends'], t_, side='right')
+    return int(count[0]) if is_scalar else count
+
+
+def creating_active_count_series(index, start, end, freq='H', type_=None):
+    """
+    Number of active announcements at every point of a regular time grid.
+    :param index: dict
+    :param start: timestamp or string
+    :param end: timestamp or string
+    :param freq: string; pandas offset alias
+    :param type_: string
+    :rtype: series
+    """
+    grid = pd.date_range(start, end, freq=freq)
+    return pd.Series(counting_active_at(index, grid, type_=type_), index=grid, name='active_count')
+
+
+def creating_peak_concurrency_series(index, freq='D', type_=None):
+    """
+    Maximum number of simultaneously active announcements within each time bucket, with a sweep line over
+    the sorted endpoints; an end and a start at the same time do not overlap.
+    :param index: dict
+    :param freq: string; pandas period alias, e.g. H, D, W or M
+    :param type_: string
+    :rtype: series
+    """
+    e = selecting_endpoints(index, type_)
+    if len(e['starts']) == 0:
+        return pd.Series(dtype=np.int64, name='peak_count')
+
+    times = np.concatenate([e['starts'], e['ends']])
+    deltas = np.concatenate([np.ones(len(e['starts']), dtype=np.int64), -np.ones(len(e['ends']), dtype=np.int64)])
+    # sorted by time, ends (-1) before starts (+1) at the same time
+    order = np.lexsort((deltas, times))
+    times, running = times[order], np.cumsum(deltas[order])
+
+    periods = pd.period_range(pd.Timestamp(times[0]), pd.Timestamp(times[-1]), freq=freq)
+    edges = periods.start_time.values.astype(np.int64)
+    buckets = np.searchsorted(edges, times, side='right') - 1
+    n_buckets = len(periods)
+
+    # the count carried into a bucket from the previous one is also a candidate for its peak
+    peak = np.zeros(n_buckets, dtype=np.int64)
+    np.maximum.at(peak, buckets, running)
+    last_in_bucket = np.full(n_buckets, -1, dtype=np.int64)
+    last_in_bucket[buckets] = np.arange(len(times))
+    carried = np.maximum.accumulate(last_in_bucket)
+    carried_count = np.where(carried >= 0, running[np.maximum(carried, 0)], 0)
+    peak[1:] = np.maximum(peak[1:], carried_count[:-1])
+
+    return pd.Series(peak, index=periods.start_time, name='peak_count')
+
+
+def creating_peak_concurrency_by_type(index, freq='D', types=None):
+    """
+    :param index: dict
+    :param freq: string
+    :param types: list; all types if it is None
+    :rtype: dataframe; columns are announcement types
+    """
+    types = sorted(index['types']) if types is None else types
+    df = pd.concat({t: creating_peak_concurrency_series(index, freq=freq, type_=t) for t in types}, axis=1)
+    return df.fillna(0).astype(np.int64)
+
+
+def creating_concurrency_graph(df, freq='D', types=None):
+    """
+    :param df: dataframe
+    :param freq: string
+    :param types: list
+    :return: Plotly Line Graph
+    """
+    data = creating_peak_concurrency_by_type(creating_interval_index(df), freq=freq, types=types)
+
+    scatter = figure_encoding.choosing_scatter_type(data.size, n_traces=len(data.columns))
+    fig = go.Figure()
+    for c in data.columns:
+        fig.add_trace(scatter(x=data.index, y=data[c].values, name=c, mode='lines', showlegend=True))
+
+    fig.update_layout(
+        title='Peak Number of Simultaneously Active Announcements [{0}]'.format(freq),
+        xaxis_title='Date',
+        yaxis_title='Peak Active Announcement Count',
+        legend_title="Announcement Type",
+        font=dict(
+            family='Verdana',
+            size=10,
+            color='black'
+        ),
+        width=900,
+        height=650
+    )
+    return fig
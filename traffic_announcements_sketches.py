@@ -0,0 +1,210 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import config
+import hashlib
+import json
+import logging
+import numpy as np
+import os
+import pandas as pd
+import plotly.graph_objs as go
+import tempfile
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger('IMM Data Visualization - Traffic Announcement Duration Sketches')
+
+# Log-bucket quantile sketch (DDSketch); a positive value x falls into the bucket ceil(log(x) / log(gamma)),
+# where gamma = (1 + alpha) / (1 - alpha). Every quantile is returned with a relative error of at most alpha,
+# and two sketches are merged exactly by adding the bucket counts, so they can be built per announcement type
+# and month, then rolled up to any level.
+
+
+def creating_sketch(alpha=None):
+    """
+    :param alpha: float; relative accuracy, config.tai_sketch_relative_accuracy if it is None
+    :rtype: dict
+    """
+    alpha = config.tai_sketch_relative_accuracy if alpha is None else alpha
+    return {'alpha': alpha, 'zero_count': 0, 'bins': {}}
+
+
+def updating_sketch(sketch, values):
+    """
+    :param sketch: dict
+    :param values: numpy array; non-negative values, e.g. durations in seconds
+    :rtype: dict
+    """
+    values = np.asarray(values, dtype=np.float64)
+    values = values[~np.isnan(values)]
+    gamma = (1 + sketch['alpha']) / (1 - sketch['alpha'])
+    positive = values[values > 0]
+    keys, counts = np.unique(np.ceil(np.log(positive) / np.log(gamma)).astype(np.int64), return_counts=True)
+    for k, c in zip(keys.tolist(), counts.tolist()):
+        sketch['bins'][k] = sketch['bins'].get(k, 0) + c
+    sketch['zero_count'] += int(len(values) - len(positive))
+    return sketch
+
+
+def merging_sketches(sketches):
+    """
+    :param sketches: list of dicts; they should have the same alpha
+    :rtype: dict
+    """
+    merged = creating_sketch(sketches[0]['alpha'] if sketches else None)
+    for s in sketches:
+        merged['zero_count'] += s['zero_count']
+        for k, c in s['bins'].items():
+            merged['bins'][k] = merged['bins'].get(k, 0) + c
+    return merged
+
+
+def querying_quantiles(sketch, qs=config.tai_sketch_quantiles):
+    """
+    :param sketch: dict
+    :param qs: list; quantiles between 0 and 1
+    :rtype: list
+    """
+    keys = np.array(sorted(sketch['bins']), dtype=np.int64)
+    counts = np.array([sketch['bins'][k] for k in keys.tolist()], dtype=np.int64)
+    total = sketch['zero_count'] + counts.sum()
+    if total == 0:
+        return [np.nan] * len(qs)
+
+    gamma = (1 + sketch['alpha']) / (1 - sketch['alpha'])
+    cum = sketch['zero_count'] + np.cumsum(counts)
+    result = []
+    for q in qs:
+        rank = q * (total - 1)
+        if rank < sketch['zero_count']:
+            result.append(0.0)
+        else:
+            k = keys[np.searchsorted(cum, rank, side='right')]
+            result.append(2 * gamma ** k / (gamma + 1))
+    return result
+
+
+def creating_duration_sketches(df, sketches=None):
+    """
+    Updates the sketches of diff_sec per announcement type & month with the given records.
+    :param df: dataframe; output of traffic_announcements_instant.creating_scatter_graph_data
+    :param sketches: dict; keys are (announcement type, YYYY-MM)
+    :rtype: dict
+    """
+    sketches = {} if sketches is None else sketches
+    months = df['announcement_starting_datetime'].dt.strftime('%Y-%m')
+    for (t, m), d in df['diff_sec'].groupby([df['announcement_type_desc'], months]):
+        sketches[(t, m)] = updating_sketch(sketches.get((t, m), creating_sketch()), d.values)
+    return sketches
+
+
+def hashing_config():
+    """
+    :rtype: string; changes with the settings the persisted sketches depend on, which are then built again
+    """
+    return hashlib.sha1(json.dumps({'alpha': config.tai_sketch_relative_accuracy, 'bucket': 'ceil_log_gamma',
+                                    'months': '%Y-%m'}).encode('utf-8')).hexdigest()
+
+
+def saving_sketches(sketches, watermark, path=config.tai_sketch_path):
+    """
+    Writes through a temporary file of its own in the same directory, so concurrent writers do not mix their files.
+    :param sketches: dict
+    :param watermark: Timestamp; latest start time of the announcements in the sketches
+    :param path: string
+    :return: None
+    """
+    data = {'config': hashing_config(), 'watermark': None if watermark is None else watermark.isoformat(),
+            'sketches': [{'type': t, 'month': m, 'alpha': s['alpha'], 'zero_count': s['zero_count'],
+                          'bins': {str(k): c for k, c in s['bins'].items()}} for (t, m), s in sketches.items()]}
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path) or '.', suffix='.tmp', delete=False) as f:
+        json.dump(data, f)
+    os.replace(f.name, path)
+
+
+def loading_sketches(path=config.tai_sketch_path):
+    """
+    :param path: string
+    :rtype: tuple; sketches and the latest start time of their announcements, or an empty dict and None if nothing
+            was persisted with the current settings
+    """
+    if not os.path.exists(path):
+        return {}, None
+
+    with open(path) as f:
+        data = json.load(f)
+    if data.get('config') != hashing_config() or 'watermark' not in data:
+        logger.info('The sketch settings changed, the duration sketches are built again.')
+        return {}, None
+    sketches = {(s['type'], s['month']): {'alpha': s['alpha'], 'zero_count': s['zero_count'],
+                                          'bins': {int(k): c for k, c in s['bins'].items()}}
+                for s in data['sketches']}
+    return sketches, None if data['watermark'] is None else pd.Timestamp(data['watermark'])
+
+
+def getting_duration_sketches(df, path=config.tai_sketch_path):
+    """
+    Loads the persisted sketches, adds only the announcements which started after the latest start time in them
+    (the watermark) and persists them again with the new watermark. An announcement is counted once, with the
+    end time it had when it was added; a later correction of that end time is not counted again.
+    :param df: dataframe; output of traffic_announcements_instant.creating_scatter_graph_data
+    :param path: string
+    :rtype: dict
+    """
+    sketches, watermark = loading_sketches(path)
+    start = df['announcement_starting_datetime']
+    is_new = start.notna() if watermark is None else (start > watermark)
+    if not is_new.any():
+        return sketches
+
+    sketches = creating_duration_sketches(df[is_new], sketches)
+    saving_sketches(sketches, start[is_new].max(), path)
+    return sketches
+
+
+def creating_quantile_table(sketches, by='announcement_type_desc', months=None, qs=config.tai_sketch_quantiles):
+    """
+    :param sketches: dict
+    :param by: string; announcement_type_desc or month
+    :param months: list; YYYY-MM, all months if it is None
+    :param qs: list
+    :rtype: dataframe; duration quantiles in seconds
+    """
+    groups = {}
+    for (t, m), s in sketches.items():
+        if months is None or m in months:
+            groups.setdefault(t if by == 'announcement_type_desc' else m, []).append(s)
+
+    rows = [[k] + querying_quantiles(merging_sketches(v), qs) for k, v in sorted(groups.items())]
+    return pd.DataFrame(rows, columns=[by] + ['p{0:g}'.format(100 * q) for q in qs])
+
+
+def creating_quantile_graph(sketches, months=None, unit='diff_min'):
+    """
+    :param sketches: dict
+    :param months: list
+    :param unit: string; diff_sec, diff_min or diff_hhh
+    :return: Plotly Bar Graph
+    """
+    df = creating_quantile_table(sketches, months=months)
+    divisor = {'diff_sec': 1, 'diff_min': 60, 'diff_hhh': 3600}[unit]
+
+    fig = go.Figure()
+    for c in df.columns[1:]:
+        fig.add_trace(go.Bar(x=df['announcement_type_desc'], y=round(df[c] / divisor, 2), name=c))
+
+    fig.update_layout(
+        title='Duration Quantiles Between the Start and End Time of Announcements [{0}]'.format(unit[-3:-2]),
+        xaxis_title='Announcement Type Description',
+        yaxis_title='Duration [{0}]'.format(unit[-3:-2]),
+        legend_title="Quantile",
+        barmode='group',
+        font=dict(
+            family='Verdana',
+            size=10,
+            color='black'
+        ),
+        width=900,
+        height=650
+    )
+    return fig
@@ -2,15 +2,19 @@
 # -*- coding: utf-8 -*-
 
 import config
-import datapane as dp
+import figure_encoding
+import lazy_imports
 import logging
+import numpy as np
+import os
 import pandas as pd
-import plotly.express as px
-import plotly.figure_factory as ff
 import plotly.graph_objs as go
-import streamlit as st
+import sql_backend
 import utils
 
+px = lazy_imports.importing_lazily('plotly.express')
+ff = lazy_imports.importing_lazily('plotly.figure_factory')
+
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger('IMM Data Visualization - Traffic Density')
 
@@ -19,14 +23,143 @@ def data_preparation():
     """
     :rtype: dataframe
     """
-    # getting data
-    dat = utils.getting_raw_data(dat_name='tdh', url_list=True)
-    dat.reset_index(drop=True, inplace=True)
+    if config.memory_budget_mb is not None:
+        dat = utils.concatenating_frames(list(utils.iterating_shrunk_partitions('tdh', preparing_partition,
+                                                                               config.tdh_keep_cols)))
+        utils.reporting_memory(dat, 'tdh', 'prepared')
+        return dat
+
+    # getting data, from the partition snapshots through the shared loader
+    return preparing_partition(utils.loading_dataset('tdh'))
+
+
+def preparing_partition(dat):
+    """
+    :param dat: dataframe; raw data or a partition of it
+    :rtype: dataframe
+    """
     dat.columns = [c.lower() for c in dat.columns]
-    dat['date_time'] = pd.to_datetime(dat['date_time'])
+    if not pd.api.types.is_datetime64_any_dtype(dat['date_time']):  # the loaded data set is already parsed
+        utils.parsing_datetime(dat, 'date_time')
     return dat
 
 
+def data_preparation_out_of_core(chunksize=config.tdh_chunk_size, parts=None):
+    """
+    Out-of-core counterpart of data_preparation + creating_heatmap_data + creating_density_map_data.
+    The partitions are processed one at a time and only their partial aggregates are kept,
+    so memory stays constant as months are added.
+    :param chunksize: int
+    :param parts: iterable of prepared partitions; the raw data is downloaded in chunks if it is None
+    :rtype: tuple of dataframes; heatmap data and density map data
+    """
+    if parts is None:
+        parts = (preparing_partition(p) for p in utils.iterating_raw_data(dat_name='tdh', chunksize=chunksize))
+    heatmap_totals = None
+    density = None
+    dtype = np.int64
+    for i, part in enumerate(parts):
+        dtype = np.result_type(part['number_of_vehicles'].dtype, dtype)
+        # city-wide totals per date_time; a date_time can be split between chunks, so the totals are added
+        totals = part[['date_time', 'number_of_vehicles']].groupby('date_time')['number_of_vehicles'].sum()
+        heatmap_totals = totals if heatmap_totals is None else heatmap_totals.add(totals, fill_value=0)
+
+        partial = utils.creating_partial_aggregates(dat=adding_year_month_cols(part), col='number_of_vehicles',
+                                                    keys=['year', 'month', 'latitude', 'longitude'])
+        partial_list = [partial] if density is None else [density[partial.columns], partial]
+        density = utils.combining_partial_aggregates(partial_list, keys=['year', 'month', 'latitude', 'longitude'])
+        logger.info('Partition {0} was processed, {1} rows'.format(i, len(part)))
+
+    if heatmap_totals is None:
+        # no partitions, e.g. an empty URL list
+        logger.warning('There is no traffic density partition to process.')
+        return creating_heatmap_data(dat=pd.DataFrame({'date_time': pd.Series(dtype='datetime64[ns]'),
+                                                       'number_of_vehicles': pd.Series(dtype=np.int64)})), \
+            pd.DataFrame(columns=['year', 'month', 'latitude', 'longitude', 'sum', 'count', 'min', 'max', 'mean'])
+
+    # the totals are floats after the fill_value additions; back to integers, at least 64-bit ones for the sums
+    data = creating_heatmap_data(dat=heatmap_totals.astype(dtype).reset_index())
+    utils.reporting_memory(density, 'tdh', 'density map data')
+    return data, density
+
+
+def adding_year_month_cols(dat):
+    """
+    :param dat: dataframe
+    :rtype: dataframe
+    """
+    dat['year'] = dat['date_time'].dt.year
+    dat['month'] = dat['date_time'].dt.month_name()
+    return dat
+
+
+def creating_density_map_data(dat):
+    """
+    :param dat: dataframe
+    :rtype: dataframe; sum, count, min, max and mean of number of vehicles by year, month and location
+    """
+    data = adding_year_month_cols(dat[['date_time', 'longitude', 'latitude', 'number_of_vehicles']].copy())
+    partial = utils.creating_partial_aggregates(dat=data, col='number_of_vehicles',
+                                                keys=['year', 'month', 'latitude', 'longitude'])
+    return utils.combining_partial_aggregates([partial], keys=['year', 'month', 'latitude', 'longitude'])
+
+
+def preparing_aggregates(mode=None, with_heatmap_data=False):
+    """
+    :param mode: string; in_memory or out_of_core, config.tdh_execution_mode if it is None
+    :param with_heatmap_data: bool; if True, the city-wide number of vehicles by hour is returned as well
+    :rtype: tuple; heatmap tensor and density map data, and heatmap data if with_heatmap_data is True
+    """
+    mode = config.tdh_execution_mode if mode is None else mode
+    if mode == 'out_of_core':
+        data, density = data_preparation_out_of_core()
+        return (getting_heatmap_tensor(dat=data), density) + ((data,) if with_heatmap_data is True else ())
+
+    # a sample of the first partition tells whether all of them fit into the budget, before any of them is loaded
+    if config.memory_budget_mb is not None and \
+            utils.estimating_footprint('tdh', preparing_partition, config.tdh_keep_cols)[1] is True:
+        logger.info('Switching to the out_of_core mode to stay in the memory budget.')
+        data, density = data_preparation_out_of_core(parts=utils.iterating_shrunk_partitions(
+            'tdh', preparing_partition, config.tdh_keep_cols, chunksize=config.tdh_chunk_size))
+        return (getting_heatmap_tensor(dat=data), density) + ((data,) if with_heatmap_data is True else ())
+
+    df = data_preparation()
+    density = creating_density_map_data(dat=df)
+    utils.reporting_memory(density, 'tdh', 'density map data')
+    return (getting_heatmap_tensor(dat=df), density) + \
+        ((creating_heatmap_data(dat=df),) if with_heatmap_data is True else ())
+
+
+def preparing_preview(fraction=None):
+    """
+    Preview counterpart of preparing_aggregates, from a stratified sample of the rows of every hour; the tensor is
+    not persisted.
+    :param fraction: float; config.preview_fraction if it is None
+    :rtype: tuple; heatmap tensor with the variances of its sums and density map data with the margins of its means
+    """
+    fraction = config.preview_fraction if fraction is None else fraction
+    sample = pd.concat(list(utils.iterating_sampled_partitions('tdh', preparing_partition, config.tdh_keep_cols,
+                                                               fraction)), ignore_index=True)
+
+    # the city-wide number of vehicles of every hour is estimated from the sampled locations of the hour
+    totals = utils.estimating_stratified_sums(sample, strata=config.preview_strata['tdh'], by=['date_time'],
+                                              col='number_of_vehicles')
+    tensor = creating_heatmap_tensor(dat=totals.rename(columns={'estimate': 'number_of_vehicles'}), backend='pandas')
+    dt = totals['date_time'].dt
+    tensor['variance'] = np.zeros_like(tensor['sum'])
+    np.add.at(tensor['variance'], (np.searchsorted(tensor['years'], dt.year.values), dt.month.values - 1,
+                                   dt.dayofweek.values, dt.hour.values), totals['variance'].values)
+
+    # every location is sampled in a random subset of the hours, its mean is the mean of those hours
+    keys = ['year', 'month', 'latitude', 'longitude']
+    density = creating_density_map_data(dat=sample)
+    std = adding_year_month_cols(sample[['date_time', 'latitude', 'longitude', 'number_of_vehicles']].copy()) \
+        .groupby(keys, observed=True)['number_of_vehicles'].std().rename('std').reset_index()
+    density = density.merge(std, on=keys, how='left')
+    density['margin'] = utils.getting_z_score() * density.pop('std').fillna(0) / np.sqrt(density['count'])
+    return tensor, density
+
+
 def creating_heatmap_data(dat):
     """
     :param dat: dataframe
@@ -40,37 +173,193 @@ def creating_heatmap_data(dat):
     return data
 
 
+def creating_heatmap_tensor(dat, tensor=None, backend=None):
+    """
+    Builds the dense [year, month, weekday, hour] tensor of the city-wide number of vehicles in one pass.
+    If a tensor is given, the new data is added on top of it (incremental update for a new month).
+    :param dat: dataframe; raw traffic density data or the output of creating_heatmap_data
+    :param tensor: dict; keys are years, sum, count and mean
+    :param backend: string; pandas, duckdb or sqlite, config.aggregation_backend['tdh'] if it is None
+    :rtype: dict
+    """
+    backend = config.aggregation_backend['tdh'] if backend is None else backend
+    if backend == 'pandas':
+        # city-wide totals per date_time, it is a no-op for the output of creating_heatmap_data
+        data = dat[['date_time', 'number_of_vehicles']].groupby('date_time').sum()
+        dt = data.index
+        cells = pd.DataFrame({'year': dt.year, 'month': dt.month, 'weekday': dt.dayofweek, 'hour': dt.hour,
+                              'sum': data['number_of_vehicles'].values, 'count': 1})
+    else:
+        cells = sql_backend.creating_heatmap_cells(dat, backend)
+    years = np.unique(cells['year'].values)
+
+    if tensor is None:
+        tensor = {'years': years,
+                  'sum': np.zeros((len(years), 12, 7, 24), dtype=np.float64),
+                  'count': np.zeros((len(years), 12, 7, 24), dtype=np.int64)}
+    else:
+        # the year axis is extended when the new data belongs to a new year
+        all_years = np.union1d(tensor['years'], years)
+        old_idx = np.searchsorted(all_years, tensor['years'])
+        sum_ = np.zeros((len(all_years), 12, 7, 24), dtype=np.float64)
+        count_ = np.zeros((len(all_years), 12, 7, 24), dtype=np.int64)
+        sum_[old_idx] = tensor['sum']
+        count_[old_idx] = tensor['count']
+        tensor = {'years': all_years, 'sum': sum_, 'count': count_}
+
+    # weekday follows the pandas convention; Monday=0, Sunday=6
+    idx = (np.searchsorted(tensor['years'], cells['year'].values), cells['month'].values - 1,
+           cells['weekday'].values, cells['hour'].values)
+    np.add.at(tensor['sum'], idx, cells['sum'].values)
+    np.add.at(tensor['count'], idx, cells['count'].values)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        tensor['mean'] = np.where(tensor['count'] > 0, tensor['sum'] / tensor['count'], np.nan)
+    return tensor
+
+
+def fingerprinting_months(dat):
+    """
+    :param dat: dataframe; raw traffic density data or the output of creating_heatmap_data
+    :rtype: dict; number of hours & total number of vehicles by (year, month), which change with the source month
+    """
+    dt = dat['date_time'].dt
+    data = dat.groupby([dt.year.rename('year'), dt.month.rename('month')]) \
+        .agg(hours=('date_time', 'nunique'), vehicles=('number_of_vehicles', 'sum'))
+    return {(int(y), int(m)): (float(h), float(v)) for (y, m), (h, v) in zip(data.index, data.values.tolist())}
+
+
+def saving_heatmap_tensor(tensor, path=config.tdh_heatmap_tensor_path):
+    """
+    :param tensor: dict
+    :param path: string
+    :return: None
+    """
+    fingerprints = tensor.get('fingerprints', {})
+    np.savez_compressed(path, years=tensor['years'], sum=tensor['sum'], count=tensor['count'],
+                        fp_keys=np.array(list(fingerprints), dtype=np.int64).reshape(-1, 2),
+                        fp_values=np.array(list(fingerprints.values()), dtype=np.float64).reshape(-1, 2))
+
+
+def loading_heatmap_tensor(path=config.tdh_heatmap_tensor_path):
+    """
+    :param path: string
+    :rtype: dict or None
+    """
+    if not os.path.exists(path):
+        return None
+
+    with np.load(path) as f:
+        tensor = {'years': f['years'], 'sum': f['sum'], 'count': f['count']}
+        # the tensors saved without fingerprints have all their months replaced at the next update
+        tensor['fingerprints'] = {} if 'fp_keys' not in f.files else \
+            {tuple(k): tuple(v) for k, v in zip(f['fp_keys'].tolist(), f['fp_values'].tolist())}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        tensor['mean'] = np.where(tensor['count'] > 0, tensor['sum'] / tensor['count'], np.nan)
+    return tensor
+
+
+def getting_heatmap_tensor(dat, path=config.tdh_heatmap_tensor_path):
+    """
+    Loads the persisted tensor, replaces the months of the data which are new or changed at the source (their
+    cells are emptied and filled again from the data), keeps the other months and persists it again.
+    :param dat: dataframe
+    :param path: string
+    :rtype: dict
+    """
+    tensor = loading_heatmap_tensor(path)
+    fingerprints = fingerprinting_months(dat)
+    known = {} if tensor is None else tensor['fingerprints']
+    changed = {k: v for k, v in fingerprints.items() if known.get(k) != v}
+    if tensor is not None:
+        if not changed:
+            return tensor
+        for y, m in changed:
+            if y in tensor['years']:
+                i = int(np.searchsorted(tensor['years'], y))
+                tensor['sum'][i, m - 1] = 0
+                tensor['count'][i, m - 1] = 0
+        ym = dat['date_time'].dt.year.values * 100 + dat['date_time'].dt.month.values
+        dat = dat[np.isin(ym, [y * 100 + m for y, m in changed])]
+        logger.info('{0} month(s) of the heatmap tensor are replaced.'.format(len(changed)))
+
+    tensor = creating_heatmap_tensor(dat=dat, tensor=tensor)
+    tensor['fingerprints'] = {**known, **changed}
+    saving_heatmap_tensor(tensor, path)
+    return tensor
+
+
+def slicing_heatmap_tensor(tensor, year, month, hours=None, margin=False):
+    """
+    Average number of vehicles by day & hour; the years and months can be lists for multi-month comparisons.
+    :param tensor: dict
+    :param year: int or list
+    :param month: string or list
+    :param hours: list
+    :param margin: bool; if True, the half widths of the confidence intervals of the averages of a preview tensor
+    :rtype: dataframe; index is day, columns are hour
+    """
+    years = year if isinstance(year, list) else [year]
+    months = month if isinstance(month, list) else [month]
+    y_idx = [int(np.searchsorted(tensor['years'], y)) for y in years
+             if y in tensor['years']]
+    m_idx = [config.months[m] - 1 for m in months]
+
+    sum_ = tensor['sum'][np.ix_(y_idx, m_idx)].sum(axis=(0, 1))
+    count_ = tensor['count'][np.ix_(y_idx, m_idx)].sum(axis=(0, 1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_ = np.where(count_ > 0, sum_ / count_, np.nan)
+        if margin is True:
+            # the averages are means of independently estimated hourly totals, so their variances add up
+            var_ = tensor['variance'][np.ix_(y_idx, m_idx)].sum(axis=(0, 1))
+            mean_ = np.where(count_ > 0, utils.getting_z_score() * np.sqrt(var_) / count_, np.nan)
+
+    df = pd.DataFrame(mean_, index=config.weekdays, columns=config.hours)
+    if hours is not None:
+        df = df[hours]
+    return df.dropna(axis=0, how='all').dropna(axis=1, how='all').rename_axis(index='day', columns='hour')
+
+
 def df_to_plotly_heatmap_data(df):
     """
     :param df: dataframe
     :rtype: dict
     """
-    return {'z': df.values.tolist(), 'x': df.columns.tolist(), 'y': df.index.tolist()}
+    return {'z': df.values, 'x': df.columns.tolist(), 'y': df.index.tolist()}
 
 
-def creating_heatmap_graph(df, year, month):
+def creating_heatmap_graph(df, year, month, tensor=None):
     """
     :param df: dataframe
     :param year: int
     :param month: string
+    :param tensor: dict; if it is given, the pivot data is sliced from the heatmap tensor
     :return: Plotly Heatmap Graph
     """
-    df_ = df[(df['year'] == year) & (df['month'] == month)].reset_index(drop=True)
+    if tensor is not None:
+        df_pivot = round(slicing_heatmap_tensor(tensor=tensor, year=year, month=month), 4)
+    else:
+        df_ = df[(df['year'] == year) & (df['month'] == month)].reset_index(drop=True)
 
-    # grouping
-    df_grouped = df_[['day', 'hour', 'number_of_vehicles']] \
-        .groupby(['day', 'hour']).mean().reset_index() \
-        .rename(columns={'number_of_vehicles': 'avg_number_of_vehicles'})
+        # grouping
+        df_grouped = df_[['day', 'hour', 'number_of_vehicles']] \
+            .groupby(['day', 'hour']).mean().reset_index() \
+            .rename(columns={'number_of_vehicles': 'avg_number_of_vehicles'})
 
-    # rounding
-    df_grouped['avg_number_of_vehicles'] = round(df_grouped['avg_number_of_vehicles'], 4)
+        # rounding
+        df_grouped['avg_number_of_vehicles'] = round(df_grouped['avg_number_of_vehicles'], 4)
 
-    # creating pivot data
-    df_pivot = pd.pivot_table(data=df_grouped, values='avg_number_of_vehicles', index='day', columns='hour')
+        # creating pivot data
+        df_pivot = pd.pivot_table(data=df_grouped, values='avg_number_of_vehicles', index='day', columns='hour')
 
     # vis
     fig = go.Figure(data=go.Heatmap(df_to_plotly_heatmap_data(df_pivot.reindex(config.days)),
                                     colorbar=dict(title='Avg Number of Vehicles')))
+    if tensor is not None and 'variance' in tensor:
+        df_margin = round(slicing_heatmap_tensor(tensor=tensor, year=year, month=month, margin=True), 4)
+        fig.update_traces(customdata=df_margin.reindex(index=config.days, columns=df_pivot.columns).values,
+                          hovertemplate='Day: %{y}<br>Hour: %{x}<br>Avg Number of Vehicles: %{z} ± %{customdata} '
+                                        + '[{0:.0%} CI]<extra></extra>'.format(config.preview_confidence))
 
     # arrangements
     fig.update_layout(
@@ -92,8 +381,30 @@ def creating_heatmap_graph(df, year, month):
     return fig
 
 
+def creating_annotated_heatmap_pivot(tensor, year, month, annotation_type, htype='day', hours=None):
+    """
+    Tensor counterpart of the grouping part of creating_annotated_heatmap.
+    :param tensor: dict
+    :param year: int
+    :param month: string
+    :param annotation_type: string; Number or Percentage
+    :param htype: string; day or hour
+    :param hours: list
+    :rtype: dataframe
+    """
+    df_mean = slicing_heatmap_tensor(tensor=tensor, year=year, month=month, hours=hours)
+
+    if annotation_type == 'Number':
+        return round(df_mean.T, 2)
+    if htype == 'hour':
+        # percentage of each day within the hour
+        return round(100 * df_mean / df_mean.sum(axis=0), 2)
+    # percentage of each hour within the day
+    return round(100 * df_mean.T / df_mean.T.sum(axis=0), 2)
+
+
 def creating_annotated_heatmap(df, year, month, annotation_type, htype='day', is_rush_hour=False,
-                               rush_hour_type='Morning'):
+                               rush_hour_type='Morning', tensor=None):
     """
     :param df: dataframe
     :param year: int
@@ -102,9 +413,12 @@ def creating_annotated_heatmap(df, year, month, annotation_type, htype='day', is
     :param htype: string; day or hour
     :param is_rush_hour: bool
     :param rush_hour_type: string; Morning or Evening
+    :param tensor: dict; if it is given, the pivot data is sliced from the heatmap tensor
     :return: Plotly Annotated Heatmap Graph
     """
-    if is_rush_hour is True:
+    if tensor is not None:
+        df_ = None
+    elif is_rush_hour is True:
         df_pre = df[(df['year'] == year) & (df['month'] == month)].reset_index(drop=True)
         if rush_hour_type == 'Evening':
             df_ = df_pre[df_pre['hour'].isin(config.tdh_evening_rush_hours)].reset_index(drop=True)
@@ -120,7 +434,22 @@ def creating_annotated_heatmap(df, year, month, annotation_type, htype='day', is
         # title
         title_ = 'Traffic Density Heatmap by Day & Hour [{0} - {1}]'.format(month, year)
         cb_title = 'Avg Number of Vehicles'
+    else:  # Percentage
+        cb_title = '[Pct] Avg Number of Vehicles'
+        if htype == 'hour':
+            axis_ = 'index'
+            days_ = config.days
+            title_ = 'Traffic Density Heatmap // Percentage by Hour [{0} - {1}]'.format(month, year)
+        else:
+            title_ = 'Traffic Density Heatmap // Percentage by Day [{0} - {1}]'.format(month, year)
 
+    if tensor is not None:
+        hours_ = None
+        if is_rush_hour is True:
+            hours_ = config.tdh_evening_rush_hours if rush_hour_type == 'Evening' else config.tdh_morning_rush_hours
+        df_pivot = creating_annotated_heatmap_pivot(tensor=tensor, year=year, month=month,
+                                                    annotation_type=annotation_type, htype=htype, hours=hours_)
+    elif annotation_type == 'Number':
         # grouping
         df_grouped = df_[['day', 'hour', 'number_of_vehicles']] \
             .groupby(['day', 'hour']).mean().reset_index() \
@@ -129,14 +458,7 @@ def creating_annotated_heatmap(df, year, month, annotation_type, htype='day', is
         # creating pivot data
         df_pivot = pd.pivot_table(data=df_grouped, values='avg_number_of_vehicles', index='hour', columns='day')
     else:  # Percentage
-        cb_title = '[Pct] Avg Number of Vehicles'
-
         if htype == 'hour':
-            axis_ = 'index'
-            days_ = config.days
-            # title
-            title_ = 'Traffic Density Heatmap // Percentage by Hour [{0} - {1}]'.format(month, year)
-
             # grouping
             dfg = df_[['hour', 'day', 'number_of_vehicles']] \
                 .groupby(['hour', 'day']) \
@@ -148,8 +470,6 @@ def creating_annotated_heatmap(df, year, month, annotation_type, htype='day', is
             # creating pivot data
             df_pivot = pd.pivot_table(data=df_grouped, values='avg_number_of_vehicles', index='day', columns='hour')
         else:
-            title_ = 'Traffic Density Heatmap // Percentage by Day [{0} - {1}]'.format(month, year)
-
             # grouping
             df_grouped = pd.DataFrame()
             for d in days_:
@@ -170,6 +490,11 @@ def creating_annotated_heatmap(df, year, month, annotation_type, htype='day', is
                                          y=df_to_plotly_heatmap_data(df_pivot.reindex(days_, axis=axis_))['y'],
                                          showscale=True, colorbar=dict(title=cb_title))
     # fig = go.FigureWidget(ff_fig)
+    if tensor is not None and 'variance' in tensor and annotation_type == 'Number':
+        df_margin = round(slicing_heatmap_tensor(tensor=tensor, year=year, month=month, hours=hours_, margin=True).T, 2)
+        ff_fig.update_traces(customdata=df_margin.reindex(index=df_pivot.index, columns=days_).values,
+                             hovertemplate='Day: %{x}<br>Hour: %{y}<br>Avg Number of Vehicles: %{z} ± %{customdata} '
+                                           + '[{0:.0%} CI]<extra></extra>'.format(config.preview_confidence))
 
     # arrangements
     if htype == 'hour':
@@ -202,23 +527,34 @@ def creating_annotated_heatmap(df, year, month, annotation_type, htype='day', is
     return ff_fig
 
 
-def creating_density_mapbox(dat, year, month):
+def creating_density_mapbox(dat, year, month, is_aggregated=False):
     """
     :param dat: dataframe
     :param year: int
     :param month: string
+    :param is_aggregated: bool; True if dat is the output of creating_density_map_data
     :return: Plotly Density Mapbox
     """
-    # data preparation
-    data = dat[['date_time', 'longitude', 'latitude', 'number_of_vehicles']]
-    data['year'] = data['date_time'].apply(lambda row: row.year)
-    data['month'] = data['date_time'].apply(lambda row: row.month_name())
-
-    # data selection
-    df = data[(data['year'] == year) & (data['month'] == month)][
-        ['latitude', 'longitude', 'number_of_vehicles']].reset_index(drop=True)
-    df_ = df.groupby(['latitude', 'longitude']).mean().reset_index().rename(
-        columns={'number_of_vehicles': 'avg_number_of_vehicles'})
+    hover_data = {'latitude': False, 'longitude': False, 'avg_number_of_vehicles': True}
+    if is_aggregated is True:
+        # the preview data has the half widths of the confidence intervals of the means
+        cols = ['latitude', 'longitude', 'mean'] + (['margin'] if 'margin' in dat.columns else [])
+        df_ = dat[(dat['year'] == year) & (dat['month'] == month)][cols] \
+            .reset_index(drop=True).rename(columns={'mean': 'avg_number_of_vehicles'})
+        if 'margin' in cols:
+            df_['margin'] = round(df_['margin'], 2)
+            hover_data['margin'] = True
+    else:
+        # data preparation
+        data = dat[['date_time', 'longitude', 'latitude', 'number_of_vehicles']]
+        data['year'] = data['date_time'].apply(lambda row: row.year)
+        data['month'] = data['date_time'].apply(lambda row: row.month_name())
+
+        # data selection
+        df = data[(data['year'] == year) & (data['month'] == month)][
+            ['latitude', 'longitude', 'number_of_vehicles']].reset_index(drop=True)
+        df_ = df.groupby(['latitude', 'longitude']).mean().reset_index().rename(
+            columns={'number_of_vehicles': 'avg_number_of_vehicles'})
     df_['avg_number_of_vehicles'] = round(df_['avg_number_of_vehicles'], 2)
 
     # vis
@@ -226,8 +562,9 @@ def creating_density_mapbox(dat, year, month):
                             radius=13, zoom=8.12, height=650, center=dict(lat=41.10, lon=28.70),
                             mapbox_style="carto-positron",
                             title='Density Map of Average Vehicle Count by Month [{0} - {1}]'.format(month, year),
-                            labels={'avg_number_of_vehicles': 'Avg Number of Vehicle'},
-                            hover_data={'latitude': False, 'longitude': False, 'avg_number_of_vehicles': True})
+                            labels={'avg_number_of_vehicles': 'Avg Number of Vehicle',
+                                    'margin': '± [{0:.0%} CI]'.format(config.preview_confidence)},
+                            hover_data=hover_data)
     fig.update_layout(width=900, height=650)
     return fig
 
@@ -236,77 +573,87 @@ def main():
     """
     :return: Plotly Figure
     """
-    df = data_preparation()
+    tensor, density = preparing_aggregates()
 
     # The localhost page is opened on the Internet browser.
     # Each plot is presented in a separate browser tab.
-    data = creating_heatmap_data(dat=df)
     for m in config.tdh_months:
         for y in config.tdh_years:
-            creating_heatmap_graph(df=data.copy(), year=y, month=m)
-            creating_annotated_heatmap(df=data.copy(), year=y, month=m, annotation_type='Number')
-            # creating_annotated_heatmap(df=data.copy(), year=y, month=m, annotation_type='Number', is_rush_hour=True)
-            # creating_annotated_heatmap(df=data.copy(), year=y, month=m, annotation_type='Number', is_rush_hour=True,
-            #                            rush_hour_type='Evening')
-            creating_annotated_heatmap(df=data.copy(), year=y, month=m, annotation_type='Percentage')
-            creating_annotated_heatmap(df=data.copy(), year=y, month=m, annotation_type='Percentage', htype='hour')
-            creating_density_mapbox(dat=df, year=y, month=m)
-
-
-def putting_into_streamlit():
+            creating_heatmap_graph(df=None, year=y, month=m, tensor=tensor)
+            creating_annotated_heatmap(df=None, year=y, month=m, annotation_type='Number', tensor=tensor)
+            # creating_annotated_heatmap(df=None, year=y, month=m, annotation_type='Number', is_rush_hour=True,
+            #                            tensor=tensor)
+            # creating_annotated_heatmap(df=None, year=y, month=m, annotation_type='Number', is_rush_hour=True,
+            #                            rush_hour_type='Evening', tensor=tensor)
+            creating_annotated_heatmap(df=None, year=y, month=m, annotation_type='Percentage', tensor=tensor)
+            creating_annotated_heatmap(df=None, year=y, month=m, annotation_type='Percentage', htype='hour',
+                                       tensor=tensor)
+            creating_density_mapbox(dat=density, year=y, month=m, is_aggregated=True)
+
+
+def putting_into_streamlit(tensor=None, density=None):
     """
+    :param tensor: dict; heatmap tensor, both aggregates are prepared here if it is None
+    :param density: dataframe; density map data
     :return: None
     """
-    df = data_preparation()
+    import streamlit as st
+
+    if tensor is None:
+        tensor, density = preparing_aggregates()
     st.markdown("## **:car: Hourly Traffic Density Data Visualization**")
-    data = creating_heatmap_data(dat=df)
     for m in config.tdh_months:
         for y in config.tdh_years:
-            st.write(creating_heatmap_graph(df=data.copy(), year=y, month=m))
+            figure_encoding.writing_to_streamlit(creating_heatmap_graph(df=None, year=y, month=m, tensor=tensor))
+    # the percentages of a preview have no confidence intervals, they wait for the exact data set
+    annotations = [('Number', 'day')] if 'variance' in tensor else \
+        [('Number', 'day'), ('Percentage', 'day'), ('Percentage', 'hour')]
     # Loop was repeated for graph order in Streamlit
     for m in config.tdh_months:
         for y in config.tdh_years:
-            st.write(creating_annotated_heatmap(df=data.copy(), year=y, month=m, annotation_type='Number'))
-            st.write(creating_annotated_heatmap(df=data.copy(), year=y, month=m, annotation_type='Percentage'))
-            st.write(
-                creating_annotated_heatmap(df=data.copy(), year=y, month=m, annotation_type='Percentage', htype='hour'))
+            for annotation_type, htype in annotations:
+                figure_encoding.writing_to_streamlit(creating_annotated_heatmap(df=None, year=y, month=m,
+                                                                                annotation_type=annotation_type,
+                                                                                htype=htype, tensor=tensor))
     # Loop was repeated for graph order in Streamlit
     for m in config.tdh_months:
         for y in config.tdh_years:
-            st.write(creating_density_mapbox(dat=df, year=y, month=m))
+            figure_encoding.writing_to_streamlit(creating_density_mapbox(dat=density, year=y, month=m,
+                                                                         is_aggregated=True))
 
 
 def putting_into_datapane():
     """
     :return: None
     """
+    import datapane as dp
+
     # getting token
     dp.login(config.dp_token)
 
     # getting data
-    df = data_preparation()
-    data = creating_heatmap_data(dat=df)
+    tensor, density = preparing_aggregates()
 
     # heatmap
-    hplot1 = creating_heatmap_graph(df=data.copy(), year=2020, month='January')
+    hplot1 = creating_heatmap_graph(df=None, year=2020, month='January', tensor=tensor)
     hp1 = dp.Page(title='January 2020', blocks=[hplot1])
-    hplot2 = creating_heatmap_graph(df=data.copy(), year=2021, month='January')
+    hplot2 = creating_heatmap_graph(df=None, year=2021, month='January', tensor=tensor)
     hp2 = dp.Page(title='January 2021', blocks=[hplot2])
     dp.Report(hp1, hp2).publish(name='Traffic Density Heatmap', open=True)
 
     # annotated heatmap
-    ahplot1 = creating_annotated_heatmap(df=data.copy(), year=2020, month='February', annotation_type='Number',
-                                         is_rush_hour=True, rush_hour_type='Evening')
+    ahplot1 = creating_annotated_heatmap(df=None, year=2020, month='February', annotation_type='Number',
+                                         is_rush_hour=True, rush_hour_type='Evening', tensor=tensor)
     ahp1 = dp.Page(title='February 2020', blocks=[ahplot1])
-    ahplot2 = creating_annotated_heatmap(df=data.copy(), year=2021, month='February', annotation_type='Number',
-                                         is_rush_hour=True, rush_hour_type='Evening')
+    ahplot2 = creating_annotated_heatmap(df=None, year=2021, month='February', annotation_type='Number',
+                                         is_rush_hour=True, rush_hour_type='Evening', tensor=tensor)
     ahp2 = dp.Page(title='February 2021', blocks=[ahplot2])
     dp.Report(ahp1, ahp2).publish(name='Traffic Density Annotated Heatmap', open=True)
 
     # density mapbox
-    dmplot1 = creating_density_mapbox(dat=df, year=2020, month='January')
+    dmplot1 = creating_density_mapbox(dat=density, year=2020, month='January', is_aggregated=True)
     dmp1 = dp.Page(title='January 2020', blocks=[dmplot1])
-    dmplot2 = creating_density_mapbox(dat=df, year=2021, month='January')
+    dmplot2 = creating_density_mapbox(dat=density, year=2021, month='January', is_aggregated=True)
     dmp2 = dp.Page(title='January 2021', blocks=[dmplot2])
     dp.Report(dmp1, dmp2).publish(name='Density Map of Average Vehicle Count', open=True)
 
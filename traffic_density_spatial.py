@@ -0,0 +1,162 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import config
+import logging
+import numpy as np
+import pandas as pd
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger('IMM Data Visualization - Traffic Density Spatial Index')
+
+earth_radius_km = 6371.0088
+
+
+def creating_spatial_index(locations, cell_size=config.tdh_grid_cell_size):
+    """
+    Uniform grid index over the distinct measurement locations. The locations are sorted by their cell id,
+    so every grid column (same latitude cell) is a contiguous slice that is found with a binary search.
+    :param locations: dataframe; latitude & longitude columns, e.g. traffic_density_store.loading_locations() or the
+                      density map data
+    :param cell_size: float; degree
+    :rtype: dict
+    """
+    locations = locations.drop_duplicates(['latitude', 'longitude']).reset_index(drop=True)
+    if 'row' not in locations.columns:
+        locations['row'] = np.arange(len(locations))
+
+    lat = locations['latitude'].values.astype(np.float64)
+    lon = locations['longitude'].values.astype(np.float64)
+    if len(locations) == 0:
+        # no cells, every query finds nothing
+        return {'locations': locations, 'lat': lat, 'lon': lon, 'origin': (0.0, 0.0), 'cell_size': cell_size,
+                'nx': 0, 'ny': 0, 'order': np.array([], dtype=np.int64), 'cell_id': np.array([], dtype=np.int64)}
+
+    origin = (lat.min(), lon.min())
+    ix = np.floor((lat - origin[0]) / cell_size).astype(np.int64)
+    iy = np.floor((lon - origin[1]) / cell_size).astype(np.int64)
+    ny = int(iy.max()) + 1
+    cell_id = ix * ny + iy
+    order = np.argsort(cell_id, kind='stable')
+
+    return {'locations': locations, 'lat': lat, 'lon': lon, 'origin': origin, 'cell_size': cell_size,
+            'nx': int(ix.max()) + 1, 'ny': ny, 'order': order, 'cell_id': cell_id[order]}
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """
+    :param lat1: float or numpy array
+    :param lon1: float or numpy array
+    :param lat2: float or numpy array
+    :param lon2: float or numpy array
+    :rtype: float or numpy array
+    """
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * earth_radius_km * np.arcsin(np.sqrt(a))
+
+
+def finding_candidates(index, min_lat, min_lon, max_lat, max_lon):
+    """
+    :param index: dict
+    :param min_lat: float
+    :param min_lon: float
+    :param max_lat: float
+    :param max_lon: float
+    :rtype: numpy array; positions of the locations in the cells that intersect the bounding box
+    """
+    size = index['cell_size']
+    x0 = max(int(np.floor((min_lat - index['origin'][0]) / size)), 0)
+    x1 = min(int(np.floor((max_lat - index['origin'][0]) / size)), index['nx'] - 1)
+    y0 = max(int(np.floor((min_lon - index['origin'][1]) / size)), 0)
+    y1 = min(int(np.floor((max_lon - index['origin'][1]) / size)), index['ny'] - 1)
+    if x0 > x1 or y0 > y1:
+        return np.array([], dtype=np.int64)
+
+    xs = np.arange(x0, x1 + 1)
+    starts = np.searchsorted(index['cell_id'], xs * index['ny'] + y0, side='left')
+    ends = np.searchsorted(index['cell_id'], xs * index['ny'] + y1, side='right')
+    return np.concatenate([index['order'][s:e] for s, e in zip(starts, ends)])
+
+
+def querying_bbox(index, min_lat, min_lon, max_lat, max_lon):
+    """
+    :param index: dict
+    :param min_lat: float
+    :param min_lon: float
+    :param max_lat: float
+    :param max_lon: float
+    :rtype: dataframe; locations in the bounding box
+    """
+    pos = finding_candidates(index, min_lat, min_lon, max_lat, max_lon)
+    lat, lon = index['lat'][pos], index['lon'][pos]
+    pos = pos[(lat >= min_lat) & (lat <= max_lat) & (lon >= min_lon) & (lon <= max_lon)]
+    return index['locations'].iloc[np.sort(pos)].reset_index(drop=True)
+
+
+def querying_radius(index, latitude, longitude, radius_km):
+    """
+    :param index: dict
+    :param latitude: float
+    :param longitude: float
+    :param radius_km: float
+    :rtype: dataframe; locations within the radius, sorted by distance
+    """
+    d_lat = np.degrees(radius_km / earth_radius_km)
+    d_lon = d_lat / max(np.cos(np.radians(latitude)), 1e-12)
+    pos = finding_candidates(index, latitude - d_lat, longitude - d_lon, latitude + d_lat, longitude + d_lon)
+    dist = haversine_km(latitude, longitude, index['lat'][pos], index['lon'][pos])
+    mask = dist <= radius_km
+    order = np.argsort(dist[mask], kind='stable')
+    return index['locations'].iloc[pos[mask][order]].assign(distance_km=dist[mask][order]).reset_index(drop=True)
+
+
+def querying_knn(index, latitude, longitude, k=5):
+    """
+    The search radius is doubled until k locations are found inside it.
+    :param index: dict
+    :param latitude: float
+    :param longitude: float
+    :param k: int
+    :rtype: dataframe; k nearest locations, sorted by distance
+    """
+    k = min(k, len(index['lat']))
+    radius_km = np.radians(index['cell_size']) * earth_radius_km
+    while True:
+        found = querying_radius(index, latitude, longitude, radius_km)
+        if len(found) >= k:
+            return found.head(k)
+        radius_km *= 2
+
+
+def aggregating_vehicle_counts(store, locations, start, end, col='number_of_vehicles'):
+    """
+    Aggregates the values of the given locations for the time window [start, end) from the location store.
+    :param store: dict; traffic_density_store.opening_location_store()
+    :param locations: dataframe; output of the queries, it should have the row column
+    :param start: string or timestamp
+    :param end: string or timestamp
+    :param col: string
+    :rtype: dataframe; sum, count of the observed hours and mean for each location
+    """
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    rows = locations['row'].values
+    sum_ = np.zeros(len(rows))
+    count_ = np.zeros(len(rows), dtype=np.int64)
+    for m, arrays in sorted(store['months'].items()):
+        arr = arrays[col]
+        month_start = pd.Timestamp(m)
+        h0 = int(max((start - month_start) / pd.Timedelta(hours=1), 0))
+        h1 = int(min(np.ceil((end - month_start) / pd.Timedelta(hours=1)), arr.shape[1]))
+        if h0 >= h1:
+            continue
+        inside = rows < arr.shape[0]
+        values = arr[rows[inside], h0:h1]
+        sum_[inside] += np.nansum(values, axis=1)
+        count_[inside] += (~np.isnan(values)).sum(axis=1)
+
+    df = locations.copy()
+    df['sum_{0}'.format(col)] = sum_
+    df['count'] = count_
+    df['avg_{0}'.format(col)] = np.where(count_ > 0, sum_ / np.maximum(count_, 1), np.nan)
+    return df
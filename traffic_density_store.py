@@ -0,0 +1,237 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import config
+import json
+import logging
+import numpy as np
+import os
+import pandas as pd
+import traffic_density_hourly
+import utils
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger('IMM Data Visualization - Traffic Density Store')
+
+# The store keeps one directory per month (YYYY-MM) with a location x hour array for each value column.
+# The rows of the arrays are given by the location dictionary (locations.csv), which is append-only,
+# so a location keeps its row in every month. Arrays of older months can have fewer rows than the dictionary;
+# the missing rows are treated as NaN.
+store_cols = ['number_of_vehicles', 'average_speed']
+
+
+def loading_locations(path=config.tdh_store_dir):
+    """
+    :param path: string
+    :rtype: dataframe; geohash, latitude, longitude and row of each location
+    """
+    file_ = os.path.join(path, 'locations.csv')
+    if not os.path.exists(file_):
+        return pd.DataFrame({'geohash': pd.Series(dtype=object), 'latitude': pd.Series(dtype=np.float64),
+                             'longitude': pd.Series(dtype=np.float64), 'row': pd.Series(dtype=np.int64)})
+    return pd.read_csv(file_)
+
+
+def updating_locations(dat, path=config.tdh_store_dir):
+    """
+    Appends the locations which are not in the dictionary yet.
+    :param dat: dataframe; it should have geohash, latitude and longitude columns
+    :param path: string
+    :rtype: dataframe
+    """
+    locations = loading_locations(path)
+    new_ = dat[['geohash', 'latitude', 'longitude']].drop_duplicates('geohash')
+    new_ = new_[~new_['geohash'].isin(locations['geohash'])].reset_index(drop=True)
+    if len(new_) > 0:
+        new_['row'] = np.arange(len(locations), len(locations) + len(new_))
+        locations = pd.concat([locations, new_], ignore_index=True)
+        locations.to_csv(os.path.join(path, 'locations.csv'), index=False)
+    return locations
+
+
+def opening_month_array(path, month, col, n_rows, n_hours):
+    """
+    Opens the array of the month for writing, it is grown when the location dictionary has more rows.
+    :param path: string
+    :param month: string; YYYY-MM
+    :param col: string
+    :param n_rows: int
+    :param n_hours: int
+    :rtype: numpy memmap
+    """
+    month_dir = os.path.join(path, month)
+    os.makedirs(month_dir, exist_ok=True)
+    file_ = os.path.join(month_dir, '{0}.npy'.format(col))
+
+    old = np.load(file_, mmap_mode='r') if os.path.exists(file_) else None
+    if old is not None and old.shape[0] >= n_rows:
+        return np.lib.format.open_memmap(file_, mode='r+')
+
+    arr = np.lib.format.open_memmap(file_ + '.tmp', mode='w+', dtype=np.float32, shape=(n_rows, n_hours))
+    arr[:] = np.nan
+    if old is not None:
+        arr[:old.shape[0]] = old
+        del old
+    arr.flush()
+    del arr
+    os.replace(file_ + '.tmp', file_)
+    return np.lib.format.open_memmap(file_, mode='r+')
+
+
+def writing_partition(dat, path=config.tdh_store_dir):
+    """
+    Writes a prepared partition (see traffic_density_hourly.preparing_partition) into the store.
+    A month can be written in several partitions.
+    :param dat: dataframe
+    :param path: string
+    :return: None
+    """
+    os.makedirs(path, exist_ok=True)
+    if 'geohash' not in dat.columns:
+        dat['geohash'] = dat['latitude'].round(6).astype(str) + '_' + dat['longitude'].round(6).astype(str)
+    locations = updating_locations(dat, path)
+    rows = dat['geohash'].map(pd.Series(locations['row'].values, index=locations['geohash'])).values
+
+    month_start = dat['date_time'].values.astype('datetime64[M]')
+    for m in np.unique(month_start):
+        mask = month_start == m
+        start = m.astype('datetime64[h]')
+        n_hours = int(((m + 1).astype('datetime64[h]') - start).astype(np.int64))
+        hours = (dat['date_time'].values[mask].astype('datetime64[h]') - start).astype(np.int64)
+        for col in store_cols:
+            arr = opening_month_array(path, str(m), col, len(locations), n_hours)
+            arr[rows[mask], hours] = dat[col].values[mask]
+            arr.flush()
+            del arr
+
+
+def building_location_store(path=config.tdh_store_dir, chunksize=config.tdh_chunk_size):
+    """
+    Builds the store from config.traffic_density_data_url_list, one partition at a time.
+    :param path: string
+    :param chunksize: int
+    :return: None
+    """
+    for part in utils.iterating_raw_data(dat_name='tdh', chunksize=chunksize):
+        writing_partition(traffic_density_hourly.preparing_partition(part), path)
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'cols': store_cols, 'months': listing_months(path)}, f)
+
+
+def listing_months(path=config.tdh_store_dir):
+    """
+    :param path: string
+    :rtype: list
+    """
+    return sorted(d for d in os.listdir(path) if os.path.isdir(os.path.join(path, d)))
+
+
+def opening_location_store(path=config.tdh_store_dir):
+    """
+    Opens every array read-only with memory mapping, so that processes share one copy of the data via page cache.
+    :param path: string
+    :rtype: dict
+    """
+    locations = loading_locations(path)
+    store = {'locations': locations,
+             'rows': pd.Series(locations['row'].values, index=locations['geohash']),
+             'months': {}}
+    for m in listing_months(path):
+        store['months'][m] = {col: np.load(os.path.join(path, m, '{0}.npy'.format(col)), mmap_mode='r')
+                              for col in store_cols}
+    return store
+
+
+def finding_location_row(store, geohash=None, latitude=None, longitude=None):
+    """
+    :param store: dict
+    :param geohash: string
+    :param latitude: float
+    :param longitude: float
+    :rtype: int; the row of the geohash or the nearest location to the coordinates
+    """
+    if geohash is not None:
+        return int(store['rows'][geohash])
+    loc = store['locations']
+    dist = (loc['latitude'].values - latitude) ** 2 + (loc['longitude'].values - longitude) ** 2
+    return int(loc['row'].values[np.argmin(dist)])
+
+
+def getting_month_row(store, month, row, col='number_of_vehicles'):
+    """
+    :param store: dict
+    :param month: string; YYYY-MM
+    :param row: int
+    :param col: string
+    :rtype: numpy array; zero-copy view of the memory mapped array
+    """
+    arr = store['months'][month][col]
+    if row >= arr.shape[0]:
+        # the location was added to the dictionary after this month was written
+        return np.full(arr.shape[1], np.nan, dtype=arr.dtype)
+    return arr[row]
+
+
+def getting_location_series(store, geohash=None, latitude=None, longitude=None, col='number_of_vehicles',
+                            months=None):
+    """
+    :param store: dict
+    :param geohash: string
+    :param latitude: float
+    :param longitude: float
+    :param col: string
+    :param months: list; all months if it is None
+    :rtype: series; hourly values of the location
+    """
+    row = finding_location_row(store, geohash=geohash, latitude=latitude, longitude=longitude)
+    months = sorted(store['months']) if months is None else months
+    series = []
+    for m in months:
+        values = getting_month_row(store, m, row, col)
+        series.append(pd.Series(values, index=pd.date_range(m, periods=len(values), freq='H')))
+    return pd.concat(series).rename(col)
+
+
+def creating_hourly_profile(store, geohash=None, latitude=None, longitude=None, col='number_of_vehicles',
+                            months=None):
+    """
+    :param store: dict
+    :param geohash: string
+    :param latitude: float
+    :param longitude: float
+    :param col: string
+    :param months: list
+    :rtype: series; average value by hour of the day
+    """
+    s = getting_location_series(store, geohash=geohash, latitude=latitude, longitude=longitude, col=col,
+                                months=months)
+    return s.groupby(s.index.hour).mean().rename_axis('hour')
+
+
+def comparing_months(store, month_a, month_b, col='number_of_vehicles', n=10):
+    """
+    Finds the locations whose average changed most between two months, e.g. year over year.
+    :param store: dict
+    :param month_a: string; YYYY-MM
+    :param month_b: string; YYYY-MM
+    :param col: string
+    :param n: int
+    :rtype: dataframe
+    """
+    loc = store['locations'].set_index('row')
+    means = []
+    for m in [month_a, month_b]:
+        arr = store['months'][m][col]
+        count_ = (~np.isnan(arr)).sum(axis=1)
+        mean_ = np.full(len(loc), np.nan)
+        mean_[:arr.shape[0]] = np.where(count_ > 0, np.nansum(arr, axis=1) / np.maximum(count_, 1), np.nan)
+        means.append(mean_)
+
+    df = loc.assign(avg_a=means[0], avg_b=means[1]).dropna(subset=['avg_a', 'avg_b'])
+    df['change'] = df['avg_b'] - df['avg_a']
+    df['pct_change'] = round(100 * df['change'] / df['avg_a'], 2)
+    return df.reindex(df['change'].abs().sort_values(ascending=False).index).head(n).reset_index()
+
+
+if __name__ == "__main__":
+    building_location_store()
@@ -2,14 +2,31 @@
 # -*- coding: utf-8 -*-
 
 import config
+import contextlib
+import functools
 import io
+import json
+import lazy_imports
 import logging
+import numpy as np
+import os
 import pandas as pd
-import requests
+import re
+import shutil
+import sql_backend
+import statistics
+import threading
+
+requests = lazy_imports.importing_lazily('requests')  # only the downloads need it, not the cached & stored data
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger('IMM Data Visualization - Util Functions')
 
+# one parsed copy of each data set per process, shared by the modules; the lock of the data set is held while its
+# copy is read or replaced, so the threads of the process parse it only once
+dataset_cache = {}
+dataset_locks = {k: threading.Lock() for k in config.datasets}
+
 
 def getting_raw_data(dat_name, url_list=False):
     """
@@ -20,24 +37,827 @@ def getting_raw_data(dat_name, url_list=False):
     # The data were taken automatically by using the URL instead of downloading manually because it is updated.
     # Footnote: The data are generally 45 days behind and are updated daily.
     if url_list is True:
-        if dat_name == 'pth':
-            url_list = config.public_transport_data_url_list
-        else:
-            url_list = config.traffic_density_data_url_list
-
         dat = pd.DataFrame()
-        for u in url_list:
+        for u in getting_data_url(dat_name):
             s = requests.get(u).content
             dat = dat.append(pd.read_csv(io.StringIO(s.decode('utf-8'))))
         return dat
 
-    if dat_name == 'dor':
-        url = config.dam_occ_rates_data_url
-    elif dat_name == 'wnu':
-        url = config.wifi_new_user_data_url
-    else:
-        url = config.traffic_announcements_url
+    if config.refresh_mode == 'incremental' and dat_name in config.refresh_datasets:
+        with locking_file(os.path.join(config.refresh_dir, dat_name + '.lock')):
+            refreshing_raw_data(dat_name)
+            return loading_raw_store(dat_name)
 
-    s = requests.get(url).content
+    s = requests.get(getting_data_url(dat_name)).content
     return pd.read_csv(io.StringIO(s.decode('utf-8')))
 
+
+def getting_data_url(dat_name):
+    """
+    :param dat_name: string; a key of config.datasets
+    :rtype: string or list; list of monthly URLs for the partitioned data sets
+    """
+    return config.datasets[dat_name]['url']
+
+
+def applying_schema(dat, dat_name):
+    """
+    Drops _id, names the columns as declared in the catalog and parses the timestamp columns;
+    a dataframe that already has the schema is left as it is.
+    :param dat: dataframe; raw records
+    :param dat_name: string
+    :rtype: dataframe
+    """
+    spec = config.datasets[dat_name]
+    dat = dat.drop(columns=[c for c in dat.columns if c.lstrip('\ufeff') == '_id'])
+    dat.columns = [c.lower() for c in dat.columns] if spec['columns'] is None else spec['columns']
+    cols = [c for c in spec['date_cols'] if not pd.api.types.is_datetime64_any_dtype(dat[c])]
+    if cols:
+        parsing_datetime(dat, cols, length=spec['date_length'])
+    return dat
+
+
+def loading_fetch_time(path):
+    """
+    :param path: string; snapshot
+    :rtype: Timestamp; download time of the snapshot from its sidecar file, None if there is no sidecar
+    """
+    if not os.path.exists(path + '.json'):
+        return None
+    with open(path + '.json') as f:
+        return pd.Timestamp(json.load(f)['fetched_at'])
+
+
+def saving_snapshot(raw, dat_name, path):
+    """
+    Replaces the snapshot with the downloaded data and records the download time in its sidecar file.
+    :param raw: dataframe
+    :param dat_name: string
+    :param path: string
+    :rtype: Timestamp; download time
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    raw.to_csv(path + '.tmp', index=False)
+    os.replace(path + '.tmp', path)
+    return saving_fetch_time(path, getting_data_url(dat_name))
+
+
+def saving_fetch_time(path, url):
+    """
+    :param path: string; snapshot
+    :param url: string
+    :rtype: Timestamp; download time, written to the sidecar file of the snapshot
+    """
+    fetched_at = pd.Timestamp.now()
+    with open(path + '.json.tmp', 'w') as f:
+        json.dump({'url': url, 'fetched_at': fetched_at.isoformat()}, f, indent=2)
+    os.replace(path + '.json.tmp', path + '.json')
+    return fetched_at
+
+
+def fetching_partition(dat_name, url):
+    """
+    The partition file in the snapshot directory of the data set; it is downloaded, straight to the disk, if it is
+    not fresh.
+    :param dat_name: string
+    :param url: string; one of the URLs of the data set
+    :rtype: string; path of the file
+    """
+    path = os.path.join(config.datasets[dat_name]['snapshot'], url.rstrip('/').rsplit('/', 1)[-1])
+    with locking_file(path + '.lock'):
+        if not checking_snapshot(path):
+            with requests.get(url, stream=True, timeout=config.orchestrator_download_timeout) as r:
+                r.raise_for_status()
+                r.raw.decode_content = True
+                with open(path + '.tmp', 'wb') as f:
+                    shutil.copyfileobj(r.raw, f)
+            os.replace(path + '.tmp', path)
+            saving_fetch_time(path, url)
+            logger.info('{0} is downloaded to {1}.'.format(url, path))
+    return path
+
+
+def checking_snapshot(path, max_age_hours=None):
+    """
+    :param path: string
+    :param max_age_hours: int; config.snapshot_max_age_hours if it is None
+    :rtype: bool; True if the snapshot exists and it was downloaded recently enough
+    """
+    max_age_hours = config.snapshot_max_age_hours if max_age_hours is None else max_age_hours
+    if path is None or not os.path.exists(path):
+        return False
+    # the modification time is not used, a checkout or a copy changes it
+    fetched_at = loading_fetch_time(path)
+    if fetched_at is None:
+        return False
+    return max_age_hours is None or pd.Timestamp.now() - fetched_at < pd.Timedelta(hours=max_age_hours)
+
+
+def reading_dataset(dat_name):
+    """
+    Reads the data set from the freshest source: the local store in the incremental refresh mode, otherwise
+    the snapshot if it is fresh, otherwise the portal (the snapshot is replaced by the download). If the portal
+    cannot be reached, the stale snapshot or the bundled copy is read. The parsed snapshot is also kept as a pickle,
+    so the csv file is parsed once after every download.
+    :param dat_name: string
+    :rtype: dataframe; with the catalog schema
+    """
+    spec = config.datasets[dat_name]
+    if config.refresh_mode == 'incremental' and dat_name in config.refresh_datasets:
+        return refreshing_parsed_store(dat_name)
+
+    if spec['partitioned'] is True:
+        return applying_schema(pd.concat(list(iterating_raw_data(dat_name)), ignore_index=True), dat_name)
+    snapshot = spec['snapshot']
+    if snapshot is None:
+        return applying_schema(getting_raw_data(dat_name), dat_name)
+
+    parsed = os.path.splitext(snapshot)[0] + '.pkl'
+    # the other processes wait for the download instead of downloading the same file
+    with locking_file(snapshot + '.lock'):
+        if checking_snapshot(snapshot):
+            fetched_at = loading_fetch_time(snapshot)
+            if os.path.exists(parsed):
+                cached = pd.read_pickle(parsed)
+                if cached['fetched_at'] == fetched_at:
+                    logger.info('{0} is read from the parsed snapshot.'.format(dat_name))
+                    return cached['data']
+            raw = pd.read_csv(snapshot)
+        else:
+            try:
+                raw = getting_raw_data(dat_name)
+            except requests.RequestException as e:
+                fallback = snapshot if os.path.exists(snapshot) else spec['bundled']
+                if fallback is None or not os.path.exists(fallback):
+                    raise
+                logger.warning('{0} cannot be downloaded ({1}), {2} is read.'.format(dat_name, e, fallback))
+                return applying_schema(pd.read_csv(fallback), dat_name)
+            fetched_at = saving_snapshot(raw, dat_name, snapshot)
+
+        dat = applying_schema(raw, dat_name)
+        pd.to_pickle({'fetched_at': fetched_at, 'data': dat}, parsed + '.tmp')
+        os.replace(parsed + '.tmp', parsed)
+    return dat
+
+
+def loading_dataset(dat_name):
+    """
+    :param dat_name: string
+    :rtype: dataframe; a copy of the parsed data set, so the callers can change it
+    """
+    with dataset_locks[dat_name]:
+        if dat_name not in dataset_cache:
+            dat = reading_dataset(dat_name)
+            if config.memory_budget_mb is not None:
+                # numbers only, the modules group these data sets by their strings without observed=True
+                dat = shrinking_frame(dat, category_ratio=0)
+                reporting_memory(dat, dat_name, 'loaded & shrunk')
+            dataset_cache[dat_name] = dat
+        return dataset_cache[dat_name].copy()
+
+
+def forgetting_dataset(dat_name):
+    """
+    Drops the parsed copy of the data set, the next loading_dataset reads its source again.
+    :param dat_name: string
+    :return: None
+    """
+    if dat_name in dataset_locks:
+        with dataset_locks[dat_name]:
+            dataset_cache.pop(dat_name, None)
+
+
+def fetching_new_records(dat_name, max_id):
+    """
+    The records whose _id is greater than max_id; the portal appends the new records with increasing _id values.
+    The SQL endpoint of the portal's datastore API is used to page through them by _id, if it is not available,
+    the whole csv file is downloaded and filtered on its _id column.
+    :param dat_name: string
+    :param max_id: int; greatest _id in the local store
+    :rtype: dataframe; with the _id column, sorted by it
+    """
+    url = getting_data_url(dat_name)
+    resource_id = re.search(r'/resource/([0-9a-f-]+)/', url).group(1)
+    try:
+        records, last_id = [], max_id
+        while True:
+            sql = 'SELECT * FROM "{0}" WHERE _id > {1} ORDER BY _id LIMIT {2}'.format(resource_id, int(last_id),
+                                                                                  config.ckan_page_size)
+            r = requests.get(config.ckan_datastore_sql_url, timeout=60, params={'sql': sql})
+            r.raise_for_status()
+            result = r.json()['result']
+            records += result['records']
+            if len(result['records']) < config.ckan_page_size:
+                break
+            last_id = result['records'][-1]['_id']
+        return pd.DataFrame(records, columns=[f['id'] for f in result['fields'] if f['id'] != '_full_text'])
+    except (requests.RequestException, KeyError, ValueError) as e:
+        logger.warning('Datastore API is not available for {0} ({1}), the csv file is used.'.format(dat_name, e))
+        s = requests.get(url).content
+        dat = pd.read_csv(io.StringIO(s.decode('utf-8')))
+        dat.columns = [c.lstrip('\ufeff') for c in dat.columns]
+        if '_id' not in dat.columns:
+            raise ValueError('The csv file of {0} has no _id column, it cannot be refreshed incrementally.'.format(
+                dat_name))
+        return dat[dat['_id'] > max_id].sort_values('_id')
+
+
+@contextlib.contextmanager
+def locking_file(path):
+    """
+    Exclusive lock on the file across the processes, e.g. the Streamlit server and a scheduled refresh; it is
+    released when the block exits. The lock is advisory, so every writer has to take it.
+    :param path: string; the lock file, created if it does not exist
+    :rtype: context manager
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'a+') as f:
+        if os.name == 'nt':
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:  # LK_LOCK gives up after 10 seconds
+                    continue
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def loading_watermarks(path=config.refresh_dir):
+    """
+    :param path: string
+    :rtype: dict; max _id, number of records, size of the store file in bytes and refresh time per data set
+    """
+    file_ = os.path.join(path, 'watermarks.json')
+    if not os.path.exists(file_):
+        return {}
+    with open(file_) as f:
+        return json.load(f)
+
+
+def saving_watermarks(watermarks, path=config.refresh_dir):
+    """
+    :param watermarks: dict
+    :param path: string
+    :return: None
+    """
+    file_ = os.path.join(path, 'watermarks.json')
+    with open(file_ + '.tmp', 'w') as f:
+        json.dump(watermarks, f, indent=2)
+    os.replace(file_ + '.tmp', file_)
+
+
+def refreshing_raw_data(dat_name, path=config.refresh_dir):
+    """
+    Appends the records after the watermark to the local store of the data set and moves the watermark; the caller
+    holds the lock of the store (locking_file on <dat_name>.lock in the same directory).
+    :param dat_name: string
+    :param path: string
+    :rtype: dataframe; the new records
+    """
+    os.makedirs(path, exist_ok=True)
+    file_ = os.path.join(path, dat_name + '.csv')
+    watermarks = loading_watermarks(path)
+    wm = watermarks.get(dat_name, {'max_id': 0, 'rows': 0, 'bytes': 0})
+
+    # anything after the watermark is a leftover of an interrupted refresh
+    if os.path.exists(file_) and os.path.getsize(file_) > wm['bytes']:
+        os.truncate(file_, wm['bytes'])
+
+    new_ = fetching_new_records(dat_name, wm['max_id'])
+    if wm['bytes'] > 0:
+        header = list(pd.read_csv(file_, nrows=0).columns)
+        if sorted(new_.columns) != sorted(header):
+            raise ValueError('The columns of {0} have changed, {1} instead of {2}; remove {3} and its watermark to '
+                             'build the store again.'.format(dat_name, list(new_.columns), header, file_))
+        new_ = new_[header]
+    new_.to_csv(file_, mode='a', header=wm['bytes'] == 0, index=False)
+
+    watermarks[dat_name] = {'max_id': int(new_['_id'].max()) if len(new_) else wm['max_id'],
+                            'rows': wm.get('rows', 0) + len(new_), 'bytes': os.path.getsize(file_),
+                            'refreshed_at': pd.Timestamp.now().isoformat(timespec='seconds')}
+    saving_watermarks(watermarks, path)
+    logger.info('{0} new record(s) of {1}, {2} in total, up to _id {3}.'.format(
+        len(new_), dat_name, watermarks[dat_name]['rows'], watermarks[dat_name]['max_id']))
+    return new_
+
+
+def refreshing_parsed_store(dat_name, path=config.refresh_dir):
+    """
+    Refreshes the local store of the data set and returns it with the catalog schema; the parsed store is kept as
+    a pickle with the store size it covers, so only the appended records are parsed.
+    :param dat_name: string
+    :param path: string
+    :rtype: dataframe
+    """
+    file_ = os.path.join(path, dat_name + '_parsed.pkl')
+    with locking_file(os.path.join(path, dat_name + '.lock')):
+        refreshing_raw_data(dat_name, path)
+        store_bytes = loading_watermarks(path)[dat_name]['bytes']
+        parsed = pd.read_pickle(file_) if os.path.exists(file_) else None
+        if parsed is not None and parsed['bytes'] == store_bytes:
+            return parsed['data']
+
+        if parsed is None or parsed['bytes'] > store_bytes:
+            dat = applying_schema(loading_raw_store(dat_name, path=path), dat_name)
+        else:
+            new_ = applying_schema(loading_raw_store(dat_name, offset=parsed['bytes'], path=path), dat_name)
+            dat = pd.concat([parsed['data'], new_], ignore_index=True)
+        pd.to_pickle({'bytes': store_bytes, 'data': dat}, file_ + '.tmp')
+        os.replace(file_ + '.tmp', file_)
+    return dat
+
+
+def loading_raw_store(dat_name, offset=0, path=config.refresh_dir):
+    """
+    :param dat_name: string
+    :param offset: int; byte position in the store file, only the records after it are read
+    :param path: string
+    :rtype: dataframe
+    """
+    file_ = os.path.join(path, dat_name + '.csv')
+    if offset == 0:
+        return pd.read_csv(file_)
+
+    header = pd.read_csv(file_, nrows=0).columns
+    if os.path.getsize(file_) <= offset:
+        return pd.DataFrame(columns=header)
+    with open(file_, 'rb') as f:
+        f.seek(offset)
+        return pd.read_csv(f, header=None, names=header)
+
+
+def iterating_raw_data(dat_name, chunksize=None, usecols=None):
+    """
+    Yields the data partition by partition (one URL at a time, optionally in chunks of rows),
+    so that only one partition is held in memory. The partitions are read from their snapshot files if the
+    catalog declares a snapshot directory, otherwise they are streamed from the portal.
+    :param dat_name: string
+    :param chunksize: int
+    :param usecols: list; lowercase names of the columns to parse, all of them if it is None
+    :rtype: generator of dataframes
+    """
+    parsed = None if usecols is None else (lambda c: c.lower() in usecols)
+    for u in getting_data_url(dat_name):
+        with contextlib.ExitStack() as stack:
+            if config.datasets[dat_name]['snapshot'] is None:
+                r = stack.enter_context(requests.get(u, stream=True))
+                r.raw.decode_content = True
+                source = r.raw
+            else:
+                source = fetching_partition(dat_name, u)
+            if chunksize is None:
+                yield pd.read_csv(source, usecols=parsed)
+            else:
+                for chunk in pd.read_csv(source, chunksize=chunksize, usecols=parsed):
+                    yield chunk
+
+
+def measuring_memory(dat):
+    """
+    :param dat: dataframe
+    :rtype: float; deep memory usage in MB
+    """
+    return dat.memory_usage(deep=True).sum() / 2 ** 20
+
+
+def reporting_memory(dat, dat_name, stage):
+    """
+    Logs the deep memory usage of the frame at a stage of the pipeline, in the memory budget mode only, because
+    measuring the strings scans them.
+    :param dat: dataframe
+    :param dat_name: string
+    :param stage: string
+    :rtype: float; MB, None if there is no memory budget
+    """
+    if config.memory_budget_mb is None:
+        return None
+    mb = measuring_memory(dat)
+    logger.info('{0} - {1}: {2} rows, {3:.1f} MB of the {4} MB budget'.format(dat_name, stage, len(dat), mb,
+                                                                             config.memory_budget_mb))
+    return mb
+
+
+def shrinking_frame(dat, category_ratio=None):
+    """
+    Downcasts the numbers without changing their values and turns the repetitive strings into categoricals, in
+    place; the groupbys & pivots over categorical keys need observed=True.
+    :param dat: dataframe
+    :param category_ratio: float; config.memory_category_ratio if it is None
+    :rtype: dataframe
+    """
+    category_ratio = config.memory_category_ratio if category_ratio is None else category_ratio
+    for c in dat.columns:
+        s = dat[c]
+        if pd.api.types.is_integer_dtype(s.dtype):
+            dat[c] = pd.to_numeric(s, downcast='integer')
+        elif pd.api.types.is_float_dtype(s.dtype):
+            f = s.astype(np.float32)
+            if np.array_equal(f.values, s.values, equal_nan=True):
+                dat[c] = f
+        elif s.dtype == object and s.nunique(dropna=False) < category_ratio * len(s):
+            dat[c] = s.astype('category')
+    return dat
+
+
+def concatenating_frames(frames):
+    """
+    pd.concat that keeps the categorical columns categorical, even if the frames have different categories.
+    :param frames: list of dataframes
+    :rtype: dataframe
+    """
+    for c in frames[0].columns:
+        if isinstance(frames[0][c].dtype, pd.CategoricalDtype):
+            categories = functools.reduce(lambda a, b: a.union(b), [f[c].cat.categories for f in frames])
+            for f in frames:
+                f[c] = f[c].cat.set_categories(categories)
+    return pd.concat(frames, ignore_index=True)
+
+
+def iterating_shrunk_partitions(dat_name, preparing, keep, chunksize=None):
+    """
+    Yields the partitions of the data set one at a time, optionally in chunks of rows; only the used columns are
+    parsed, then the partition is prepared and shrunk.
+    :param dat_name: string
+    :param preparing: function; prepares a raw partition, e.g. traffic_density_hourly.preparing_partition
+    :param keep: list; lowercase names of the columns that are used
+    :param chunksize: int
+    :rtype: generator of dataframes
+    """
+    for i, part in enumerate(iterating_raw_data(dat_name, chunksize=chunksize, usecols=keep)):
+        reporting_memory(part, dat_name, 'partition {0} read'.format(i))
+        part = shrinking_frame(preparing(part))
+        reporting_memory(part, dat_name, 'partition {0} prepared & shrunk'.format(i))
+        yield part
+
+
+def estimating_footprint(dat_name, preparing, keep, nrows=None):
+    """
+    Estimates the memory of the whole prepared & shrunk data set before any partition is loaded: the first rows
+    of the first partition file are prepared & shrunk, and their MB per byte of the file is scaled to the size of
+    all partition files.
+    :param dat_name: string
+    :param preparing: function; prepares a raw partition
+    :param keep: list; lowercase names of the columns that are used
+    :param nrows: int; config.memory_sample_rows if it is None
+    :rtype: tuple; estimated MB of the whole data set & True if it is over the memory budget
+    """
+    nrows = config.memory_sample_rows if nrows is None else nrows
+    paths = [fetching_partition(dat_name, u) for u in getting_data_url(dat_name)]
+    if not paths:
+        return 0.0, False
+
+    with open(paths[0], 'rb') as f:
+        sample = b''.join(f.readline() for _ in range(nrows + 1))  # the header & nrows rows
+    part = shrinking_frame(preparing(pd.read_csv(io.BytesIO(sample), usecols=lambda c: c.lower() in keep)))
+    mb = float(measuring_memory(part) / max(len(sample), 1) * sum(os.path.getsize(p) for p in paths))
+    logger.info('{0} is estimated at {1:.1f} MB in memory from {2} rows.'.format(dat_name, mb, len(part)))
+    return mb, mb > config.memory_budget_mb
+
+
+def sampling_stratified(dat, strata, fraction, min_rows=None, seed=None):
+    """
+    Stratified random sample without replacement; ceil(fraction x size) rows of each stratum are kept, at least
+    min_rows, all of them in the smaller strata. The stratum size & the stratum sample size are added as the
+    stratum_size & stratum_sample columns, their ratio is the weight of a sampled row.
+    :param dat: dataframe
+    :param strata: list; columns
+    :param fraction: float
+    :param min_rows: int; config.preview_min_rows if it is None
+    :param seed: int
+    :rtype: dataframe
+    """
+    min_rows = config.preview_min_rows if min_rows is None else min_rows
+    codes = dat.groupby(strata, sort=False, dropna=False).ngroup().values
+    size = np.bincount(codes)
+    # a random rank within the stratum; the rows ranked below the stratum sample size are kept
+    order = np.argsort(codes + np.random.default_rng(seed).random(len(dat)))  # by stratum, randomly within it
+    rank = np.empty(len(dat), dtype=np.int64)
+    rank[order] = np.arange(len(dat)) - np.repeat(np.cumsum(size) - size, size)
+    size = size[codes]
+    n = np.minimum(size, np.maximum(np.ceil(fraction * size), min_rows))
+    is_kept = rank < n
+    sample = dat[is_kept].copy()
+    sample['stratum_size'] = size[is_kept]
+    sample['stratum_sample'] = n[is_kept]
+    return sample
+
+
+def iterating_sampled_partitions(dat_name, preparing, keep, fraction, chunksize=None):
+    """
+    Yields a stratified sample of the data set, with the strata of config.preview_strata, chunk by chunk; every chunk
+    is sampled as soon as it is read, so only the used columns of one chunk are held in memory besides the sampled
+    rows, and only the sampled rows are prepared. A stratum split between two chunks is sampled as two strata, told
+    apart by the stratum_chunk column.
+    :param dat_name: string
+    :param preparing: function; prepares a raw partition
+    :param keep: list; lowercase names of the columns that are used
+    :param fraction: float
+    :param chunksize: int; config.preview_chunk_size if it is None
+    :rtype: generator of dataframes
+    """
+    chunksize = config.preview_chunk_size if chunksize is None else chunksize
+    chunks = iterating_raw_data(dat_name, chunksize=chunksize, usecols=keep)
+    for i, chunk in enumerate(chunks):
+        chunk.columns = [c.lower() for c in chunk.columns]
+        sample = sampling_stratified(chunk, config.preview_strata[dat_name], fraction, seed=i)
+        sample['stratum_chunk'] = i
+        logger.info('{0} - chunk {1}: {2} of {3} rows are sampled'.format(dat_name, i, len(sample), len(chunk)))
+        yield preparing(sample)
+
+
+def getting_z_score(confidence=None):
+    """
+    :param confidence: float; config.preview_confidence if it is None
+    :rtype: float; two-sided critical value of the normal distribution
+    """
+    confidence = config.preview_confidence if confidence is None else confidence
+    return statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+
+
+def estimating_stratified_sums(sample, strata, by, col, confidence=None):
+    """
+    Estimates of the sums of the column by the given keys from a stratified sample, with the half widths of their
+    confidence intervals (normal approximation); each stratum has to fall into one group of the keys.
+    :param sample: dataframe; output of sampling_stratified, possibly prepared
+    :param strata: list
+    :param by: list; keys of the sums, e.g. ['date_time']
+    :param col: string
+    :param confidence: float; config.preview_confidence if it is None
+    :rtype: dataframe; keys, estimate, variance & margin
+    """
+    keys = strata + [c for c in by if c not in strata]
+    if 'stratum_chunk' in sample.columns:
+        # a stratum split between the chunks of iterating_sampled_partitions is sampled as separate strata
+        keys.append('stratum_chunk')
+    per = sample.groupby(keys, observed=True).agg(size=('stratum_size', 'first'), n=('stratum_sample', 'first'),
+                                                  mean=(col, 'mean'), var=(col, 'var')).reset_index()
+    per['estimate'] = per['size'] * per['mean']
+    # variance of the estimated stratum total, with the finite population correction
+    per['variance'] = per['size'] ** 2 * (1 - per['n'] / per['size']) * per['var'].fillna(0) / per['n']
+    sums = per.groupby(by, observed=True)[['estimate', 'variance']].sum().reset_index()
+    sums['margin'] = getting_z_score(confidence) * np.sqrt(sums['variance'])
+    return sums
+
+
+def weighting_sample(sample, cols):
+    """
+    Multiplies the columns by the weights of the sampled rows, in place; the sums of the weighted columns are the
+    estimates of the sums over all rows, so the charts built on sums can be drawn from the sample as they are.
+    :param sample: dataframe; output of sampling_stratified
+    :param cols: list
+    :rtype: dataframe
+    """
+    weight = sample['stratum_size'] / sample['stratum_sample']
+    for c in cols:
+        sample[c] = sample[c] * weight
+    return sample
+
+
+def creating_partial_aggregates(dat, keys, col):
+    """
+    :param dat: dataframe
+    :param keys: list
+    :param col: string
+    :rtype: dataframe; sum, count, min and max of the column for each key
+    """
+    return dat[keys + [col]].groupby(keys, observed=True)[col] \
+        .agg(['sum', 'count', 'min', 'max']).reset_index()
+
+
+def combining_partial_aggregates(partials, keys):
+    """
+    Combines the outputs of creating_partial_aggregates; the mean is derived from the combined sum and count.
+    :param partials: list of dataframes
+    :param keys: list
+    :rtype: dataframe
+    """
+    combined = pd.concat(partials, ignore_index=True) \
+        .groupby(keys, observed=True) \
+        .agg({'sum': 'sum', 'count': 'sum', 'min': 'min', 'max': 'max'}).reset_index()
+    combined['mean'] = combined['sum'] / combined['count']
+    return combined
+
+
+def creating_time_buckets(dat, date_col, cols, backend='pandas', table=None):
+    """
+    Daily sum, count, min and max of the columns in one pass over the data. The other granularities are rolled
+    up from these daily partials when they are first asked for and kept in the returned dict, so switching
+    between them does not touch the data again.
+    :param dat: dataframe
+    :param date_col: string; timestamp column
+    :param cols: list; numeric columns
+    :param backend: string; pandas, duckdb or sqlite
+    :param table: string; table name in the SQL backends
+    :rtype: dict
+    """
+    if backend == 'pandas':
+        data = dat[cols].groupby(dat[date_col].dt.floor('D').rename(date_col)).agg(['sum', 'count', 'min', 'max'])
+    else:
+        data = sql_backend.creating_daily_partials(dat, table, date_col, cols, backend)
+    return {'cols': list(cols), 'partials': data, 'cache': {}}
+
+
+def getting_time_buckets(buckets, granularity='daily', aggs=('mean',)):
+    """
+    :param buckets: dict; output of creating_time_buckets
+    :param granularity: string; daily, weekly, monthly, quarterly or yearly
+    :param aggs: list; some of mean, sum, count, min and max
+    :rtype: dataframe; indexed by the start of each bucket, columns are (column, aggregation) pairs
+    """
+    freq = config.time_granularity[granularity]
+    if freq not in buckets['cache']:
+        data = buckets['partials'].copy()
+        if freq != 'D':
+            rollup = {k: k[1] if k[1] in ['min', 'max'] else 'sum' for k in data.columns}
+            data = data.groupby(data.index.to_period(freq).start_time.rename(data.index.name)).agg(rollup)
+        for c in buckets['cols']:
+            data[(c, 'mean')] = data[(c, 'sum')] / data[(c, 'count')]
+        buckets['cache'][freq] = data
+
+    return buckets['cache'][freq][[(c, a) for c in buckets['cols'] for a in aggs]]
+
+
+def merging_time_buckets(buckets, dat, date_col):
+    """
+    Adds the daily partials of the new records to the buckets; the rolled up granularities are computed again
+    from the daily partials when they are asked for.
+    :param buckets: dict; output of creating_time_buckets
+    :param dat: dataframe; new records
+    :param date_col: string
+    :rtype: dict
+    """
+    partials = pd.concat([buckets['partials'], creating_time_buckets(dat, date_col, buckets['cols'])['partials']])
+    rollup = {k: k[1] if k[1] in ['min', 'max'] else 'sum' for k in partials.columns}
+    return {'cols': buckets['cols'], 'partials': partials.groupby(level=0).agg(rollup), 'cache': {}}
+
+
+def refreshing_time_buckets(dat_name, preparing, date_col, cols, path=config.refresh_dir):
+    """
+    Time buckets of the local store, updated with the records appended since they were saved.
+    :param dat_name: string
+    :param preparing: function; turns the raw records into the prepared dataframe of the data set
+    :param date_col: string
+    :param cols: list
+    :param path: string
+    :rtype: dict
+    """
+    file_ = os.path.join(path, dat_name + '_buckets.pkl')
+    with locking_file(os.path.join(path, dat_name + '.lock')):
+        store_bytes = loading_watermarks(path)[dat_name]['bytes']
+        buckets = pd.read_pickle(file_) if os.path.exists(file_) else None
+        if buckets is not None and buckets['cols'] == list(cols) and buckets['bytes'] == store_bytes:
+            return buckets
+
+        if buckets is None or buckets['cols'] != list(cols):
+            buckets = creating_time_buckets(preparing(loading_raw_store(dat_name, path=path)), date_col, cols)
+        else:
+            new_ = loading_raw_store(dat_name, offset=buckets['bytes'], path=path)
+            buckets = merging_time_buckets(buckets, preparing(new_), date_col)
+
+        buckets['bytes'] = store_bytes
+        pd.to_pickle(buckets, file_ + '.tmp')
+        os.replace(file_ + '.tmp', file_)
+    return buckets
+
+
+# ISO 8601 prefix length -> resolution that keeps the same information as truncating the string to that length
+iso_prefix_regex = r'^\d{4}-\d{2}-\d{2}([ T]\d{2}(:\d{2}(:\d{2})?)?)?'
+iso_prefix_freq = {10: 'D', 13: 'H', 16: 'min', 19: 'S'}
+
+
+def parsing_datetime_values(values, length=None, fmt=None):
+    """
+    :param values: series of strings
+    :param length: int
+    :param fmt: string
+    :rtype: DatetimeIndex
+    """
+    if length is None:
+        return pd.DatetimeIndex(pd.to_datetime(values.values, format=fmt, cache=False))
+
+    sample = values.dropna().iloc[:1000]
+    if fmt is None and length in iso_prefix_freq and sample.str.match(iso_prefix_regex).all():
+        # ISO fast path; parsing the whole string and flooring is the same as parsing the truncated string
+        try:
+            parsed = pd.to_datetime(values.values, cache=False)
+        except (ValueError, TypeError):
+            parsed = None
+        if isinstance(parsed, pd.DatetimeIndex):
+            if parsed.tz is not None:
+                # local wall time, like the truncated string without the UTC offset
+                parsed = parsed.tz_localize(None)
+            return parsed.floor(iso_prefix_freq[length])
+
+    # fixed-width numpy strings truncate without a Python level loop
+    truncated = values.values.astype('U{0}'.format(length)).astype(object)
+    truncated[values.isna().values] = None
+    return pd.DatetimeIndex(pd.to_datetime(truncated, format=fmt, cache=False))
+
+
+def parsing_datetime(dat, cols, length=None, fmt=None):
+    """
+    Parses one or more timestamp columns of the dataframe in one pass.
+    Repeated strings (hourly or daily data) are parsed only once and mapped back by their codes.
+    :param dat: dataframe
+    :param cols: string or list
+    :param length: int; strings are truncated to this length, e.g. 19 for YYYY-MM-DD HH:MM:SS
+    :param fmt: string; explicit format of the (truncated) strings, it is inferred if None
+    :return: None
+    """
+    cols = [cols] if isinstance(cols, str) else cols
+    values = pd.concat([dat[c] for c in cols], ignore_index=True)
+
+    sample = values.iloc[:10000]
+    if sample.nunique() < 0.1 * len(sample):
+        codes, uniques = pd.factorize(values)
+        parsed = parsing_datetime_values(pd.Series(uniques, dtype=object), length=length, fmt=fmt) \
+            .take(codes, allow_fill=True, fill_value=pd.NaT)
+    else:
+        parsed = parsing_datetime_values(values, length=length, fmt=fmt)
+
+    n = len(dat)
+    for i, c in enumerate(cols):
+        dat[c] = parsed[i * n:(i + 1) * n].values if parsed.tz is None else parsed[i * n:(i + 1) * n]
+
+
+def downsampling_lttb(x, y, n_out):
+    """
+    Largest-Triangle-Three-Buckets downsampling; the first and the last points are kept and from every bucket
+    the point forming the largest triangle with the previous selected point and the average of the next bucket.
+    :param x: numpy array; numeric or datetime64
+    :param y: numpy array
+    :param n_out: int; number of points to keep
+    :rtype: numpy array; indices of the selected points
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    if np.issubdtype(x.dtype, np.datetime64):
+        x_ = x.astype('datetime64[ns]').astype(np.int64).astype(np.float64)
+    elif np.issubdtype(x.dtype, np.number):
+        x_ = x.astype(np.float64)
+    else:
+        # categorical axis, the points are equally spaced
+        x_ = np.arange(n, dtype=np.float64)
+    y_ = y.astype(np.float64)
+    # bucket edges of the points between the first and the last one
+    edges = (np.arange(n_out - 1) * (n - 2) / (n_out - 2)).astype(np.int64) + 1
+    edges[-1] = n - 1
+
+    # averages of the buckets, the last point is the "next bucket" of the last bucket
+    x_sum, y_sum = np.add.reduceat(x_[:n - 1], edges[:-1]), np.add.reduceat(y_[:n - 1], edges[:-1])
+    counts = np.diff(edges)
+    x_avg = np.append(x_sum / counts, x_[-1])
+    y_avg = np.append(y_sum / counts, y_[-1])
+
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        area = np.abs((x_[a] - x_avg[i + 1]) * (y_[lo:hi] - y_[a]) - (x_[a] - x_[lo:hi]) * (y_avg[i + 1] - y_[a]))
+        a = lo + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+def downsampling_series(x, y, max_points=None, x_range=None):
+    """
+    Applies LTTB when the series has more points than the budget. A zoomed range is filtered first,
+    so that it is returned in full resolution as long as it fits into the budget.
+    :param x: series or numpy array
+    :param y: series or numpy array
+    :param max_points: int; config.max_points if it is None, downsampling is off if that is None too
+    :param x_range: tuple; (start, end), both included
+    :rtype: tuple of numpy arrays
+    """
+    max_points = config.max_points if max_points is None else max_points
+    x, y = np.asarray(x), np.asarray(y)
+    if x_range is not None:
+        start, end = x_range
+        if np.issubdtype(x.dtype, np.datetime64):
+            start, end = np.datetime64(pd.Timestamp(start)), np.datetime64(pd.Timestamp(end))
+        mask = (x >= start) & (x <= end)
+        x, y = x[mask], y[mask]
+
+    if max_points is None or len(x) <= max_points:
+        return x, y
+
+    is_valid = ~pd.isna(y)
+    x, y = x[is_valid], y[is_valid]
+    idx = downsampling_lttb(x, y, max_points)
+    return x[idx], y[idx]
@@ -2,14 +2,17 @@
 # -*- coding: utf-8 -*-
 
 import config
-import datapane as dp
+import figure_encoding
+import lazy_imports
 import logging
+import numpy as np
 import pandas as pd
-import plotly.express as px
 import plotly.graph_objs as go
-import streamlit as st
 import utils
 
+h3 = lazy_imports.importing_lazily('h3')
+px = lazy_imports.importing_lazily('plotly.express')
+
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger('IMM Data Visualization - Daily Wifi New User')
 
@@ -18,38 +21,87 @@ def data_preparation():
     """
     :return: dataframe
     """
-    # getting data
-    data = utils.getting_raw_data(dat_name='wnu')
-    data.columns = ['subscription_date', 'subscription_county', 'subscription_type', 'lon', 'lat',
-                    'number_of_subscription']
+    # getting data, one parsed copy is shared in the process
+    return preparing_data(utils.loading_dataset('wnu'))
+
+
+def preparing_data(data):
+    """
+    :param data: dataframe; raw records or the output of utils.loading_dataset
+    :rtype: dataframe
+    """
+    # column names & str -> timestamp for date column, as declared in the dataset catalog
+    data = utils.applying_schema(data, 'wnu')
     # converting from Turkish to English for subscription type column
     data['subscription_type'] = data['subscription_type'].map({'Yerli': 'domestic',
                                                                'Yabancı': 'foreign',
                                                                'Bilinmiyor': 'unknown'})
-    # Changing data type for date column, str -> timestamp
-    data['subscription_date'] = pd.to_datetime(data['subscription_date'])
     return data
 
 
-def creating_line_graph_based_date(df, date_type):
+def getting_time_buckets(df):
     """
-    :param df: dataframe
-    :param date_type: string
+    :param df: dataframe; output of data_preparation or creating_subscription_cube
+    :rtype: dict; in the incremental refresh mode, only the appended records are added to the saved buckets
+    """
+    if config.refresh_mode == 'incremental':
+        return utils.refreshing_time_buckets('wnu', preparing_data, 'subscription_date', ['number_of_subscription'])
+    return utils.creating_time_buckets(df, 'subscription_date', ['number_of_subscription'],
+                                       backend=config.aggregation_backend['wnu'], table='wifi_subscriptions')
+
+
+def creating_subscription_cube(dat, resolution=config.wnu_h3_resolution):
+    """
+    Number of records and subscriptions per date, county, subscription type and H3 cell; the charts are
+    roll-ups of it, so the raw data are grouped only once.
+    :param dat: dataframe; output of data_preparation
+    :param resolution: int; H3 resolution
+    :rtype: dataframe
+    """
+    # the cell is computed once per location; missing coordinates (-1) pick the trailing None
+    locations = dat.groupby(['lat', 'lon'], sort=False)
+    first = locations[['lat', 'lon']].first()
+    hexes = [h3.geo_to_h3(la, lo, resolution) for la, lo in zip(first['lat'].values, first['lon'].values)]
+    hex_id = np.array(hexes + [None], dtype=object)[locations.ngroup().fillna(-1).values.astype(np.int64)]
+
+    keys = [dat['subscription_date'].dt.floor('D'), dat['subscription_county'], dat['subscription_type'],
+            pd.Series(hex_id, index=dat.index, name='hex_id')]
+    return dat.groupby(keys, dropna=False)['number_of_subscription'] \
+        .agg(record_count='size', number_of_subscription='sum').reset_index()
+
+
+def rolling_up_cube(cube, dims, values=('number_of_subscription',)):
+    """
+    :param cube: dataframe; output of creating_subscription_cube
+    :param dims: list; some of subscription_date, subscription_county, subscription_type and hex_id
+    :param values: list; record_count and/or number_of_subscription
+    :rtype: dataframe
+    """
+    return cube.groupby(list(dims))[list(values)].sum().reset_index()
+
+
+def creating_line_graph_based_date(df, date_type, x_range=None, buckets=None):
+    """
+    :param df: dataframe; output of data_preparation or creating_subscription_cube
+    :param date_type: string; daily, weekly, monthly, quarterly or yearly
+    :param x_range: tuple; (start date, end date), the zoomed range is shown in full resolution within the budget
+    :param buckets: dict; output of utils.creating_time_buckets, shared by the graphs of all granularities
     :return: Plotly Scatter Plot
     """
-    if date_type == 'daily':
-        title_ = 'Daily Subscription Count'
-        mode_ = 'lines'
-    else:
-        df['subscription_date'] = df['subscription_date'].dt.strftime('%Y-%m')
-        title_ = 'Monthly Subscription Count'
-        mode_ = 'lines+markers'
+    title_ = '{0} Subscription Count'.format(date_type.title())
+    mode_ = 'lines' if date_type == 'daily' else 'lines+markers'
+
+    buckets = utils.creating_time_buckets(df, 'subscription_date', ['number_of_subscription']) \
+        if buckets is None else buckets
+    df_grouped = utils.getting_time_buckets(buckets, granularity=date_type, aggs=['sum'])[
+        ('number_of_subscription', 'sum')]
 
-    df_grouped = df[['subscription_date', 'number_of_subscription']].groupby('subscription_date').sum().reset_index()
+    # long series are downsampled to the point budget
+    x_, y_ = utils.downsampling_series(df_grouped.index, df_grouped.values, x_range=x_range)
 
-    fig = go.Figure(data=go.Scatter(x=df_grouped['subscription_date'], y=df_grouped['number_of_subscription'],
-                                    marker_color=df_grouped['number_of_subscription'], showlegend=True,
-                                    name="Number of Subscription", mode=mode_))
+    scatter = figure_encoding.choosing_scatter_type(len(x_))
+    fig = go.Figure(data=scatter(x=x_, y=y_, marker_color=y_, showlegend=True,
+                                 name="Number of Subscription", mode=mode_))
     fig.update_layout(
         title=title_,
         xaxis_title='Date',
@@ -65,9 +117,9 @@ def creating_line_graph_based_date(df, date_type):
     return fig
 
 
-def creating_bar_graph(df, col):
+def creating_bar_graph(cube, col):
     """
-    :param df: dataframe
+    :param cube: dataframe; output of creating_subscription_cube
     :param col: string
     :return: Plotly Express Bar Plot
     """
@@ -78,7 +130,7 @@ def creating_bar_graph(df, col):
         xlbl = 'Type'
         rtt = 0
 
-    df_grouped = df[[col, 'number_of_subscription']].groupby(col).sum().reset_index()
+    df_grouped = rolling_up_cube(cube, [col])
     fig = px.bar(df_grouped, x=col, y='number_of_subscription', color=col, height=600)
     fig.update_layout(
         title='Subscription Count by {0}'.format(xlbl),
@@ -99,18 +151,17 @@ def creating_bar_graph(df, col):
     return fig
 
 
-def creating_stack_bar_graph(dat):
+def creating_stack_bar_graph(cube):
     """
-    :param dat: dataframe
+    :param cube: dataframe; output of creating_subscription_cube
     :return: Plotly Express Bar Plot
     """
-    dat_county_ = dat[dat['subscription_county'].isin(config.wnu_county_list_)][
-        ['subscription_county', 'subscription_type', 'number_of_subscription']]
-    df_stack = dat_county_.groupby(['subscription_county', 'subscription_type']).size().reset_index()
-    df_stack['percentage'] = dat_county_.groupby(['subscription_county', 'subscription_type'])\
-        .size().groupby(level=0).apply(lambda x: 100 * x / float(x.sum())).values
-    df_stack.rename(columns={0: 'number_of_subscription'}, inplace=True)
-    df_stack['percentage'] = df_stack['percentage'].map('{:,.2f}%'.format)
+    # number of records by county & type, and their share in the county
+    df_stack = rolling_up_cube(cube[cube['subscription_county'].isin(config.wnu_county_list_)],
+                               ['subscription_county', 'subscription_type'], values=['record_count']) \
+        .rename(columns={'record_count': 'number_of_subscription'})
+    total = df_stack.groupby('subscription_county')['number_of_subscription'].transform('sum')
+    df_stack['percentage'] = (100 * df_stack['number_of_subscription'] / total).map('{:,.2f}%'.format)
 
     fig = px.bar(df_stack, x='subscription_county', y='number_of_subscription', color='subscription_type',
                  barmode='stack', text=df_stack['percentage'])
@@ -125,49 +176,62 @@ def main():
     """
     :return: Plotly Figure
     """
-    df = data_preparation()
+    cube = creating_subscription_cube(data_preparation())
+    buckets = getting_time_buckets(cube)
 
     # The localhost page is opened on the Internet browser.
     # Each plot is presented in a separate browser tab.
     for dt in config.date_type:
-        creating_line_graph_based_date(df=df, date_type=dt)
+        creating_line_graph_based_date(df=cube, date_type=dt, buckets=buckets)
     for c in ['subscription_county', 'subscription_type']:
-        creating_bar_graph(df=df, col=c)
-    creating_stack_bar_graph(dat=df)
+        creating_bar_graph(cube=cube, col=c)
+    creating_stack_bar_graph(cube=cube)
 
 
-def putting_into_streamlit():
+def putting_into_streamlit(cube=None, buckets=None):
     """
+    :param cube: dataframe; output of creating_subscription_cube, loaded here if it is None
+    :param buckets: dict; output of getting_time_buckets
     :return: None
     """
-    df = data_preparation()
+    import streamlit as st
+
+    cube = creating_subscription_cube(data_preparation()) if cube is None else cube
+    buckets = getting_time_buckets(cube) if buckets is None else buckets
     st.markdown("## **:signal_strength: Daily IMM WiFi New User Data Visualization**")
 
+    # the selected range is drawn in full resolution as long as it fits into the point budget
+    first, last = buckets['partials'].index.min().date(), buckets['partials'].index.max().date()
+    x_range = st.slider('Date range', min_value=first, max_value=last, value=(first, last), format='YYYY-MM-DD')
+    x_range = None if x_range == (first, last) else x_range
     for dt in config.date_type:
-        st.write(creating_line_graph_based_date(df=df, date_type=dt))
+        figure_encoding.writing_to_streamlit(creating_line_graph_based_date(df=cube, date_type=dt, x_range=x_range,
+                                                                            buckets=buckets))
 
     for c in ['subscription_county', 'subscription_type']:
-        st.write(creating_bar_graph(df=df, col=c))
+        figure_encoding.writing_to_streamlit(creating_bar_graph(cube=cube, col=c))
 
-    st.write(creating_stack_bar_graph(dat=df))
+    figure_encoding.writing_to_streamlit(creating_stack_bar_graph(cube=cube))
 
 
 def putting_into_datapane():
     """
     :return: None
     """
+    import datapane as dp
+
     # getting token
     dp.login(config.dp_token)
     # getting data
-    df = data_preparation()
+    cube = creating_subscription_cube(data_preparation())
     # line graph
-    p1 = creating_line_graph_based_date(df=df, date_type='monthly')
+    p1 = creating_line_graph_based_date(df=cube, date_type='monthly')
     dp.Report(dp.Plot(p1)).publish(name='Monthly Subscription Count', open=True)
     # bar graph
-    p2 = creating_bar_graph(df=df, col='subscription_county')
+    p2 = creating_bar_graph(cube=cube, col='subscription_county')
     dp.Report(dp.Plot(p2)).publish(name='Subscription Count by County', open=True)
     # stack bar graph
-    p3 = creating_stack_bar_graph(dat=df)
+    p3 = creating_stack_bar_graph(cube=cube)
     dp.Report(dp.Plot(p3)).publish(name='Subscription Count by County & Type', open=True)
 
     dp.logout()